@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import re
+import json
+import fcntl
+import pathlib
+from typing import List, Dict, Any, Union
+
+from profiling import isis
+import helper as h
+
+# scale of the reduced cubes coreg definition file is made for, e.g. 'coreg.maxcor_x20_...' or '..._reduce20_...'
+CONFIG_SCALE_RE = re.compile(r'_(?:x|reduce)(\d+)_')
+
+
+def config_scale(coreg_config) -> Union[int, None]:
+    match = CONFIG_SCALE_RE.search(pathlib.Path(coreg_config).stem)
+    return int(match.group(1)) if match else None
+
+
+def config_cost(coreg_config) -> int:
+    """ Relative cost of coreg with the definition file: pattern chip pixels times search positions """
+    pattern_samples, pattern_lines = h.coreg_chip_size(coreg_config, 'PatternChip')
+    search_samples, search_lines = h.coreg_chip_size(coreg_config, 'SearchChip')
+    positions = max(search_samples - pattern_samples + 1, 1) * max(search_lines - pattern_lines + 1, 1)
+    return pattern_samples * pattern_lines * positions
+
+
+def candidates(coreg_config, scale, preferred=None) -> List[pathlib.Path]:
+    """
+    Coreg definition files for cubes reduced by 'scale' from the folder of 'coreg_config', from the cheapest one.
+    'preferred' config (if it's one of them) goes first
+    """
+    coreg_config = pathlib.Path(coreg_config)
+    configs = [config for config in coreg_config.parent.glob('*.def') if config_scale(config) == scale]
+    if coreg_config not in configs:
+        configs.append(coreg_config)
+    configs.sort(key=lambda config: (config_cost(config), config.name))
+
+    preferred = [config for config in configs if config.name == preferred]
+    return preferred + [config for config in configs if config not in preferred]
+
+
+def pair_kind(old_cub, lroc_cub, scale) -> str:
+    """ Pairs of the same kind (instruments and scale) are expected to be co-registered with the same config """
+    instruments = [isis.getkey_k(cub, group='Instrument', key='InstrumentId').strip('"') for cub in [old_cub, lroc_cub]]
+    return f'{instruments[0]}-{instruments[1]}-x{scale}'
+
+
+def passed(gof_mean, points, min_gof=h.AUTO_TUNE_MIN_GOF, min_points=h.AUTO_TUNE_MIN_POINTS) -> bool:
+    return gof_mean >= min_gof and points >= min_points
+
+
+def load(history_path) -> Dict[str, Any]:
+    """ Configs which co-registered pairs by pair kind: {kind: {'last': config name, 'passed': {config name: count}}} """
+    try:
+        with open(history_path, 'rt') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def preferred(history_path, kind) -> Union[str, None]:
+    """ Config which co-registered the last pair of the kind """
+    return load(history_path).get(kind, {}).get('last')
+
+
+def record(history_path, kind, config_name):
+    """ Record the config which co-registered a pair of the kind (concurrent workers and runs are serialized) """
+    history_path = pathlib.Path(history_path)
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(history_path.with_name(f'{history_path.name}.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        history = load(history_path)
+        entry = history.setdefault(kind, {'last': None, 'passed': {}})
+        entry['last'] = config_name
+        entry['passed'][config_name] = entry['passed'].get(config_name, 0) + 1
+
+        temp_path = history_path.with_name(f'{history_path.name}.tmp')
+        temp_path.write_text(json.dumps(history, indent=2, sort_keys=True))
+        temp_path.replace(history_path)
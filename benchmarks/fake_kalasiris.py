@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the 'kalasiris' module used by benchmarks on machines without ISIS.
+ISIS programs are not run; they write small synthetic outputs (cubes, flatfiles,
+control networks) so the Python side of the tool can be measured end to end.
+Cubes are real pixel cubes of a synthetic scene: 'cam2cam' shifts it, 'reduce' and 'translate'
+process pixels of their input cube, so in-process engines (--engine numpy) run on them
+"""
+import re
+import sys
+import types
+import shutil
+import pathlib
+import subprocess
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+import synthetic
+import cnetbin
+import cube
+
+# number of control points produced by the fake 'coreg' and 'pointreg',
+# shift (lines, samples) of the scene in cubes matched by 'cam2cam' (whole pixels at coreg scales)
+settings = {'coreg_points': 1000, 'match_shift': (40, -20)}
+
+# ISIS programs writing a new cube of the scene to 'to'
+CUBE_PROGRAMS = ['apollo2isis', 'lo2isis', 'lronac2isis', 'std2isis', 'apollowarp', 'apollocal', 'histeq',
+                 'lronaccal', 'lronacecho']
+# ISIS programs updating the cube in place or writing nothing needed by the tool
+NOOP_PROGRAMS = ['spiceinit', 'apollofindrx', 'apollopaninit', 'footprintinit', 'findimageoverlaps']
+
+
+def arg(kwargs, *names):
+    for name in names:
+        if name in kwargs:
+            return kwargs[name]
+    return None
+
+
+def completed(stdout=''):
+    return subprocess.CompletedProcess(args=[], returncode=0, stdout=stdout, stderr='')
+
+
+def write_cube(kwargs):
+    to_ = arg(kwargs, 'to_', 'to')
+    synthetic.write_cube(to_)
+    return completed()
+
+
+def cam2cam(**kwargs):
+    # matched cube shows the scene shifted relative to the MATCH cube
+    synthetic.write_cube(arg(kwargs, 'to_', 'to'), shift=settings['match_shift'])
+    return completed()
+
+
+def reduce(**kwargs):
+    values = cube.read_band(arg(kwargs, 'from_', 'from'))
+    values = synthetic.block_mean(values, int(kwargs.get('lscale', 1)), int(kwargs.get('sscale', 1)))
+    cube.write_band(arg(kwargs, 'to_', 'to'), values, groups=synthetic.CUBE_GROUPS)
+    return completed()
+
+
+def translate(**kwargs):
+    values = np.nan_to_num(cube.read_band(arg(kwargs, 'from_', 'from')))
+    values = ndimage.shift(values, (float(kwargs.get('ltrans', 0.)), float(kwargs.get('strans', 0.))),
+                           order=3, mode='nearest')
+    cube.write_band(arg(kwargs, 'to_', 'to'), values, groups=synthetic.CUBE_GROUPS)
+    return completed()
+
+
+def campt(**kwargs):
+    from_, to_ = arg(kwargs, 'from_', 'from'), arg(kwargs, 'to_', 'to')
+    if not pathlib.Path(from_).exists():
+        raise subprocess.CalledProcessError(1, ['campt'], stderr=f'**I/O ERROR** Unable to open [{from_}]')
+
+    if kwargs.get('usecoordlist'):
+        coords = np.loadtxt(kwargs['coordlist'], delimiter=',', ndmin=2)
+        if kwargs.get('coordtype') == 'ground':
+            df = pd.DataFrame({'Filename': str(from_), 'Sample': synthetic.lon_to_sample(coords[:, 1]),
+                               'Line': synthetic.lat_to_line(coords[:, 0])})
+        else:
+            df = pd.DataFrame({'Filename': str(from_), 'Sample': coords[:, 0], 'Line': coords[:, 1],
+                               'PlanetocentricLatitude': synthetic.line_to_lat(coords[:, 1]),
+                               'PositiveEast360Longitude': synthetic.sample_to_lon(coords[:, 0])})
+        df.to_csv(to_, index=False)
+    else:
+        if kwargs.get('type') == 'ground':
+            lat, lon = float(kwargs['latitude']), float(kwargs['longitude'])
+            sample, line = synthetic.lon_to_sample(lon), synthetic.lat_to_line(lat)
+        else:
+            sample, line = float(kwargs['sample']), float(kwargs['line'])
+            lat, lon = synthetic.line_to_lat(line), synthetic.sample_to_lon(sample)
+        pathlib.Path(to_).write_text(
+            'Group = GroundPoint\n'
+            f'  Sample = {sample}\n  Line = {line}\n'
+            f'  PlanetocentricLatitude = {lat}\n  PositiveEast360Longitude = {lon}\n'
+            'End_Group\n')
+    return completed()
+
+
+def camstats(**kwargs):
+    to_ = arg(kwargs, 'to_', 'to')
+    if to_:
+        pathlib.Path(to_).write_text(
+            'Group = Latitude\n  LatitudeMinimum = 10.0\n  LatitudeMaximum = 12.0\nEnd_Group\n'
+            'Group = "PositiveEast Longitude"\n  PositiveEast360LongitudeMinimum = 20.0\n'
+            '  PositiveEast360LongitudeMaximum = 21.0\nEnd_Group\n')
+    return completed()
+
+
+def getkey(from_=None, grpname=None, keyword=None, **kwargs):
+    if keyword:
+        value = getkey_k(from_, grpname, keyword)
+        return completed(value + '\n')
+    return completed()
+
+
+def getkey_k(cube, group, key):
+    text = pathlib.Path(cube).read_text(errors='ignore')
+    match = re.search(rf'Group = "?{re.escape(group)}"?\n(.*?)End_Group', text, re.S)
+    if match:
+        value = re.search(rf'^\s*{re.escape(key)}\s*=\s*(.*)$', match.group(1), re.M)
+        if value:
+            return value.group(1).strip()
+    # instrument metadata is always "present" in synthetic cubes
+    return 'FAKE'
+
+
+def getsn(**kwargs):
+    return completed(f'FAKE/{pathlib.Path(arg(kwargs, "from_", "from")).stem}\n')
+
+
+def coreg(**kwargs):
+    from_, match = pathlib.Path(arg(kwargs, 'from_', 'from')), pathlib.Path(kwargs['match'])
+    n_points = settings['coreg_points']
+    # coreg writes binary control network
+    header, points = synthetic.control_network_keywords(n_points, from_sn=from_.name, match_sn=match.name)
+    cnetbin.write(kwargs['onet'], header, points)
+    synthetic.write_coreg_stats(kwargs['flatfile'], n_points)
+    synthetic.write_cube(arg(kwargs, 'to_', 'to'))
+    return completed()
+
+
+def pointreg(**kwargs):
+    synthetic.write_pointreg_stats(kwargs['flatfile'], settings['coreg_points'])
+    shutil.copy(kwargs['cnet'], kwargs['onet'])
+    return completed()
+
+
+def autoseed(**kwargs):
+    pathlib.Path(kwargs['onet']).write_text('')
+    return completed()
+
+
+def cnetref(**kwargs):
+    shutil.copy(kwargs['cnet'], kwargs['onet'])
+    return completed()
+
+
+def cnetbin2pvl(**kwargs):
+    import pvl
+    cn = pvl.ControlNetwork.from_keywords(*cnetbin.read(arg(kwargs, 'from_', 'from')))
+    pathlib.Path(arg(kwargs, 'to_', 'to')).write_text(cn.to_pvl())
+    return completed()
+
+
+def cnetpvl2bin(**kwargs):
+    import pvl
+    pvl.read_control_network(arg(kwargs, 'from_', 'from')).to_bin(arg(kwargs, 'to_', 'to'))
+    return completed()
+
+
+def build_module():
+    """ Module object replacing 'kalasiris' """
+    module = types.ModuleType('kalasiris')
+    module.__file__ = __file__
+    module.environ = {}
+
+    for program in CUBE_PROGRAMS:
+        setattr(module, program, lambda *args, **kwargs: write_cube(kwargs))
+    for program in NOOP_PROGRAMS:
+        setattr(module, program, lambda *args, **kwargs: completed())
+
+    module.cam2cam = cam2cam
+    module.reduce = reduce
+    module.translate = translate
+    module.campt = campt
+    module.camstats = camstats
+    module.getkey = getkey
+    module.getkey_k = getkey_k
+    module.getsn = getsn
+    module.coreg = coreg
+    module.pointreg = pointreg
+    module.autoseed = autoseed
+    module.cnetref = cnetref
+    module.cnetpvl2bin = cnetpvl2bin
+    module.cnetbin2pvl = cnetbin2pvl
+    return module
+
+
+def install():
+    """ Replace 'kalasiris' before the tool modules are imported """
+    sys.modules['kalasiris'] = build_module()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the Python side of the tool. ISIS is replaced by 'fake_kalasiris', so they run
+on machines without ISIS. Results are written to a json file, and compared to a baseline one if passed
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import pathlib
+import platform
+import tempfile
+import contextlib
+
+import click
+import numpy as np
+import pandas as pd
+
+BENCHMARKS_DIR = pathlib.Path(__file__).resolve().parent
+REPO_DIR = BENCHMARKS_DIR.parent
+sys.path[:0] = [str(BENCHMARKS_DIR), str(REPO_DIR)]
+
+import fake_kalasiris
+import synthetic
+
+# the tool modules import 'kalasiris' on load
+fake_kalasiris.install()
+import cli
+import pvl
+import ncc
+import cube
+import downscale
+import zscore
+import helper as h
+
+DEFAULT_SIZES = '1000,10000,100000'
+# chips (pattern, search) of the coreg config of in-process co-registration benchmarks
+NCC_CHIPS = (20, 50)
+# scale of the end-to-end benchmark with in-process engines (the reduced synthetic cubes fit the search chips)
+NCC_CLI_SCALE = 5
+
+
+def timed(func, setup=None, repeat=3):
+    """ Best wall time of 'func' in seconds. 'setup' is called (not timed) before every run """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with open(os.devnull, 'wt') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_cli(work_dir, n_images, n_points, num_proc, engine, repeat):
+    """
+    End-to-end orchestration: LO & LROC images preprocessing and advanced co-registration of every pair.
+    With 'numpy' engine cubes are reduced and co-registered in-process (synthetic coreg config and scale)
+    """
+    lo_dir, lro_dir, output_dir = work_dir / 'lo', work_dir / 'lro', work_dir / 'output'
+    for folder, prefix in [(lo_dir, 'lo'), (lro_dir, 'lroc')]:
+        folder.mkdir()
+        for i in range(n_images):
+            (folder / f'{prefix}_{i}.img').write_text('')
+
+    fake_kalasiris.settings['coreg_points'] = n_points
+    args = ['--lo', str(lo_dir), '--lro', str(lro_dir), '--output_folder', str(output_dir),
+            '--num_proc', str(num_proc), '--advanced']
+    if engine == 'numpy':
+        coreg_config = work_dir / 'coreg.ncc.def'
+        synthetic.write_coreg_config(coreg_config, *NCC_CHIPS)
+        args += ['--engine', 'numpy', '--preprocess_engine', 'numpy', '--coreg_config', str(coreg_config),
+                 '--scale', str(NCC_CLI_SCALE)]
+    seconds = timed(lambda: cli.cli.main(args, standalone_mode=False),
+                    setup=lambda: shutil.rmtree(output_dir, ignore_errors=True), repeat=repeat)
+    df_summary = pd.read_csv(output_dir / h.ADV_COREG_SUMMARY)
+    if not (df_summary['status'] == 'ok').all():
+        raise ValueError(f'Not all pairs are co-registered by {engine} engine: {output_dir / h.ADV_COREG_SUMMARY}')
+    return {'name': 'cli_advanced' if engine == 'isis' else f'cli_advanced_{engine}', 'size': n_images ** 2,
+            'unit': 'pairs', 'seconds': seconds}
+
+
+def bench_ncc(work_dir, n_points, repeat):
+    """ In-process co-registration (ncc.coreg) of a grid of 'n_points' points of shifted synthetic cubes """
+    side = int(np.ceil(np.sqrt(n_points)))
+    pattern, search = NCC_CHIPS
+    shift = (6, -3)
+    from_cub, match_cub, deffile = work_dir / 'from.cub', work_dir / 'match.cub', work_dir / 'coreg.def'
+    synthetic.write_cube(from_cub, shift=shift, size=(side * search, side * search))
+    synthetic.write_cube(match_cub, size=(side * search, side * search))
+    synthetic.write_coreg_config(deffile, pattern, search)
+    onet, flatfile = work_dir / 'coreg.net', work_dir / 'coreg.flat.csv'
+
+    seconds = timed(lambda: ncc.coreg(from_cub, match_cub, deffile, onet, flatfile, rows=side, columns=side),
+                    repeat=repeat)
+    # registered points must recover the shift
+    df = pd.read_csv(flatfile)
+    recovered = df[['LineDifference', 'SampleDifference']].median().to_numpy()
+    if not np.allclose(np.abs(recovered), np.abs(shift), atol=0.5):
+        raise ValueError(f'ncc.coreg recovered shift {recovered} instead of {shift}')
+    return {'name': 'ncc_coreg', 'size': side * side, 'unit': 'points', 'seconds': seconds}
+
+
+def bench_reduce(work_dir, size, repeat):
+    """
+    In-process reduce (downscale.reduce_cube) of a 'size' x 'size' synthetic Tile cube with a few hot pixels,
+    with and without histogram equalization, compared to the block mean of the whole band read into memory.
+    Equalization (downscale.equalize) of the reduced cube is compared to the stretch by exact percentiles
+    """
+    scale = h.scale
+    source, reduced, equalized = work_dir / 'source.cub', work_dir / 'reduced.cub', work_dir / 'equalized.cub'
+    values = synthetic.scene_view(size, size).copy()
+    values[size // 3::size // 3, size // 3::size // 3] = 1e6
+    cube.write_band(source, values, groups=synthetic.CUBE_GROUPS)
+
+    def reference():
+        return synthetic.block_mean(cube.read_band(source), scale, scale)
+
+    def equalize():
+        shutil.copy(reduced, equalized)
+        cub = cube.Cube(equalized, mode='r+')
+        downscale.equalize(cub, downscale.cube_histogram(cub))
+        cub.flush()
+
+    results = [{
+        'name': 'downscale_reduce_cube', 'size': size * size, 'unit': 'pixels',
+        'seconds': timed(lambda: downscale.reduce_cube(source, reduced, scale), repeat=repeat),
+    }]
+    # reduced cube must match the reference (the cube size is a multiple of scale, so there are no partial blocks)
+    expected = reference()
+    if not np.allclose(cube.read_band(reduced)[:expected.shape[0], :expected.shape[1]], expected, atol=1e-3):
+        raise ValueError('downscale.reduce_cube result differs from the reference block mean')
+
+    results.append({
+        'name': 'downscale_equalize', 'size': expected.size, 'unit': 'pixels',
+        'seconds': timed(equalize, repeat=repeat),
+    })
+    # hot pixels are out of the stretch percents, they don't compress the stretch of other pixels
+    expected = synthetic.percentile_stretch(cube.read_band(reduced), h.HISTEQ_PERCENTS)
+    if not np.allclose(cube.read_band(equalized), expected, atol=1e-3 * (np.nanmax(expected) - np.nanmin(expected))):
+        raise ValueError('downscale.equalize result differs from the reference percentile stretch')
+
+    return results + [{
+        'name': 'downscale_reduce_cube_histeq', 'size': size * size, 'unit': 'pixels',
+        'seconds': timed(lambda: downscale.reduce_cube(source, reduced, scale, histeq=True), repeat=repeat),
+    }, {
+        'name': 'numpy_block_mean', 'size': size * size, 'unit': 'pixels',
+        'seconds': timed(reference, repeat=repeat),
+    }]
+
+
+def bench_control_network(work_dir, n_measures, repeat):
+    """ Parsing, translation and filtering of coreg control network with 'n_measures' measures (2 per point) """
+    n_points = n_measures // 2
+    interim_pvl = work_dir / 'interim.pvl'
+    stats_path = work_dir / 'interim.stats.txt'
+    old_cub, lroc_cub = work_dir / 'old.cub', work_dir / 'lroc.cub'
+    # measures are translated through the co-registered cubes, found by serial numbers of the network
+    for cub in [old_cub, lroc_cub, work_dir / 'from.cub', work_dir / 'match.cub']:
+        synthetic.write_cube(cub)
+    synthetic.write_control_network(interim_pvl, n_points, from_sn='from.cub', match_sn='match.cub')
+    synthetic.write_coreg_stats(stats_path, n_points)
+    interim_net = work_dir / 'interim.net'
+    cn = pvl.read_control_network(interim_pvl)
+    cn.to_bin(interim_net)
+
+    results = [{
+        'name': 'pvl_read_control_network', 'size': n_measures, 'unit': 'measures',
+        'seconds': timed(lambda: pvl.read_control_network(interim_pvl), repeat=repeat),
+    }, {
+        'name': 'cnetbin_read', 'size': n_measures, 'unit': 'measures',
+        'seconds': timed(lambda: pvl.read_control_network(interim_net), repeat=repeat),
+    }, {
+        'name': 'cnetbin_write', 'size': n_measures, 'unit': 'measures',
+        'seconds': timed(lambda: cn.to_bin(work_dir / 'written.net'), repeat=repeat),
+    }, {
+        'name': 'pvl_translate_coreg_res', 'size': n_measures, 'unit': 'measures',
+        'seconds': timed(lambda: pvl.translate_coreg_res(interim_pvl, old_cub, lroc_cub, work_dir, 'final'),
+                         repeat=repeat),
+    }, {
+        'name': 'pvl_filter_coreg_result', 'size': n_measures, 'unit': 'measures',
+        'seconds': timed(lambda: pvl.filter_coreg_result(interim_pvl, pvl.CoregStats.read(stats_path),
+                                                         work_dir / 'filtered.pvl'), repeat=repeat),
+    }]
+    return results
+
+
+def bench_outliers(work_dir, n_rows, repeat):
+    """ Outliers detection on coreg stats with 'n_rows' points """
+    stats_path = work_dir / 'outliers.stats.txt'
+    synthetic.write_coreg_stats(stats_path, n_rows)
+    df_points = synthetic.coreg_points(n_rows)
+    x = df_points['SampleDifference'].to_numpy()
+    xy, dxy = df_points[['Sample', 'Line']].to_numpy(), df_points[['SampleDifference', 'LineDifference']].to_numpy()
+
+    return [{
+        'name': 'zscore_modified_zscore', 'size': n_rows, 'unit': 'points',
+        'seconds': timed(lambda: zscore.modified_zscore(x), repeat=repeat),
+    }] + [{
+        'name': f'zscore_outliers_{model}', 'size': n_rows, 'unit': 'points',
+        'seconds': timed(lambda: zscore.outliers(xy, dxy, model), repeat=repeat),
+    } for model in zscore.OUTLIER_MODELS] + [{
+        'name': 'pvl_coreg_stats_read', 'size': n_rows, 'unit': 'points',
+        'seconds': timed(lambda: pvl.CoregStats.read(stats_path), repeat=repeat),
+    }, {
+        'name': 'pvl_filter_points', 'size': n_rows, 'unit': 'points',
+        'seconds': timed(lambda: pvl.filter_points(pvl.CoregStats.read(stats_path)), repeat=repeat),
+    }]
+
+
+def bench_goodness_of_fit(work_dir, n_rows, repeat):
+    """ Co-registration statistics on stats files with 'n_rows' rows """
+    pointreg_stats = work_dir / 'pointreg.stats.csv'
+    coreg_stats = work_dir / 'coreg.stats.txt'
+    synthetic.write_coreg_stats(coreg_stats, n_rows)
+
+    return [{
+        # basic stats rewrite the stats file, so it's generated for every run
+        'name': 'goodness_of_fit_basic_coreg', 'size': n_rows, 'unit': 'rows',
+        'seconds': timed(lambda: h.goodness_of_fit_basic_coreg(str(pointreg_stats)),
+                         setup=lambda: synthetic.write_pointreg_stats(pointreg_stats, n_rows), repeat=repeat),
+    }, {
+        'name': 'goodness_of_fit_adv_coreg', 'size': n_rows, 'unit': 'rows',
+        'seconds': timed(lambda: h.goodness_of_fit_adv_coreg(pvl.CoregStats.read(coreg_stats), None, h.scale),
+                         repeat=repeat),
+    }]
+
+
+def compare(results, baseline_path, tolerance):
+    """ Benchmarks slower than baseline ones by more than 'tolerance' fraction """
+    baseline = {(r['name'], r['size']): r['seconds'] for r in json.loads(pathlib.Path(baseline_path).read_text())['results']}
+    regressions = []
+    for r in results:
+        base_seconds = baseline.get((r['name'], r['size']))
+        if base_seconds is None:
+            continue
+        r['baseline_seconds'] = base_seconds
+        if r['seconds'] > base_seconds * (1 + tolerance):
+            regressions.append(r)
+    return regressions
+
+
+@click.command()
+@click.option('--sizes', default=DEFAULT_SIZES, help='Comma separated numbers of control network measures / stats rows')
+@click.option('--repeat', type=int, default=3, help='Number of runs of every benchmark, the best time is reported')
+@click.option('--cli_images', type=int, default=2, help='Number of LO and LROC images in end-to-end benchmark (0 skips it)')
+@click.option('--cli_points', type=int, default=1000, help='Number of control points registered per pair in end-to-end benchmark')
+@click.option('--num_proc', type=int, default=1, help='Number of processes in end-to-end benchmark')
+@click.option('--ncc_points', type=int, default=400, help='Number of points registered by in-process co-registration benchmark (0 skips it)')
+@click.option('--reduce_size', type=int, default=4000, help='Lines and samples of the cube of in-process reduce benchmark (0 skips it)')
+@click.option('--output', default='benchmarks.json', help='Path to the results json file')
+@click.option('--baseline', default=None, required=False, help='Path to the baseline results json file')
+@click.option('--tolerance', type=float, default=0.25, help='Allowed slowdown fraction compared to the baseline')
+def main(sizes, repeat, cli_images, cli_points, num_proc, ncc_points, reduce_size, output, baseline, tolerance):
+    """ Run benchmarks """
+    sizes = [int(s) for s in sizes.split(',') if s]
+    output = pathlib.Path(output).resolve()
+    results = []
+
+    # the tool uses paths relative to the repository (configs, state vectors)
+    os.chdir(REPO_DIR)
+
+    def run(bench, *args):
+        with tempfile.TemporaryDirectory(prefix='lmct-bench-') as work_dir:
+            res = bench(pathlib.Path(work_dir), *args, repeat)
+        for r in res if isinstance(res, list) else [res]:
+            r['throughput'] = r['size'] / r['seconds'] if r['seconds'] else None
+            print(f'[INFO] {r["name"]} ({r["size"]:,} {r["unit"]}): {r["seconds"]:.3f} secs')
+            results.append(r)
+
+    if cli_images:
+        run(bench_cli, cli_images, cli_points, num_proc, 'isis')
+        run(bench_cli, cli_images, cli_points, num_proc, 'numpy')
+    if ncc_points:
+        run(bench_ncc, ncc_points)
+    if reduce_size:
+        run(bench_reduce, reduce_size)
+    for size in sizes:
+        run(bench_control_network, size)
+        run(bench_outliers, size)
+        run(bench_goodness_of_fit, size)
+
+    regressions = compare(results, baseline, tolerance) if baseline else []
+
+    output.write_text(json.dumps({
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'repeat': repeat,
+        'results': results,
+    }, indent=2))
+    print(f'[INFO] Benchmark results: {output}')
+
+    for r in regressions:
+        print(f'[ERROR] Regression: {r["name"]} ({r["size"]:,} {r["unit"]}): '
+              f'{r["seconds"]:.3f} secs, baseline {r["baseline_seconds"]:.3f} secs')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
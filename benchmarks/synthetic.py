@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Synthetic cubes, co-registration flatfiles and control networks for benchmarks
+"""
+import pathlib
+import functools
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+import cube
+
+# synthetic cubes are views of one textured scene, so co-registration can find the shift between them.
+# Lines and samples of cubes written by ISIS programs (the image <-> ground mapping below covers them)
+CUBE_SIZE = (1000, 1000)
+CUBE_GROUPS = {'Instrument': {'InstrumentId': 'FAKE', 'TargetName': 'Moon'}, 'Kernels': {'NaifFrameCode': 0}}
+# largest shift of a view of the scene
+SCENE_MARGIN = 64
+
+COREG_CONFIG = '''Object = AutoRegistration
+  Group = Algorithm
+    Name      = MaximumCorrelation
+    Tolerance = 0.6
+  EndGroup
+  Group = PatternChip
+    Samples = {pattern}
+    Lines   = {pattern}
+  EndGroup
+  Group = SearchChip
+    Samples = {search}
+    Lines   = {search}
+  EndGroup
+EndObject
+'''
+
+
+# simple invertible image <-> ground mapping shared by all synthetic cubes
+def line_to_lat(line):
+    return 10. + np.asarray(line) * 1e-4
+
+
+def sample_to_lon(sample):
+    return 20. + np.asarray(sample) * 1e-4
+
+
+def lat_to_line(lat):
+    return (np.asarray(lat) - 10.) * 1e4
+
+
+def lon_to_sample(lon):
+    return (np.asarray(lon) - 20.) * 1e4
+
+
+@functools.lru_cache(maxsize=4)
+def scene(lines, samples, seed=0) -> np.ndarray:
+    """ Smooth random texture, DNs are about 500 +- 100 """
+    rng = np.random.default_rng(seed)
+    values = ndimage.gaussian_filter(rng.normal(size=(lines, samples)), 2.)
+    return 500. + 100. * values / values.std()
+
+
+def scene_view(lines, samples, shift=(0, 0)) -> np.ndarray:
+    """ 'lines' x 'samples' part of the scene displaced by 'shift' (lines, samples) whole pixels """
+    values = scene(lines + 2 * SCENE_MARGIN, samples + 2 * SCENE_MARGIN)
+    line, sample = SCENE_MARGIN + shift[0], SCENE_MARGIN + shift[1]
+    return values[line:line + lines, sample:sample + samples]
+
+
+def write_cube(path, shift=(0, 0), size=CUBE_SIZE):
+    """ Real pixel cube of the scene (see scene_view), readable by ISIS and 'cube' module """
+    if path:
+        cube.write_band(path, scene_view(*size, shift), groups=CUBE_GROUPS)
+
+
+def block_mean(values, line_scale, sample_scale) -> np.ndarray:
+    """ Means of 'line_scale' x 'sample_scale' blocks of values (partial blocks are dropped) """
+    lines, samples = values.shape[0] // line_scale, values.shape[1] // sample_scale
+    blocks = values[:lines * line_scale, :samples * sample_scale].reshape(lines, line_scale, samples, sample_scale)
+    return blocks.mean(axis=(1, 3))
+
+
+def percentile_stretch(values, percents) -> np.ndarray:
+    """ Reference histeq stretch: value at every 'increment' percent (exact percentiles) to evenly spaced values """
+    min_percent, max_percent, increment = percents
+    steps = np.arange(min_percent, max_percent + increment / 2, increment)
+    inputs = np.nanpercentile(values, steps)
+    outputs = inputs[0] + (inputs[-1] - inputs[0]) * (steps - min_percent) / (max_percent - min_percent)
+    return np.interp(values, inputs, outputs)
+
+
+def write_coreg_config(path, pattern=20, search=50):
+    """ coreg definition file of MaximumCorrelation with square chips """
+    pathlib.Path(path).write_text(COREG_CONFIG.format(pattern=pattern, search=search))
+
+
+def coreg_points(n_points, outliers_fraction=0.02, seed=0):
+    """ Co-registration results: registered points with small residuals and some outliers """
+    rng = np.random.default_rng(seed)
+    sample = np.round(rng.uniform(1, 5000, n_points), 2)
+    line = np.round(rng.uniform(1, 5000, n_points), 2)
+    sample_diff = np.round(rng.normal(0.5, 0.2, n_points), 4)
+    line_diff = np.round(rng.normal(-0.3, 0.2, n_points), 4)
+
+    outliers = rng.random(n_points) < outliers_fraction
+    sample_diff[outliers] += np.round(rng.choice([-1, 1], outliers.sum()) * rng.uniform(5, 20, outliers.sum()), 4)
+
+    return pd.DataFrame({
+        'Sample': sample,
+        'Line': line,
+        'TranslatedSample': np.round(sample + sample_diff, 4),
+        'TranslatedLine': np.round(line + line_diff, 4),
+        'SampleDifference': sample_diff,
+        'LineDifference': line_diff,
+        'GoodnessOfFit': np.round(rng.uniform(0.6, 1.0, n_points), 4),
+    })
+
+
+def write_coreg_stats(path, n_points):
+    """ coreg flatfile """
+    coreg_points(n_points).to_csv(path, index=False)
+
+
+def control_network_pvl(n_points, from_sn='from.cub', match_sn='match.cub'):
+    """ Control network (pvl) matching 'coreg_points' """
+    df = coreg_points(n_points)
+    head = ('Object = ControlNetwork\n  NetworkId    = Coreg\n  TargetName   = Moon\n  UserName     = bench\n'
+            '  Created      = 2021-01-01T00:00:00\n  LastModified = 2021-01-01T00:00:00\n'
+            '  Description  = "synthetic network for benchm-\n                 arks"\n  Version      = 5\n')
+    points = [
+        f'''
+  Object = ControlPoint
+    PointType   = Free
+    PointId     = Coreg_{i}
+    ChooserName = coreg
+    DateTime    = 2021-01-01T00:00:00
+
+    Group = ControlMeasure
+      SerialNumber = {match_sn}
+      MeasureType  = Candidate
+      ChooserName  = coreg
+      DateTime     = 2021-01-01T00:00:00
+      Sample       = {s}
+      Line         = {l}
+      Reference    = True
+    End_Group
+
+    Group = ControlMeasure
+      SerialNumber   = {from_sn}
+      MeasureType    = RegisteredSubPixel
+      ChooserName    = coreg
+      DateTime       = 2021-01-01T00:00:00
+      Sample         = {ts}
+      Line           = {tl}
+      SampleResidual = {sd} <pixels>
+      LineResidual   = {ld} <pixels>
+      GoodnessOfFit  = {gof}
+    End_Group
+  End_Object
+'''
+        for i, (s, l, ts, tl, sd, ld, gof) in enumerate(df.itertuples(index=False))
+    ]
+    return head + ''.join(points) + 'End_Object\nEnd\n'
+
+
+def control_network_keywords(n_points, from_sn='from.cub', match_sn='match.cub'):
+    """ Control network matching 'coreg_points' as pvl keywords: header and (point, measures) pairs """
+    df = coreg_points(n_points)
+    header = [('NetworkId', 'Coreg'), ('TargetName', 'Moon'), ('UserName', 'bench'),
+              ('Created', '2021-01-01T00:00:00'), ('LastModified', '2021-01-01T00:00:00'),
+              ('Description', '"synthetic network for benchmarks"'), ('Version', '5')]
+    points = [
+        ([('PointType', 'Free'), ('PointId', f'Coreg_{i}'), ('ChooserName', 'coreg'),
+          ('DateTime', '2021-01-01T00:00:00')],
+         [[('SerialNumber', match_sn), ('MeasureType', 'Candidate'), ('ChooserName', 'coreg'),
+           ('DateTime', '2021-01-01T00:00:00'), ('Sample', str(s)), ('Line', str(l)), ('Reference', 'True')],
+          [('SerialNumber', from_sn), ('MeasureType', 'RegisteredSubPixel'), ('ChooserName', 'coreg'),
+           ('DateTime', '2021-01-01T00:00:00'), ('Sample', str(ts)), ('Line', str(tl)),
+           ('SampleResidual', f'{sd} <pixels>'), ('LineResidual', f'{ld} <pixels>'), ('GoodnessOfFit', str(gof))]])
+        for i, (s, l, ts, tl, sd, ld, gof) in enumerate(df.itertuples(index=False))
+    ]
+    return header, points
+
+
+def write_control_network(path, n_points, from_sn='from.cub', match_sn='match.cub'):
+    pathlib.Path(path).write_text(control_network_pvl(n_points, from_sn, match_sn))
+
+
+def write_pointreg_stats(path, n_rows, seed=0):
+    """ pointreg flatfile (the second line contains units and is skipped by the tool) """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'PointId': [f'P{i // 2:07d}' for i in range(n_rows)],
+        'Filename': np.where(np.arange(n_rows) % 2, 'lroc.cub', 'old.cub'),
+        'MeasureType': np.where(np.arange(n_rows) % 2, 'RegisteredSubPixel', 'Candidate'),
+        'SampleShift': np.round(rng.normal(0, 1, n_rows), 4),
+        'LineShift': np.round(rng.normal(0, 1, n_rows), 4),
+        'GoodnessOfFit': np.where(rng.random(n_rows) < 0.05, np.nan, np.round(rng.uniform(0, 1, n_rows), 4)),
+    })
+    with open(path, 'wt') as f:
+        f.write(','.join(df.columns) + '\n')
+        f.write(','.join(['', '', '', 'pixels', 'pixels', '']) + '\n')
+        df.to_csv(f, index=False, header=False, na_rep='')
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import shutil
+import hashlib
+import pathlib
+import functools
+from typing import Union
+
+import helper as h
+
+# bump it when preprocessing chains change, so stale cached cubes are not reused
+CACHE_VERSION = 1
+
+# preprocessing functions returning resolved pathlib.Path (others return 'output_folder/name' string)
+RESOLVED_RESULT_FUNCS = ['apollo_pan_img_preprocess']
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    """ Content hash of the file """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_fingerprint(image):
+    """
+    Content hash of the input image.
+    Files sharing the image stem (like label and data files) are hashed as well
+    """
+    image = pathlib.Path(image)
+    digest = hashlib.blake2b(digest_size=20)
+    for path in sorted(image.parent.iterdir()):
+        if path.name.startswith(f'{image.stem}.') and path.is_file():
+            digest.update(path.name.encode())
+            digest.update(file_digest(path).encode())
+    return digest.hexdigest()
+
+
+class PreprocessCache:
+    """
+    Content-addressed cache of preprocessed cubes shared between runs.
+    Every entry is a folder named by the cache key, containing the cube and 'meta.json'.
+    Entry modification time is the last access time used for LRU eviction
+    """
+
+    def __init__(self, cache_dir, max_size_gb=h.PREPROCESS_CACHE_SIZE):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_size = int(max_size_gb * 2 ** 30)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(image, **params):
+        """ Cache key for the image preprocessed with specific parameters """
+        key_dict = {
+            'version': CACHE_VERSION,
+            'image': image_fingerprint(image),
+            'isis': [h.isis_sinc, h.isis_linc, h.isis_sinc_foot, h.isis_linc_foot],
+            **params
+        }
+        return hashlib.blake2b(json.dumps(key_dict, sort_keys=True, default=str).encode(), digest_size=20).hexdigest()
+
+    def get(self, key, output_folder) -> Union[pathlib.Path, None]:
+        """ Hardlink (or copy) cached cube to the output folder. Returns None in case of cache miss """
+        entry = self.cache_dir / key
+        meta_path = entry / 'meta.json'
+        if not meta_path.exists():
+            return None
+
+        with open(meta_path, 'rt') as f:
+            meta = json.load(f)
+
+        output_cube = pathlib.Path(output_folder) / meta['name']
+        try:
+            link_or_copy(entry / meta['name'], output_cube)
+        except FileNotFoundError:
+            # evicted by a concurrent run
+            return None
+
+        os.utime(entry)
+        return output_cube
+
+    def put(self, key, cube):
+        """ Store the cube in the cache """
+        cube = pathlib.Path(cube)
+        entry = self.cache_dir / key
+        if entry.exists():
+            return
+
+        # fill a temporary folder first, so a partially written entry is never visible
+        temp_entry = self.cache_dir / f'{key}.tmp-{os.getpid()}'
+        shutil.rmtree(temp_entry, ignore_errors=True)
+        temp_entry.mkdir()
+        link_or_copy(cube, temp_entry / cube.name)
+        with open(temp_entry / 'meta.json', 'wt') as f:
+            json.dump({'name': cube.name, 'created': time.time()}, f)
+
+        try:
+            temp_entry.rename(entry)
+        except OSError:
+            # stored by a concurrent worker
+            shutil.rmtree(temp_entry, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits into the size limit """
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            if entry.is_dir() and '.tmp-' not in entry.name:
+                size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+                entries.append((entry.stat().st_mtime, size, entry))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+
+def link_or_copy(src, dst):
+    """ Hardlink 'src' to 'dst', copy it if hardlinking is not possible (e.g. different file systems) """
+    dst = pathlib.Path(dst)
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError as ex:
+        if not pathlib.Path(src).exists():
+            raise FileNotFoundError(src) from ex
+        shutil.copy2(src, dst)
+
+
+def cached_preprocess(preprocess_func):
+    """
+    Wrap '*_img_preprocess' function with the preprocessing cache.
+    The wrapped function accepts additional 'cache_dir' and 'cache_size' (GB) keyword arguments,
+    the cache is disabled if 'cache_dir' is not set. Location of intermediate cubes ('scratch_folder')
+    is not a part of the cache key
+    """
+    @functools.wraps(preprocess_func)
+    def wrapper(image, output_folder, coreg_type, *args, cache_dir=None, cache_size=h.PREPROCESS_CACHE_SIZE,
+                scratch_folder=None, **kwargs):
+        if not cache_dir:
+            return preprocess_func(image, output_folder, coreg_type, *args, scratch_folder=scratch_folder, **kwargs)
+
+        cache = PreprocessCache(cache_dir, cache_size)
+        key = cache.key(image, func=preprocess_func.__name__, coreg_type=coreg_type, args=args, **kwargs)
+
+        cached_cube = cache.get(key, output_folder)
+        if not cached_cube:
+            res = preprocess_func(image, output_folder, coreg_type, *args, scratch_folder=scratch_folder, **kwargs)
+            cache.put(key, res)
+            return res
+
+        print(f'--> [INFO] Preprocessed image found in cache: {image}')
+        # keep the same result type as the preprocessing function
+        if preprocess_func.__name__ in RESOLVED_RESULT_FUNCS:
+            return cached_cube.resolve()
+        return os.path.join(output_folder, cached_cube.name)
+
+    return wrapper
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import math
+import pathlib
+import threading
+from typing import List, Dict, Any, Tuple, Union
+
+import pandas as pd
+
+import helper as h
+
+# per-image stats of basic co-registration (see helper.goodness_of_fit_basic_coreg)
+BASIC_IMAGES_STATS_SUFFIX = '.stats.csv.images.csv'
+
+# numeric fields of result records, they can be filtered by range ('min_<field>', 'max_<field>')
+NUMERIC_FIELDS = ['scale', 'configs_tried', 'points', 'filtered', 'gof_mean', 'uncertainty_samples',
+                  'uncertainty_lines', 'seconds', 'measures', 'gof_count', 'below_threshold', 'ql_of_uncertainty']
+# text fields of result records, they are filtered by substring
+TEXT_FIELDS = ['folder', 'kind', 'old_cub', 'lroc_cub', 'coreg_config', 'status', 'image']
+
+
+def scan_folder(path: pathlib.Path) -> Tuple[List[str], Dict[str, Tuple[int, int]]]:
+    """ Names of files in the folder and (mtime, size) of the files results are read from """
+    names, tracked = [], {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            names.append(entry.name)
+            if entry.name == h.ADV_COREG_SUMMARY or entry.name.endswith(BASIC_IMAGES_STATS_SUFFIX):
+                stat = entry.stat()
+                tracked[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return sorted(names), tracked
+
+
+def tracked_unchanged(path: pathlib.Path, tracked: Dict[str, Tuple[int, int]]) -> bool:
+    """ Results files were not modified (they are rewritten in place, so folder mtime does not change) """
+    try:
+        for name, key in tracked.items():
+            stat = (path / name).stat()
+            if (stat.st_mtime_ns, stat.st_size) != tuple(key):
+                return False
+    except OSError:
+        return False
+    return True
+
+
+def clean_value(value):
+    """ JSON friendly value of a table cell: NaN -> None, numpy scalars -> Python ones """
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def adv_coreg_records(folder: pathlib.Path, names: List[str]) -> List[Dict[str, Any]]:
+    """ Per-pair records of advanced co-registration summary with the pair artifacts """
+    df_summary = pd.read_csv(folder / h.ADV_COREG_SUMMARY)
+    records = []
+    for row in df_summary.to_dict('records'):
+        record = {'folder': folder.name, 'kind': 'advanced'}
+        record.update((key, clean_value(value)) for key, value in row.items())
+        # artifacts are named '<coreg config>-<old cube>-<lroc cube>...'
+        marker = f'-{pathlib.Path(str(row["old_cub"])).stem}-{pathlib.Path(str(row["lroc_cub"])).stem}.'
+        record['artifacts'] = [str(folder / name) for name in names if marker in name]
+        records.append(record)
+    return records
+
+
+def basic_coreg_records(folder: pathlib.Path, names: List[str]) -> List[Dict[str, Any]]:
+    """ Per-image records of basic co-registration stats """
+    records = []
+    for images_name in names:
+        if not images_name.endswith(BASIC_IMAGES_STATS_SUFFIX):
+            continue
+        stats_name = images_name[:-len('.images.csv')]
+        prefix = stats_name[:-len(f'_{pathlib.Path(h.pointreg_template).stem}.stats.csv')]
+        # artifacts are named '<prefix>_...' (see mission.basic_coregistration)
+        artifacts = [str(folder / name) for name in names if name.startswith(f'{prefix}_')]
+        for row in pd.read_csv(folder / images_name).to_dict('records'):
+            record = {'folder': folder.name, 'kind': 'basic', 'image': row.pop('Filename')}
+            record.update((key, clean_value(value)) for key, value in row.items())
+            record['artifacts'] = artifacts
+            records.append(record)
+    return records
+
+
+def folder_entry(folder: pathlib.Path) -> Dict[str, Any]:
+    """ Catalog entry of the output folder: its mtime, files and result records """
+    mtime_ns = folder.stat().st_mtime_ns
+    names, tracked = scan_folder(folder)
+    records = []
+    try:
+        if h.ADV_COREG_SUMMARY in tracked:
+            records += adv_coreg_records(folder, names)
+        records += basic_coreg_records(folder, names)
+        error = None
+    except (OSError, ValueError, KeyError, pd.errors.ParserError) as ex:
+        # e.g. results file being written, it's read again when modified
+        error = str(ex)
+    return {'mtime_ns': mtime_ns, 'tracked': tracked, 'names': names, 'records': records, 'error': error}
+
+
+class Catalog:
+    """
+    Catalog of input folders and co-registration results, maintained incrementally: an output folder
+    is read again only if its mtime or mtime of its results files changed. The catalog is refreshed
+    at most every 'refresh_seconds' and persisted to 'index_path' (if passed), so a restarted server
+    does not read all results again
+    """
+
+    def __init__(self, input_roots: Dict[str, Union[str, pathlib.Path]], output_root, index_path=None,
+                 refresh_seconds=5.):
+        self.input_roots = {key: pathlib.Path(root) for key, root in input_roots.items()}
+        self.output_root = pathlib.Path(output_root)
+        self.index_path = pathlib.Path(index_path) if index_path else None
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        self.refreshed = 0.
+        # {root path: (mtime_ns, sorted subfolders)}
+        self.listings: Dict[str, Tuple[int, List[str]]] = {}
+        # {output folder name: folder_entry}
+        self.folders: Dict[str, Dict[str, Any]] = {}
+        self.records: List[Dict[str, Any]] = []
+        self.load()
+
+    def load(self):
+        if not self.index_path:
+            return
+        try:
+            index = json.loads(self.index_path.read_text())
+        except (OSError, json.JSONDecodeError):
+            return
+        self.listings = {root: (mtime_ns, folders) for root, (mtime_ns, folders) in index['listings'].items()}
+        self.folders = index['folders']
+        self.records = [record for entry in self.folders.values() for record in entry['records']]
+
+    def save(self):
+        if not self.index_path:
+            return
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.index_path.with_name(f'{self.index_path.name}.tmp')
+        temp_path.write_text(json.dumps({'listings': self.listings, 'folders': self.folders}))
+        temp_path.replace(self.index_path)
+
+    def subfolders(self, root: pathlib.Path) -> List[str]:
+        """ Subfolders of the root, listed again only if the root mtime changed """
+        try:
+            mtime_ns = root.stat().st_mtime_ns
+        except OSError:
+            return []
+        listing = self.listings.get(str(root))
+        if listing is None or listing[0] != mtime_ns:
+            with os.scandir(root) as entries:
+                folders = sorted(entry.path for entry in entries if entry.is_dir())
+            listing = self.listings[str(root)] = (mtime_ns, folders)
+        return listing[1]
+
+    def refresh(self, force=False) -> bool:
+        """ Update the catalog with changed folders. Returns True if anything changed """
+        with self.lock:
+            if not force and time.time() - self.refreshed < self.refresh_seconds:
+                return False
+
+            listings = dict(self.listings)
+            for root in self.input_roots.values():
+                self.subfolders(root)
+
+            changed = False
+            folders = {}
+            for path in map(pathlib.Path, self.subfolders(self.output_root)):
+                entry = self.folders.get(path.name)
+                try:
+                    if entry is None or entry['mtime_ns'] != path.stat().st_mtime_ns or \
+                            not tracked_unchanged(path, entry['tracked']):
+                        entry = folder_entry(path)
+                        changed = True
+                except OSError:
+                    # the folder was deleted
+                    continue
+                folders[path.name] = entry
+            changed |= folders.keys() != self.folders.keys() or listings != self.listings
+
+            if changed:
+                self.folders = folders
+                self.records = [record for entry in folders.values() for record in entry['records']]
+                self.save()
+            self.refreshed = time.time()
+            return changed
+
+    def inputs(self) -> Dict[str, List[str]]:
+        """ Input folders by root name, and output folders ('outputs') """
+        self.refresh()
+        with self.lock:
+            res = {key: self.subfolders(root) for key, root in self.input_roots.items()}
+            res['outputs'] = self.subfolders(self.output_root)
+        return res
+
+    def outputs(self) -> List[Dict[str, Any]]:
+        """ Output folders with results overview """
+        self.refresh()
+        res = []
+        for name, entry in self.folders.items():
+            ok = [record for record in entry['records'] if record.get('status', 'ok') == 'ok']
+            gofs = [record['gof_mean'] for record in ok if record.get('gof_mean') is not None]
+            res.append({'folder': name, 'path': str(self.output_root / name), 'mtime': entry['mtime_ns'] / 1e9,
+                        'files': len(entry['names']), 'records': len(entry['records']), 'ok': len(ok),
+                        'gof_mean': sum(gofs) / len(gofs) if gofs else None, 'error': entry['error']})
+        return res
+
+    def files(self, folder) -> Union[List[str], None]:
+        """ Names of files in the output folder, None if there is no such folder """
+        self.refresh()
+        entry = self.folders.get(folder)
+        return entry['names'] if entry else None
+
+    def query(self, filters: Dict[str, str] = None, sort=None, descending=False) -> List[Dict[str, Any]]:
+        """
+        Result records matching all filters: substring of TEXT_FIELDS (case insensitive),
+        'min_<field>' / 'max_<field>' ranges of NUMERIC_FIELDS. Records are sorted by 'sort' field (if passed),
+        records without the field go last
+        """
+        self.refresh()
+        records = self.records
+        for key, value in (filters or {}).items():
+            if value in [None, '']:
+                continue
+            if key in TEXT_FIELDS:
+                value = str(value).lower()
+                records = [r for r in records if value in str(r.get(key) or '').lower()]
+            elif key[:4] in ['min_', 'max_'] and key[4:] in NUMERIC_FIELDS:
+                field, bound = key[4:], float(value)
+                if key.startswith('min_'):
+                    records = [r for r in records if r.get(field) is not None and r[field] >= bound]
+                else:
+                    records = [r for r in records if r.get(field) is not None and r[field] <= bound]
+            else:
+                raise ValueError(f'Unknown filter: {key}')
+
+        if sort:
+            if sort not in NUMERIC_FIELDS + TEXT_FIELDS:
+                raise ValueError(f'Unknown sort field: {sort}')
+            present = sorted((r for r in records if r.get(sort) is not None), key=lambda r: r[sort],
+                             reverse=descending)
+            records = present + [r for r in records if r.get(sort) is None]
+        return records
+
+
+def paginate(items: List, page=1, per_page=50) -> Dict[str, Any]:
+    """ Page of the items (pages are numbered from 1) """
+    page, per_page = max(int(page), 1), max(int(per_page), 1)
+    return {'total': len(items), 'page': page, 'per_page': per_page,
+            'pages': (len(items) + per_page - 1) // per_page,
+            'items': items[(page - 1) * per_page:page * per_page]}
@@ -2,7 +2,9 @@
 import click
 import time
 import os
-from multiprocessing import Pool
+import shutil
+import tempfile
+import pathlib
 from functools import partial
 #import pprint
 
@@ -10,6 +12,11 @@ import validation as v
 import helper as h
 import mission
 import pvl
+import autotune
+import zscore
+import scheduler
+import profiling
+import manifest
 
 @click.command()
 @click.option('--apollo', default=None, required=False, help='Path to the folder containing LBL files associated to Apollo images')
@@ -20,7 +27,7 @@ import pvl
 @click.option('--lo', default=None, required=False, help='Path to the folder containing LO image files')
 @click.option('--lro', default=None, required=False, help='Path to the folder containing LROC image files')
 @click.option('--output_folder', default='./output', required=False, help='Folder used to save co-registration resources')
-@click.option('--num_proc', type=int, default=1, help='Number of processes for parallel image preprocessing')
+@click.option('--num_proc', type=int, default=1, help='Number of processes for parallel image preprocessing and co-registration')
 @click.option('--basic', 'coreg_type', flag_value='basic')
 @click.option('--advanced', 'coreg_type', flag_value='advanced', default=True)
 @click.option('--coreg_config', default=h.coreg_config, required=False, help='Path to the co-registration config file (.def)')
@@ -28,11 +35,49 @@ import pvl
               help='Scale during advanced co-registration (have to match corresponding coreg_config)')
 @click.option('--filter_cn', type=int, default=1,
               help='Apply additional filtering of coreg resulting Control Network. Presumably improve coreg quality)')
-def cli(apollo, apollo_mission, apollo_camera, lo, lro, output_folder, num_proc, coreg_type, coreg_config, scale, filter_cn):
+@click.option('--pyramid', is_flag=True, default=False,
+              help='Coarse-to-fine advanced co-registration: --scale level seeds finer levels (x10, x5) searched in narrow chips')
+@click.option('--auto_tune', is_flag=True, default=False,
+              help='Try coreg configs for --scale from the --coreg_config folder, from the cheapest one, until the result passes thresholds')
+@click.option('--tune_gof', type=float, default=h.AUTO_TUNE_MIN_GOF, required=False,
+              help='Minimal goodness of fit accepted by --auto_tune')
+@click.option('--tune_points', type=int, default=h.AUTO_TUNE_MIN_POINTS, required=False,
+              help='Minimal number of (not filtered) points accepted by --auto_tune')
+@click.option('--tune_history', default=None, required=False,
+              help='File recording configs accepted by --auto_tune, shared by runs (default is auto_tune.json in the output folder)')
+@click.option('--outlier_model', type=click.Choice(zscore.OUTLIER_MODELS), default=h.OUTLIER_MODEL, required=False,
+              help='Model detecting outliers filtered from coreg resulting Control Network (with --filter_cn 1)')
+@click.option('--engine', type=click.Choice(h.COREG_ENGINES), default=h.COREG_ENGINE, required=False,
+              help='Advanced co-registration engine: ISIS coreg or in-process FFT normalized cross-correlation (numpy)')
+@click.option('--preprocess_engine', type=click.Choice(h.PREPROCESS_ENGINES), default=h.PREPROCESS_ENGINE, required=False,
+              help='Engine reducing and equalizing cubes: ISIS reduce / histeq or in-process streaming ones (numpy)')
+@click.option('--coreg_proc', type=int, default=None, required=False,
+              help='Maximum number of image pairs co-registered concurrently in advanced mode (default is --num_proc)')
+@click.option('--min_overlap', type=float, default=h.FOOTPRINT_MIN_OVERLAP, required=False,
+              help='Advanced co-registration skips pairs with footprints overlap fraction not above it (negative disables)')
+@click.option('--pan_ram_budget', type=float, default=h.PAN_RAM_BUDGET, required=False,
+              help='RAM budget in GB for parallel Apollo panoramic images preprocessing (default 80% of physical memory)')
+@click.option('--pan_disk_budget', type=float, default=h.PAN_DISK_BUDGET, required=False,
+              help='Disk budget in GB for parallel Apollo panoramic images preprocessing (default 90% of free space)')
+@click.option('--profile', is_flag=True, default=False,
+              help='Trace every ISIS call to profile.jsonl in the output folder and print the run profile')
+@click.option('--scratch_dir', default=None, required=False,
+              help='Folder on fast local storage (e.g. tmpfs) for intermediate cubes (default is the output folder)')
+@click.option('--resume', is_flag=True, default=False,
+              help='Resume the run in the output folder: stages completed with the same inputs are skipped')
+@click.option('--cache_dir', default=None, required=False,
+              help='Folder with preprocessed images cache shared between runs (cache is not used if not set)')
+@click.option('--cache_size', type=float, default=h.PREPROCESS_CACHE_SIZE, required=False,
+              help='Size limit of preprocessed images cache in GB (least recently used images are evicted)')
+def cli(apollo, apollo_mission, apollo_camera, lo, lro, output_folder, num_proc, coreg_type, coreg_config, scale, filter_cn,
+        pyramid, auto_tune, tune_gof, tune_points, tune_history, outlier_model, engine, preprocess_engine, coreg_proc, min_overlap, pan_ram_budget, pan_disk_budget, profile, scratch_dir, resume, cache_dir, cache_size):
     '''This is the entry point to the application'''
     args = locals()
     start = time.time()
     print('[INFO] NASA Lunar Co-Registration Tool Started: time {:.2f} secs '.format(time.time() - start))
+    scratch_folder = None
+    trace_path = None
+    previous_trace = None
     #print(f'h.coreg_config: {coreg_config}, h.scale: {scale}')
 
     try:
@@ -49,6 +94,10 @@ def cli(apollo, apollo_mission, apollo_camera, lo, lro, output_folder, num_proc,
             print('[INFO] Two missions must be specified between APOLLO15, LRO, LO')
             exit()
 
+        if pyramid and auto_tune:
+            print('[INFO] Options --pyramid and --auto_tune can not be combined')
+            exit()
+
         # validate input parameters
         if apollo:
             validation_code = v.validate_apollo(apollo, apollo_camera)
@@ -78,79 +127,154 @@ def cli(apollo, apollo_mission, apollo_camera, lo, lro, output_folder, num_proc,
         # create the output folder if it does not exists yet
         if not os.path.exists(output_folder):
             h.make_empty_folder(output_folder)
-        
-        # preprocessed cub files
-        #preprocessed_cubs = []
-        old_cubs = []
-        lroc_cubs = []
+
+        if profile:
+            trace_path = os.path.join(output_folder, h.PROFILE_TRACE)
+            previous_trace = profiling.enable(trace_path)
+
+        # intermediate cubes are written to a run folder in the scratch dir, only final products to the output folder
+        if scratch_dir:
+            pathlib.Path(scratch_dir).mkdir(parents=True, exist_ok=True)
+            scratch_folder = tempfile.mkdtemp(prefix='lmct-', dir=scratch_dir)
+
+        # completed stages of images and pairs are recorded in the run manifest, so the run can be resumed
+        manifest_path = manifest.start(output_folder, resume)
+
+        def checkpoint(key, func, sources=(), source_args=0, **params):
+            return manifest.Checkpoint(manifest_path, key, func, sources, source_args, **params)
+
+        # preprocessing and co-registration are run as a single tasks graph: each pair is co-registered
+        # as soon as both its images are preprocessed, all tasks share one pool of 'num_proc' workers
+        tasks = {}
+        old_images = []
+        lroc_images = []
+        preprocess_kwargs = dict(output_folder=output_folder, coreg_type=coreg_type, scratch_folder=scratch_folder,
+                                 cache_dir=cache_dir, cache_size=cache_size)
 
         # preprocess apollo
         if apollo:
-            print('[INFO] Apollo image preprocessing')  #: time {:.2f} secs '.format(time.time() - start))
-
             if apollo_camera == 'metric':
-                apollo_images = [os.path.join(apollo, f)
-                                 for f in os.listdir(apollo)
-                                 if os.path.splitext(f)[1] in h.apollo_metric_file_types]
-
-                with Pool(num_proc) as p:
-                    f = partial(mission.apollo_img_preprocess,
-                                output_folder=output_folder, coreg_type=coreg_type, mission=apollo_mission)
-                    res = list(p.imap_unordered(f, apollo_images))
-                old_cubs.extend(res)
+                old_images = [os.path.join(apollo, f)
+                              for f in os.listdir(apollo)
+                              if os.path.splitext(f)[1] in h.apollo_metric_file_types]
+                f = partial(mission.apollo_img_preprocess, mission=apollo_mission, preprocess_engine=preprocess_engine,
+                            **preprocess_kwargs)
+                tasks.update({('preprocess', image): scheduler.Task(checkpoint(
+                    ('preprocess', image), partial(f, image), [image], preprocess=f.func.__name__, coreg_type=coreg_type,
+                    mission=apollo_mission, preprocess_engine=preprocess_engine)) for image in old_images})
 
             elif apollo_camera == 'panoramic':
-                apollo_pan_images = [os.path.join(apollo, f)
-                                     for f in os.listdir(apollo)
-                                     if os.path.splitext(f)[1] in h.apollo_pan_file_types]
-                for apollo_image in apollo_pan_images:
-                    old_cubs.append(
-                        mission.apollo_pan_img_preprocess(os.path.join(apollo, apollo_image), output_folder,
-                                                          coreg_type=coreg_type, mission=apollo_mission))
+                old_images = [os.path.join(apollo, f)
+                              for f in os.listdir(apollo)
+                              if os.path.splitext(f)[1] in h.apollo_pan_file_types]
+
+                # panoramic cubes are huge - their preprocessing is limited by RAM and disk budgets
+                f = partial(mission.apollo_pan_img_preprocess, mission=apollo_mission,
+                            preprocess_engine=preprocess_engine, **preprocess_kwargs)
+                tasks.update({('preprocess', image): scheduler.Task(checkpoint(
+                    ('preprocess', image), partial(f, image), [image], preprocess=f.func.__name__, coreg_type=coreg_type,
+                    mission=apollo_mission, preprocess_engine=preprocess_engine),
+                    resources=h.estimate_pan_preprocess_resources(image, engine=preprocess_engine))
+                              for image in old_images})
 
         # preprocess lo images
         if lo:
-            print('[INFO] LO image preprocessing')  #: time {:.2f} secs '.format(time.time() - start))
             lo_images = [os.path.join(lo, f) for f in os.listdir(lo) if os.path.splitext(f)[1] in h.lo_file_types]
-
-            with Pool(num_proc) as p:
-                f = partial(mission.lo_img_preprocess, output_folder=output_folder, coreg_type=coreg_type)
-                res = list(p.imap_unordered(f, lo_images))
-            old_cubs.extend(res)
-
-            #for lo_image in lo_images:
-            #    preprocessed_cubs.append(
-            #       mission.lo_img_preprocess(os.path.join(lo, lo_image), output_folder, coreg_type))
+            f = partial(mission.lo_img_preprocess, **preprocess_kwargs)
+            tasks.update({('preprocess', image): scheduler.Task(checkpoint(
+                ('preprocess', image), partial(f, image), [image], preprocess=f.func.__name__, coreg_type=coreg_type))
+                for image in lo_images})
+            old_images.extend(lo_images)
 
         # preprocess lroc images
         if lro:
-            print('[INFO] LROC image preprocessing: time {:.2f} secs '.format(time.time() - start))
             lroc_images = [os.path.join(lro, f) for f in os.listdir(lro) if os.path.splitext(f)[1] in h.lroc_file_types]
+            f = partial(mission.lro_img_preprocess, **preprocess_kwargs)
+            tasks.update({('preprocess', image): scheduler.Task(checkpoint(
+                ('preprocess', image), partial(f, image), [image], preprocess=f.func.__name__, coreg_type=coreg_type))
+                for image in lroc_images})
+
+        # advanced co-registration of every pair (skipped if footprints of the pair do not overlap)
+        if coreg_type == 'advanced':
+            pruning = min_overlap is not None and min_overlap >= 0
+            if pruning:
+                f = partial(h.get_footprint_bbox, output_folder=output_folder)
+                tasks.update({('footprint', image): scheduler.Task(checkpoint(('footprint', image), f, source_args=1),
+                                                                   deps=[('preprocess', image)], priority=1)
+                              for image in old_images + lroc_images})
+
+            # (scale, coreg config) of every co-registration level
+            levels = h.pyramid_levels(coreg_config, scale) if pyramid else [(scale, coreg_config)]
+            # coreg configs used by pairs (all candidates with auto-tuning)
+            pair_configs = autotune.candidates(coreg_config, scale) if auto_tune else [config for _, config in levels]
+            tune_settings = None
+            if auto_tune:
+                tune_settings = {'history_path': pathlib.Path(tune_history) if tune_history else None,
+                                 'min_gof': tune_gof, 'min_points': tune_points}
+            f = partial(mission.adv_coreg_pipeline_pair, output_folder=output_folder, filter_cn=filter_cn,
+                        coreg_config=coreg_config, scale=scale, min_overlap=min_overlap, scratch_folder=scratch_folder,
+                        outlier_model=outlier_model, pyramid=pyramid, auto_tune=tune_settings, engine=engine,
+                        preprocess_engine=preprocess_engine)
+            for old_image in old_images:
+                for lroc_image in lroc_images:
+                    deps = [('preprocess', old_image), ('preprocess', lroc_image)]
+                    if pruning:
+                        deps += [('footprint', old_image), ('footprint', lroc_image)]
+                    key = ('pair', old_image, lroc_image)
+                    pair_f = checkpoint(key, f, pair_configs, source_args=2, filter_cn=filter_cn, scale=scale,
+                                        min_overlap=min_overlap, outlier_model=outlier_model, pyramid=pyramid,
+                                        auto_tune=tune_settings, engine=engine, preprocess_engine=preprocess_engine)
+                    tasks[key] = scheduler.Task(pair_f, deps=deps, group='pair', priority=2)
 
-            with Pool(num_proc) as p:
-                f = partial(mission.lro_img_preprocess, output_folder=output_folder, coreg_type=coreg_type)
-                res = list(p.imap_unordered(f, lroc_images))
-            lroc_cubs.extend(res)
+            # reduced LROC cubes are deleted as soon as the last pair with the LROC image is co-registered
+            f = partial(mission.release_scaled_lroc_cube, scratch_folder=scratch_folder or output_folder,
+                        scales=[level_scale for level_scale, _ in levels])
+            for lroc_image in lroc_images:
+                deps = [('preprocess', lroc_image)] + [('pair', old_image, lroc_image) for old_image in old_images]
+                tasks[('release', lroc_image)] = scheduler.Task(f, deps=deps, priority=3)
 
-            #for lro_image in lroc_images:
-            #    preprocessed_cubs.append(
-            #       mission.lro_img_preprocess(os.path.join(lro, lro_image), output_folder, coreg_type))
+            # matched cubes (shared by all coreg configs of the pair) are deleted when the pair is co-registered
+            f = partial(mission.release_matched_cubes, scratch_folder=scratch_folder or output_folder,
+                        scales=[level_scale for level_scale, _ in levels])
+            for old_image in old_images:
+                for lroc_image in lroc_images:
+                    deps = [('preprocess', old_image), ('preprocess', lroc_image), ('pair', old_image, lroc_image)]
+                    tasks[('release', old_image, lroc_image)] = scheduler.Task(f, deps=deps, priority=3)
 
-        # co-registration
-        print('[INFO] Images co-registration: time {:.2f} secs '.format(time.time() - start))
+        print('[INFO] Images preprocessing and co-registration: time {:.2f} secs '.format(time.time() - start))
+        ram_budget = (pan_ram_budget * scheduler.GB if pan_ram_budget else 0.8 * scheduler.total_memory())
+        disk_budget = (pan_disk_budget * scheduler.GB if pan_disk_budget
+                       else 0.9 * scheduler.free_disk(scratch_folder or output_folder))
+        done = {}
+        if resume:
+            done = manifest.completed_results(tasks, manifest_path)
+            print(f'[INFO] Resuming the run: {len(done)} of {len(tasks)} stages are completed and skipped')
+        with scheduler.FolderUsageMonitor(scratch_folder or output_folder) as usage:
+            results = scheduler.run_dag({key: task for key, task in tasks.items() if key not in done}, num_proc,
+                                        ram_budget, disk_budget, group_limits={'pair': coreg_proc or num_proc},
+                                        done=done)
+        print(f'[INFO] Peak {"scratch" if scratch_folder else "output folder"} usage during preprocessing and '
+              f'co-registration: {usage.peak / scheduler.GB:.2f} GB')
 
         if coreg_type == 'basic':
+            old_cubs = [results[('preprocess', image)] for image in old_images]
+            lroc_cubs = [results[('preprocess', image)] for image in lroc_images]
             mission_dir = apollo if apollo else lo
             mission.basic_coregistration(old_cubs + lroc_cubs, output_folder, h.get_artifacts_prefix(mission_dir))
         elif coreg_type == 'advanced':
-            mission.advanced_coregistration(old_cubs, lroc_cubs, output_folder, filter_cn, coreg_config, scale)
+            summaries = [res for key, res in results.items() if key[0] == 'pair']
+            mission.write_adv_coreg_summary(summaries, pathlib.Path(output_folder))
 
     except Exception as ex:
         print('[ERROR] There was a problem with the tool, please check error trace')
         print('[ERROR] Exception details: ', ex.stderr)
         exit(1)
     finally:
-        pass
+        if trace_path:
+            profiling.print_summary(os.environ[profiling.PROFILE_ENV])
+            profiling.disable(previous_trace)
+        if scratch_folder:
+            shutil.rmtree(scratch_folder, ignore_errors=True)
 
 
     print('[INFO] NASA Lunar Co-Registration Tool Ended: time {:.2f} secs '.format(time.time() - start))
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Reader and writer of ISIS binary Control Network files (protocol buffers based format, version 5).
+The file starts with pvl label describing location of the header message and points messages,
+every point message is prefixed with its size (little endian uint32).
+Messages are (de)serialized here directly, so neither ISIS nor protobuf library is needed.
+Networks are exchanged as pvl keywords: header [(key, value), ...] and points
+[(point keywords, [measure keywords, ...]), ...], the same as in pvl (text) Control Network
+"""
+import re
+import struct
+import pathlib
+from typing import List, Tuple, Iterable
+
+HEADER_START_BYTE = 65536
+VERSION = 5
+
+Keywords = List[Tuple[str, str]]
+
+# ControlNetFileHeaderV0005 message fields
+HEADER_FIELDS = [(1, 'NetworkId'), (2, 'TargetName'), (3, 'Created'), (4, 'LastModified'), (5, 'Description'),
+                 (6, 'UserName')]
+HEADER_PVL_ORDER = ['NetworkId', 'TargetName', 'UserName', 'Created', 'LastModified', 'Description']
+
+# enums
+POINT_TYPES = {0: 'Tie', 1: 'Ground', 2: 'Free', 3: 'Constrained', 4: 'Fixed'}
+MEASURE_TYPES = {0: 'Candidate', 1: 'Manual', 2: 'RegisteredPixel', 3: 'RegisteredSubPixel'}
+APRIORI_SOURCES = {0: 'None', 1: 'User', 2: 'AverageOfMeasures', 3: 'Reference', 4: 'Ellipsoid', 5: 'DEM',
+                   6: 'Basemap', 7: 'BundleSolution'}
+LOG_DATA_TYPES = {2: 'GoodnessOfFit', 3: 'MinimumPixelZScore', 4: 'MaximumPixelZScore', 5: 'PixelShift',
+                  6: 'WholePixelCorrelation', 7: 'SubPixelCorrelation'}
+LOG_DATA_CODES = {name: code for code, name in LOG_DATA_TYPES.items()}
+
+# ControlPointFileEntryV0005 message fields (field number, pvl keyword, kind) in cnetbin2pvl keywords order
+POINT_FIELDS = [
+    (2, 'PointType', POINT_TYPES),
+    (1, 'PointId', 'string'),
+    (3, 'ChooserName', 'string'),
+    (4, 'DateTime', 'string'),
+    (5, 'EditLock', 'bool'),
+    (6, 'Ignore', 'bool'),
+    (9, 'AprioriXYZSource', APRIORI_SOURCES),
+    (10, 'AprioriXYZSourceFile', 'string'),
+    (11, 'AprioriRadiusSource', APRIORI_SOURCES),
+    (12, 'AprioriRadiusSourceFile', 'string'),
+    (13, 'LatitudeConstrained', 'bool'),
+    (14, 'LongitudeConstrained', 'bool'),
+    (15, 'RadiusConstrained', 'bool'),
+    (16, 'AprioriX', 'meters'),
+    (17, 'AprioriY', 'meters'),
+    (18, 'AprioriZ', 'meters'),
+    (19, 'AprioriCovarianceMatrix', 'matrix'),
+    (20, 'AdjustedX', 'meters'),
+    (21, 'AdjustedY', 'meters'),
+    (22, 'AdjustedZ', 'meters'),
+    (23, 'AdjustedCovarianceMatrix', 'matrix'),
+    (7, 'JigsawRejected', 'bool'),
+]
+POINT_REFERENCE_INDEX = 8
+POINT_MEASURES = 25
+
+# Measure message fields
+MEASURE_FIELDS = [
+    (1, 'SerialNumber', 'string'),
+    (2, 'MeasureType', MEASURE_TYPES),
+    (7, 'ChooserName', 'string'),
+    (8, 'DateTime', 'string'),
+    (9, 'EditLock', 'bool'),
+    (10, 'Ignore', 'bool'),
+    (3, 'Sample', 'double'),
+    (4, 'Line', 'double'),
+    (12, 'Diameter', 'double'),
+    (13, 'AprioriSample', 'double'),
+    (14, 'AprioriLine', 'double'),
+    (15, 'SampleSigma', 'pixels'),
+    (16, 'LineSigma', 'pixels'),
+    (5, 'SampleResidual', 'pixels'),
+    (6, 'LineResidual', 'pixels'),
+    (11, 'JigsawRejected', 'bool'),
+]
+MEASURE_LOG = 17
+
+UNITS = {'meters': '<meters>', 'pixels': '<pixels>'}
+DOUBLE = struct.Struct('<d')
+SIZE = struct.Struct('<I')
+LABEL_KEYWORD_RE = re.compile(r'^\s*(\w+)\s*=\s*(.*?)\s*$', re.M)
+PVL_NEEDS_QUOTES_RE = re.compile(r'[\s,(){}<>=#"\']')
+
+
+# --- protocol buffers wire format
+
+def read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(buf, pos=0, end=None):
+    """ (field number, value) of every field of the message. Length delimited values are bytes """
+    end = len(buf) if end is None else end
+    while pos < end:
+        tag, pos = read_varint(buf, pos)
+        field, wire_type = tag >> 3, tag & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 1:
+            value = DOUBLE.unpack_from(buf, pos)[0]
+            pos += 8
+        elif wire_type == 2:
+            size, pos = read_varint(buf, pos)
+            value = bytes(buf[pos:pos + size])
+            pos += size
+        elif wire_type == 5:
+            value = bytes(buf[pos:pos + 4])
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+        yield field, value
+
+
+def varint(value: int) -> bytes:
+    if 0 <= value < 0x80:
+        return bytes((value,))
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def field_varint(field: int, value: int) -> bytes:
+    return varint(field << 3) + varint(value)
+
+
+def field_double(field: int, value: float) -> bytes:
+    return varint(field << 3 | 1) + DOUBLE.pack(value)
+
+
+def field_bytes(field: int, value: bytes) -> bytes:
+    return varint(field << 3 | 2) + varint(len(value)) + value
+
+
+# --- pvl values
+
+def pvl_string(value: str) -> str:
+    """ Quote pvl value if needed """
+    if value == '' or PVL_NEEDS_QUOTES_RE.search(value):
+        return f'"{value}"'
+    return value
+
+
+def unquote(value: str) -> str:
+    value = value.strip()
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def pvl_number(value: str) -> float:
+    """ Number from pvl value, measurement units (like '<pixels>') are dropped """
+    return float(value.split(' ')[0].split('<')[0])
+
+
+def pvl_decoder(kind):
+    """ Function converting field value to pvl value (None if the keyword is not written) """
+    if isinstance(kind, dict):
+        return kind.__getitem__
+    if kind == 'string':
+        return lambda value: pvl_string(value.decode())
+    if kind == 'bool':
+        return lambda value: 'True' if value else None
+    if kind == 'double':
+        return repr
+    if kind == 'matrix':
+        return lambda value: '(' + ', '.join(repr(v) for v in struct.unpack(f'<{len(value) // 8}d', value)) + ')'
+    return lambda value: f'{value!r} {UNITS[kind]}'
+
+
+def field_table(fields):
+    """ Decoding table: {field number: (keyword position, pvl keyword, decoder)} """
+    return {field: (i, name, pvl_decoder(kind)) for i, (field, name, kind) in enumerate(fields)}
+
+
+def pvl_encoder(field, kind):
+    """ Function converting pvl value to encoded field (tag included) """
+    if isinstance(kind, dict):
+        codes = {name: code for code, name in kind.items()}
+        tag = varint(field << 3)
+        return lambda value: tag + varint(codes[unquote(value)])
+    if kind == 'string':
+        tag = varint(field << 3 | 2)
+        return lambda value: tag + varint(len(encoded := unquote(value).encode())) + encoded
+    if kind == 'bool':
+        true_field = field_varint(field, 1)
+        return lambda value: true_field if value.strip().lower() == 'true' else b''
+    if kind == 'matrix':
+        def encode_matrix(value):
+            values = [float(v) for v in value.strip('() ').split(',') if v.strip()]
+            return field_bytes(field, struct.pack(f'<{len(values)}d', *values))
+        return encode_matrix
+    tag = varint(field << 3 | 1)
+    return lambda value: tag + DOUBLE.pack(pvl_number(value))
+
+
+def encoder_table(fields):
+    """ Encoding table: {pvl keyword: encoder} """
+    return {name: pvl_encoder(field, kind) for field, name, kind in fields}
+
+
+# --- messages
+
+POINT_TABLE = field_table(POINT_FIELDS)
+MEASURE_TABLE = field_table(MEASURE_FIELDS)
+POINT_ENCODERS = encoder_table(POINT_FIELDS)
+MEASURE_ENCODERS = encoder_table(MEASURE_FIELDS)
+
+
+def decode_message(buf, table, n_keywords) -> Tuple[Keywords, list]:
+    """
+    Pvl keywords of the message fields in 'table' (see field_table), and list of (field, value) of other fields.
+    The hot loop of the reader, so the wire format is decoded inline
+    """
+    keywords = [None] * n_keywords
+    other = []
+    pos, end = 0, len(buf)
+    while pos < end:
+        tag = buf[pos]
+        pos += 1
+        if tag & 0x80:
+            tag, pos = read_varint(buf, pos - 1)
+        wire_type = tag & 7
+        if wire_type == 2:
+            size = buf[pos]
+            pos += 1
+            if size & 0x80:
+                size, pos = read_varint(buf, pos - 1)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = DOUBLE.unpack_from(buf, pos)[0]
+            pos += 8
+        elif wire_type == 0:
+            value = buf[pos]
+            pos += 1
+            if value & 0x80:
+                value, pos = read_varint(buf, pos - 1)
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+
+        entry = table.get(tag >> 3)
+        if entry is None:
+            other.append((tag >> 3, value))
+        else:
+            position, name, decoder = entry
+            pvl_value = decoder(value)
+            if pvl_value is not None:
+                keywords[position] = (name, pvl_value)
+
+    return [kw for kw in keywords if kw is not None], other
+
+
+def decode_point(buf) -> Tuple[Keywords, List[Keywords]]:
+    point, other = decode_message(buf, POINT_TABLE, len(POINT_FIELDS))
+
+    reference_index = None
+    measures = []
+    for field, value in other:
+        if field == POINT_REFERENCE_INDEX:
+            reference_index = value
+        elif field == POINT_MEASURES:
+            measures.append(decode_measure(value))
+
+    if reference_index is not None and reference_index < len(measures):
+        measures[reference_index].append(('Reference', 'True'))
+    return point, measures
+
+
+def decode_measure(buf) -> Keywords:
+    measure, other = decode_message(buf, MEASURE_TABLE, len(MEASURE_FIELDS))
+
+    for field, value in other:
+        if field == MEASURE_LOG:
+            log = dict(iter_fields(value))
+            name = LOG_DATA_TYPES.get(log.get(1))
+            if name and 2 in log:
+                measure.append((name, repr(log[2])))
+    return measure
+
+
+def encode_point(point: Keywords, measures: List[Keywords]) -> bytes:
+    out = [POINT_ENCODERS[name](value) for name, value in point if name in POINT_ENCODERS]
+
+    for i, measure in enumerate(measures):
+        if any(name == 'Reference' and value.strip().lower() == 'true' for name, value in measure):
+            out.append(field_varint(POINT_REFERENCE_INDEX, i))
+            break
+
+    out.extend(field_bytes(POINT_MEASURES, encode_measure(measure)) for measure in measures)
+    return b''.join(out)
+
+
+def encode_measure(measure: Keywords) -> bytes:
+    out = []
+    for name, value in measure:
+        encoder = MEASURE_ENCODERS.get(name)
+        if encoder:
+            out.append(encoder(value))
+        elif name in LOG_DATA_CODES:
+            log = field_varint(1, LOG_DATA_CODES[name]) + field_double(2, pvl_number(value))
+            out.append(field_bytes(MEASURE_LOG, log))
+    return b''.join(out)
+
+
+# --- files
+
+def is_binary(path) -> bool:
+    """ ISIS binary Control Network starts with 'ProtoBuffer' pvl object """
+    with open(path, 'rb') as f:
+        return f.read(64).lstrip().startswith(b'Object = ProtoBuffer')
+
+
+def read_label(data: bytes) -> dict:
+    label = data[:HEADER_START_BYTE].split(b'\0', 1)[0].decode('latin-1')
+    return dict(LABEL_KEYWORD_RE.findall(label))
+
+
+def read(path) -> Tuple[Keywords, List[Tuple[Keywords, List[Keywords]]]]:
+    """
+    Read binary Control Network. Raises ValueError if the file is not a Control Network of version 5
+    """
+    data = pathlib.Path(path).read_bytes()
+    label = read_label(data)
+    if label.get('Version') != str(VERSION):
+        raise ValueError(f'Unsupported binary Control Network version {label.get("Version")}: {path}')
+
+    header_start, header_bytes = int(label['HeaderStartByte']), int(label['HeaderBytes'])
+    header_values = dict(iter_fields(data, header_start, header_start + header_bytes))
+    header_keywords = dict((name, pvl_string(header_values[field].decode()))
+                           for field, name in HEADER_FIELDS if field in header_values)
+    header = [(name, header_keywords[name]) for name in HEADER_PVL_ORDER if name in header_keywords]
+    header.append(('Version', str(VERSION)))
+
+    pos = int(label['PointsStartByte'])
+    end = pos + int(label['PointsBytes'])
+    if end > len(data):
+        raise ValueError(f'Truncated binary Control Network: {path}')
+
+    points = []
+    while pos < end:
+        size = SIZE.unpack_from(data, pos)[0]
+        pos += SIZE.size
+        if pos + size > end:
+            raise ValueError(f'Corrupted binary Control Network: {path}')
+        points.append(decode_point(data[pos:pos + size]))
+        pos += size
+
+    if 'NumberOfPoints' in label and int(label['NumberOfPoints']) != len(points):
+        raise ValueError(f'Corrupted binary Control Network: {path}')
+    return header, points
+
+
+def write(path, header: Keywords, points: Iterable[Tuple[Keywords, List[Keywords]]]):
+    """ Write binary Control Network """
+    header = dict(header)
+    header_message = b''.join(field_bytes(field, unquote(header[name]).encode())
+                              for field, name in HEADER_FIELDS if name in header)
+
+    point_messages = []
+    n_points = n_measures = 0
+    for point, measures in points:
+        message = encode_point(point, measures)
+        point_messages.append(SIZE.pack(len(message)))
+        point_messages.append(message)
+        n_points += 1
+        n_measures += len(measures)
+    points_bytes = sum(len(m) for m in point_messages)
+
+    info = ''.join(f'    {name:<16} = {header[name]}\n' for name in HEADER_PVL_ORDER if name in header)
+    label = (
+        'Object = ProtoBuffer\n'
+        '  Object = Core\n'
+        f'    HeaderStartByte = {HEADER_START_BYTE}\n'
+        f'    HeaderBytes     = {len(header_message)}\n'
+        f'    PointsStartByte = {HEADER_START_BYTE + len(header_message)}\n'
+        f'    PointsBytes     = {points_bytes}\n'
+        '  End_Object\n\n'
+        '  Group = ControlNetworkInfo\n'
+        f'{info}'
+        f'    NumberOfPoints   = {n_points}\n'
+        f'    NumberOfMeasures = {n_measures}\n'
+        f'    Version          = {VERSION}\n'
+        '  End_Group\n'
+        'End_Object\n'
+        'End\n'
+    ).encode()
+    if len(label) > HEADER_START_BYTE:
+        raise ValueError('Control Network label is too long')
+
+    with open(path, 'wb') as f:
+        f.write(label)
+        f.write(b'\0' * (HEADER_START_BYTE - len(label)))
+        f.write(header_message)
+        for message in point_messages:
+            f.write(message)
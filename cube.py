@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+import re
+import struct
+import pathlib
+from typing import Dict, Any, Iterator, Tuple, List, Union
+
+import numpy as np
+
+# numpy types of ISIS pixel types (byte order is added from the label)
+PIXEL_TYPES = {'UnsignedByte': 'u1', 'SignedWord': 'i2', 'UnsignedWord': 'u2', 'SignedInteger': 'i4',
+               'Real': 'f4', 'Double': 'f8'}
+
+
+def float_bits(bits, fmt='<f', int_fmt='<I'):
+    return struct.unpack(fmt, struct.pack(int_fmt, bits))[0]
+
+
+# ISIS special pixel values by pixel type (see ISIS SpecialPixel.h)
+SPECIAL_PIXELS = {
+    'UnsignedByte': {'Null': 0, 'Lrs': 0, 'Lis': 0, 'His': 255, 'Hrs': 255},
+    'SignedWord': {'Null': -32768, 'Lrs': -32767, 'Lis': -32766, 'His': -32765, 'Hrs': -32764},
+    'UnsignedWord': {'Null': 0, 'Lrs': 1, 'Lis': 2, 'His': 65534, 'Hrs': 65535},
+    'SignedInteger': {'Null': -8388613, 'Lrs': -8388612, 'Lis': -8388611, 'His': -8388610, 'Hrs': -8388609},
+    'Real': {name: float_bits(bits) for name, bits in
+             [('Null', 0xFF7FFFFB), ('Lrs', 0xFF7FFFFC), ('Lis', 0xFF7FFFFD), ('His', 0xFF7FFFFE), ('Hrs', 0xFF7FFFFF)]},
+    'Double': {name: float_bits(bits, '<d', '<Q') for name, bits in
+               [('Null', 0xFFEFFFFFFFFFFFFB), ('Lrs', 0xFFEFFFFFFFFFFFFC), ('Lis', 0xFFEFFFFFFFFFFFFD),
+                ('His', 0xFFEFFFFFFFFFFFFE), ('Hrs', 0xFFEFFFFFFFFFFFFF)]},
+}
+
+# valid DN ranges of ISIS pixel types, special pixels are out of them (except SignedInteger ones)
+VALID_RANGES = {
+    'UnsignedByte': (1, 254),
+    'SignedWord': (-32752, 32767),
+    'UnsignedWord': (3, 65522),
+    'SignedInteger': (np.iinfo(np.int32).min, np.iinfo(np.int32).max),
+    'Real': (float_bits(0xFF7FFFFA), float(np.finfo(np.float32).max)),
+    'Double': (float_bits(0xFFEFFFFFFFFFFFFA, '<d', '<Q'), float(np.finfo(np.float64).max)),
+}
+
+LABEL_CHUNK = 65536
+LABEL_BYTES = 65536  # label area of written cubes
+TILE_SIZE = 128  # tile samples and lines of written cubes
+LABEL_KEYWORD_RE = re.compile(r'^\s*(\^?\w+)\s*=\s*(.*?)\s*$')
+END_KEYWORDS = ['End_Object', 'EndObject', 'End_Group', 'EndGroup']
+
+
+def label_text(path) -> str:
+    """ Text of the attached cube label (up to 'End' line) """
+    text = b''
+    with open(path, 'rb') as f:
+        # the label ends with 'End' line
+        while not re.search(rb'^End\s*$', text, re.M):
+            chunk = f.read(LABEL_CHUNK)
+            if not chunk:
+                break
+            text += chunk
+    return text.decode('ascii', errors='replace')
+
+
+def read_label(path) -> Dict[str, Dict[str, str]]:
+    """ Keywords of the attached cube label by their Object / Group name (e.g. label['Dimensions']['Samples']) """
+    label, names = {}, []
+    for line in label_text(path).splitlines():
+        line = line.split('/*')[0].strip()
+        if line == 'End':
+            break
+        match = LABEL_KEYWORD_RE.match(line)
+        if match:
+            key, value = match.groups()
+            if key in ['Object', 'Group']:
+                names.append(value)
+                label.setdefault(value, {})
+            elif names:
+                label[names[-1]][key] = value.strip('"')
+        elif line in END_KEYWORDS and names:
+            names.pop()
+    return label
+
+
+def cube_info(label: Dict[str, Dict[str, str]]) -> Dict[str, Any]:
+    """ Layout of cube pixels described by the label """
+    core, pixels, dimensions = label['Core'], label['Pixels'], label['Dimensions']
+    if '^Core' in core:
+        raise ValueError(f'Detached cube labels are not supported (^Core = {core["^Core"]})')
+    pixel_type = pixels['Type']
+    byte_order = '<' if pixels.get('ByteOrder', 'Lsb') == 'Lsb' else '>'
+    info = {
+        'start_byte': int(core['StartByte']),
+        'format': core.get('Format', 'Tile'),
+        'samples': int(dimensions['Samples']),
+        'lines': int(dimensions['Lines']),
+        'bands': int(dimensions['Bands']),
+        'pixel_type': pixel_type,
+        'dtype': np.dtype(byte_order + PIXEL_TYPES[pixel_type]),
+        'base': float(pixels.get('Base', 0.)),
+        'multiplier': float(pixels.get('Multiplier', 1.)),
+    }
+    if info['format'] == 'Tile':
+        info['tile_samples'], info['tile_lines'] = int(core['TileSamples']), int(core['TileLines'])
+    else:
+        # band sequential cube is a single tile of the whole band
+        info['tile_samples'], info['tile_lines'] = info['samples'], info['lines']
+    return info
+
+
+class Cube:
+    """
+    ISIS cube with attached label. Pixels are a zero-copy numpy.memmap of the cube file: 'tiles' is
+    (Bands x TileRows x TileColumns x TileLines x TileSamples) array of raw DNs (band sequential cube
+    is a single tile of every band). Lines are read and written by tile rows, so memory usage does not
+    depend on the cube size. Raw DNs are converted to values (NaN for special pixels) by 'to_values'
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = pathlib.Path(path)
+        self.label = read_label(path)
+        self.info = cube_info(self.label)
+        for key in ['samples', 'lines', 'bands', 'pixel_type', 'dtype', 'base', 'multiplier', 'tile_samples',
+                    'tile_lines']:
+            setattr(self, key, self.info[key])
+
+        self.tile_rows = -(-self.lines // self.tile_lines)
+        self.tile_columns = -(-self.samples // self.tile_samples)
+        self.tiles = np.memmap(self.path, dtype=self.dtype, mode=mode, offset=self.info['start_byte'] - 1,
+                               shape=(self.bands, self.tile_rows, self.tile_columns, self.tile_lines, self.tile_samples))
+
+    def flush(self):
+        self.tiles.flush()
+
+    def tile(self, band, row, column) -> np.ndarray:
+        """ Raw DNs of the tile (view, padded pixels of edge tiles are included) """
+        return self.tiles[band - 1, row, column]
+
+    def line_blocks(self, lines=None) -> Iterator[Tuple[int, int]]:
+        """ (start, stop) ranges of 0-based lines, aligned to tile rows ('lines' is rounded up to tile lines) """
+        step = -(-(lines or self.tile_lines) // self.tile_lines) * self.tile_lines
+        for start in range(0, self.lines, step):
+            yield start, min(start + step, self.lines)
+
+    def read_lines(self, start, stop, band=1) -> np.ndarray:
+        """ Raw DNs of 0-based lines [start, stop) of the band, only tiles of the lines are read """
+        res = np.empty((stop - start, self.samples), dtype=self.dtype)
+        line = start
+        while line < stop:
+            row, tile_line = divmod(line, self.tile_lines)
+            n = min(self.tile_lines - tile_line, stop - line)
+            # (TileColumns x Lines x TileSamples) -> (Lines x Samples)
+            block = self.tiles[band - 1, row, :, tile_line:tile_line + n].transpose(1, 0, 2)
+            res[line - start:line - start + n] = block.reshape(n, -1)[:, :self.samples]
+            line += n
+        return res
+
+    def write_lines(self, start, raw, band=1):
+        """ Write raw DNs (Lines x Samples) to the band starting from 0-based line 'start' """
+        raw = np.asarray(raw, dtype=self.dtype)
+        padded = np.zeros((raw.shape[0], self.tile_columns * self.tile_samples), dtype=self.dtype)
+        padded[:, :self.samples] = raw
+        # (Lines x TileColumns x TileSamples) -> (TileColumns x Lines x TileSamples) for every tile row
+        padded = padded.reshape(raw.shape[0], self.tile_columns, self.tile_samples).transpose(1, 0, 2)
+
+        line, stop = start, start + raw.shape[0]
+        while line < stop:
+            row, tile_line = divmod(line, self.tile_lines)
+            n = min(self.tile_lines - tile_line, stop - line)
+            self.tiles[band - 1, row, :, tile_line:tile_line + n] = padded[:, line - start:line - start + n]
+            line += n
+
+    def read_band(self, band=1) -> np.ndarray:
+        """ Values of the whole band (Lines x Samples float64 array, special pixels are NaN) """
+        return self.to_values(self.read_lines(0, self.lines, band))
+
+    def special(self, raw) -> np.ndarray:
+        """ Mask of special pixels of raw DNs """
+        raw = np.asarray(raw)
+        valid_min, valid_max = VALID_RANGES[self.pixel_type]
+        res = ~((raw >= valid_min) & (raw <= valid_max))
+        if self.pixel_type == 'SignedInteger':
+            res |= (raw >= SPECIAL_PIXELS['SignedInteger']['Null']) & (raw <= SPECIAL_PIXELS['SignedInteger']['Hrs'])
+        return res
+
+    def to_values(self, raw) -> np.ndarray:
+        """ Values (Base + Multiplier * DN) of raw DNs as float64, special pixels are NaN """
+        res = np.array(raw, dtype=np.float64)
+        if self.base != 0. or self.multiplier != 1.:
+            res = self.base + self.multiplier * res
+        res[self.special(raw)] = np.nan
+        return res
+
+    def to_raw(self, values) -> np.ndarray:
+        """ Raw DNs of values: NaN is Null, values out of the valid range are low / high representation saturation """
+        values = np.asarray(values, dtype=np.float64)
+        if self.base != 0. or self.multiplier != 1.:
+            values = (values - self.base) / self.multiplier
+        special = SPECIAL_PIXELS[self.pixel_type]
+        valid_min, valid_max = VALID_RANGES[self.pixel_type]
+        if self.dtype.kind != 'f':
+            values = np.round(values)
+
+        with np.errstate(invalid='ignore'):
+            raw = np.clip(values, valid_min, valid_max)
+            if self.pixel_type == 'SignedInteger':
+                # special values are in the middle of the valid range
+                raw[(raw >= special['Null']) & (raw <= special['Hrs'])] = special['Lrs']
+            raw = raw.astype(self.dtype)
+            raw[values < valid_min] = special['Lrs']
+            raw[values > valid_max] = special['Hrs']
+        raw[np.isnan(values)] = special['Null']
+        return raw
+
+
+def label_blocks(lines: List[str]) -> List[List[str]]:
+    """ Label lines split into top level Objects / Groups (with nested ones), other lines are dropped """
+    blocks, depth = [], 0
+    for line in lines:
+        text = line.split('/*')[0].strip()
+        if depth == 0:
+            if text == 'End':
+                break
+            blocks.append([])
+        blocks[-1].append(line)
+        match = LABEL_KEYWORD_RE.match(text)
+        if match and match.group(1) in ['Object', 'Group']:
+            depth += 1
+        elif text in END_KEYWORDS:
+            depth -= 1
+    return [block for block in blocks if block_name(block)]
+
+
+def block_name(block: List[str]) -> Union[str, None]:
+    """ Name of the label Object / Group """
+    match = LABEL_KEYWORD_RE.match(block[0].split('/*')[0])
+    return match.group(2) if match and match.group(1) in ['Object', 'Group'] else None
+
+
+def block_keyword(block: List[str], key) -> Union[str, None]:
+    """ Value of the first keyword of the label block (nested blocks included) """
+    for line in block:
+        match = LABEL_KEYWORD_RE.match(line.split('/*')[0])
+        if match and match.group(1) == key:
+            return match.group(2)
+    return None
+
+
+def group_lines(name, keywords: Dict[str, Any], indent='  ') -> List[str]:
+    return ([f'{indent}Group = {name}'] + [f'{indent}  {key} = {value}' for key, value in keywords.items()] +
+            [f'{indent}End_Group'])
+
+
+def core_lines(samples, lines, bands, pixel_type, cube_format, tile_samples, tile_lines, base, multiplier,
+               byte_order, start_byte) -> List[str]:
+    """ Core object of the cube label """
+    tile_keywords = [f'    TileSamples = {tile_samples}', f'    TileLines   = {tile_lines}'] \
+        if cube_format == 'Tile' else []
+    return (['  Object = Core', f'    StartByte   = {start_byte}', f'    Format      = {cube_format}'] +
+            tile_keywords + [''] +
+            group_lines('Dimensions', {'Samples': samples, 'Lines': lines, 'Bands': bands}, '    ') + [''] +
+            group_lines('Pixels', {'Type': pixel_type, 'ByteOrder': byte_order, 'Base': base,
+                                   'Multiplier': multiplier}, '    ') +
+            ['  End_Object'])
+
+
+def create(path, samples, lines, bands=1, pixel_type='Real', cube_format='Tile', tile_samples=TILE_SIZE,
+           tile_lines=TILE_SIZE, base=0., multiplier=1., groups=None, like=None) -> Cube:
+    """
+    Create the cube (all pixels are Null) with minimal label and open it for writing.
+    'groups' ({name: {keyword: value}}) are added to IsisCube object. Groups of IsisCube object and
+    data objects (tables, history, original label) of 'like' cube are copied (except the replaced groups)
+    """
+    groups = groups or {}
+    cube_groups, blobs = [], []
+    if like is not None:
+        for block in label_blocks(label_text(like).splitlines()):
+            name = block_name(block)
+            if name == 'IsisCube':
+                cube_groups = [inner for inner in label_blocks(block[1:-1])
+                               if block_name(inner) not in ['Core', *groups]]
+            elif name != 'Label' and block_keyword(block, 'StartByte') and block_keyword(block, 'Bytes'):
+                blobs.append(block)
+    cube_groups += [group_lines(name, keywords) for name, keywords in groups.items()]
+
+    if cube_format == 'Tile':
+        n_pixels = bands * -(-lines // tile_lines) * tile_lines * -(-samples // tile_samples) * tile_samples
+    else:
+        n_pixels = bands * lines * samples
+    null = np.array([SPECIAL_PIXELS[pixel_type]['Null']], dtype=np.dtype('<' + PIXEL_TYPES[pixel_type]))
+
+    # data objects follow the pixels, the label area grows until the label fits into it
+    label_bytes = LABEL_BYTES
+    while True:
+        start_byte = label_bytes + n_pixels * null.itemsize + 1
+        blob_lines = []
+        for block in blobs:
+            blob_lines += [re.sub(r'StartByte(\s*)=\s*\d+', rf'StartByte\g<1>= {start_byte}', line) for line in block]
+            start_byte += int(block_keyword(block, 'Bytes'))
+        label = '\n'.join(
+            ['Object = IsisCube'] +
+            core_lines(samples, lines, bands, pixel_type, cube_format, tile_samples, tile_lines, base, multiplier,
+                       'Lsb', label_bytes + 1) +
+            [line for block in cube_groups for line in [''] + block] +
+            ['End_Object', '', 'Object = Label', f'  Bytes = {label_bytes}', 'End_Object', ''] +
+            blob_lines + ['End', '']).encode()
+        if len(label) <= label_bytes:
+            break
+        label_bytes = -(-len(label) // LABEL_BYTES) * LABEL_BYTES
+
+    with open(path, 'wb') as f:
+        f.write(label.ljust(label_bytes, b'\0'))
+        if null[0] == 0:
+            f.truncate(label_bytes + n_pixels * null.itemsize)
+            f.seek(0, 2)
+        else:
+            chunk = np.repeat(null, min(n_pixels, 2 ** 20)).tobytes()
+            for start in range(0, n_pixels, 2 ** 20):
+                f.write(chunk[:min(2 ** 20, n_pixels - start) * null.itemsize])
+
+        if blobs:
+            with open(like, 'rb') as source:
+                for block in blobs:
+                    source.seek(int(block_keyword(block, 'StartByte')) - 1)
+                    f.write(source.read(int(block_keyword(block, 'Bytes'))))
+    return Cube(path, mode='r+')
+
+
+def write_band(path, values, pixel_type='Real', groups=None) -> pathlib.Path:
+    """ Write values (Lines x Samples, NaN is Null) as a single band cube """
+    lines, samples = np.shape(values)
+    cub = create(path, samples, lines, pixel_type=pixel_type, groups=groups)
+    cub.write_lines(0, cub.to_raw(values))
+    cub.flush()
+    return pathlib.Path(path)
+
+
+def read_band(path, band=1) -> np.ndarray:
+    """ DNs of the cube band as float64 (Lines x Samples) array, special pixels are NaN """
+    return Cube(path).read_band(band)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import pathlib
+from typing import Dict, Any, Union, Tuple
+
+import numpy as np
+
+import helper as h
+import cube
+
+
+class Histogram:
+    """ Histogram of values with fixed bins over [minimum, maximum], NaN values are skipped """
+
+    def __init__(self, minimum, maximum, bins=h.HISTEQ_BINS):
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.edges = np.linspace(minimum, maximum, bins + 1)
+        self.minimum, self.maximum = np.inf, -np.inf
+
+    def add(self, values):
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return
+        self.counts += np.histogram(values, bins=self.edges)[0]
+        self.minimum, self.maximum = min(self.minimum, values.min()), max(self.maximum, values.max())
+
+    def percentiles(self, percents) -> np.ndarray:
+        """ Values below which 'percents' of values are (linear within a bin) """
+        cdf = np.cumsum(self.counts)
+        targets = np.maximum(np.asarray(percents, dtype=np.float64) / 100. * cdf[-1], 1e-9)
+        index = np.minimum(np.searchsorted(cdf, targets), len(self.counts) - 1)
+        below = cdf[index] - self.counts[index]
+        fraction = (targets - below) / np.maximum(self.counts[index], 1)
+        res = self.edges[index] + fraction * (self.edges[index + 1] - self.edges[index])
+        return np.clip(res, self.minimum, self.maximum)
+
+
+def value_range(cub: cube.Cube) -> Union[Tuple[float, float], None]:
+    """
+    Range of valid values of 8 and 16 bit cubes, so their histogram is built while the cube is read.
+    None for other pixel types (their range is not known in advance)
+    """
+    if cub.dtype.kind == 'f' or cub.dtype.itemsize > 2:
+        return None
+    values = cub.base + cub.multiplier * np.array(cube.VALID_RANGES[cub.pixel_type], dtype=np.float64)
+    return values.min(), values.max()
+
+
+def block_average(values: np.ndarray, scale: int, valid_fraction: float) -> np.ndarray:
+    """
+    Averages of valid (not NaN) values of 'scale' x 'scale' blocks (edge blocks are partial).
+    Block average is NaN if valid fraction of its values is below 'valid_fraction'. NaN values are zeroed in place
+    """
+    lines, samples = values.shape
+    out_lines, out_samples = -(-lines // scale), -(-samples // scale)
+    if (lines, samples) != (out_lines * scale, out_samples * scale):
+        padded = np.full((out_lines * scale, out_samples * scale), np.nan)
+        padded[:lines, :samples] = values
+        values = padded
+
+    sizes = np.outer(np.minimum(scale, lines - scale * np.arange(out_lines)),
+                     np.minimum(scale, samples - scale * np.arange(out_samples)))
+    invalid = np.isnan(values)
+    values[invalid] = 0.
+    # summing the contiguous axis first is several times faster
+    sums = values.reshape(out_lines, scale, out_samples, scale).sum(axis=3).sum(axis=1)
+    if invalid.any():
+        counts = scale * scale - invalid.reshape(out_lines, scale, out_samples, scale).sum(axis=3).sum(axis=1)
+    else:
+        counts = sizes
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = sums / counts
+    res[(counts == 0) | (counts < valid_fraction * sizes)] = np.nan
+    return res
+
+
+def alpha_cube(source: cube.Cube, samples: int, lines: int, scale: int) -> Dict[str, Any]:
+    """ AlphaCube group of the reduced cube, it maps reduced pixels to pixels of the original cube (as ISIS reduce) """
+    alpha = source.label.get('AlphaCube')
+    res = {'AlphaSamples': alpha['AlphaSamples'] if alpha else source.samples,
+           'AlphaLines': alpha['AlphaLines'] if alpha else source.lines}
+    for axis, size in [('Sample', samples), ('Line', lines)]:
+        # reduced cube covers 'size * scale' pixels of the source cube
+        end = size * scale + 0.5
+        if alpha:
+            # source cube is reduced (or cropped) already, its pixels are mapped to the original cube
+            start, stop = float(alpha[f'AlphaStarting{axis}']), float(alpha[f'AlphaEnding{axis}'])
+            res[f'AlphaStarting{axis}'] = start
+            res[f'AlphaEnding{axis}'] = start + (end - 0.5) * (stop - start) / int(alpha[f'Beta{axis}s'])
+        else:
+            res[f'AlphaStarting{axis}'], res[f'AlphaEnding{axis}'] = 0.5, end
+    res.update(BetaSamples=samples, BetaLines=lines)
+    return res
+
+
+def cube_histogram(cub: cube.Cube, band=1) -> Histogram:
+    """ Histogram of the cube band, read twice: for values range and for counts """
+    minimum, maximum = np.inf, -np.inf
+    for start, stop in cub.line_blocks():
+        values = cub.to_values(cub.read_lines(start, stop, band))
+        if not np.isnan(values).all():
+            minimum, maximum = min(minimum, np.nanmin(values)), max(maximum, np.nanmax(values))
+
+    histogram = Histogram(minimum, maximum) if minimum <= maximum else Histogram(0., 1.)
+    for start, stop in cub.line_blocks():
+        histogram.add(cub.to_values(cub.read_lines(start, stop, band)))
+    return histogram
+
+
+def equalize(cub: cube.Cube, histogram: Histogram, band=1, percents=h.HISTEQ_PERCENTS):
+    """
+    Histogram equalization of the cube band in place (as ISIS histeq): value at every 'increment' percent
+    from minimum to maximum percent is stretched to evenly spaced values between them
+    """
+    min_percent, max_percent, increment = percents
+    steps = np.arange(min_percent, max_percent + increment / 2, increment)
+    inputs = histogram.percentiles(steps)
+    outputs = inputs[0] + (inputs[-1] - inputs[0]) * (steps - min_percent) / (max_percent - min_percent)
+
+    for start, stop in cub.line_blocks():
+        values = cub.to_values(cub.read_lines(start, stop, band))
+        cub.write_lines(start, cub.to_raw(np.interp(values, inputs, outputs)), band)
+
+
+def reduce_cube(from_, to_, scale=1, histeq=False, valid_percent=h.REDUCE_VALID_PERCENT,
+                percents=h.HISTEQ_PERCENTS, block_bytes=h.STREAM_BLOCK_BYTES) -> pathlib.Path:
+    """
+    Reduce the cube by 'scale' averaging valid pixels of blocks (as ISIS reduce, the reduced pixel is Null
+    if less than 'valid_percent' of its pixels are valid) and equalize its histogram if 'histeq' is set.
+    The source cube is read once by blocks of about 'block_bytes', the histogram of 8 and 16 bit cubes
+    is built in the same pass. The result is a Real cube with groups and tables of the source cube label
+    """
+    source = cube.Cube(from_)
+    samples, lines = -(-source.samples // scale), -(-source.lines // scale)
+    groups = {'AlphaCube': alpha_cube(source, samples, lines, scale)} if scale > 1 else None
+    target = cube.create(to_, samples, lines, source.bands, groups=groups, like=from_)
+
+    # source lines reduced at once (multiple of scale)
+    block_lines = max(1, block_bytes // (8 * source.samples * scale)) * scale
+    for band in range(1, source.bands + 1):
+        hist_range = value_range(source) if histeq else None
+        histogram = Histogram(*hist_range) if hist_range else None
+        for start in range(0, source.lines, block_lines):
+            values = source.to_values(source.read_lines(start, min(start + block_lines, source.lines), band))
+            if scale > 1:
+                values = block_average(values, scale, valid_percent / 100.)
+            if histogram:
+                histogram.add(values)
+            target.write_lines(start // scale, target.to_raw(values), band)
+
+        if histeq:
+            # the reduced band is equalized in place
+            equalize(target, histogram or cube_histogram(target, band), band, percents)
+
+    target.flush()
+    return pathlib.Path(to_)
@@ -1,13 +1,17 @@
-from flask import Flask, render_template, jsonify, flash, request, redirect, url_for, stream_with_context
+from flask import Flask, render_template, jsonify, flash, request, redirect, url_for, stream_with_context, abort
 #import test
-import subprocess
-import time, os
+import sys
+import json
+import queue
+import threading
 from pathlib import Path
 
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, SelectField, IntegerField, TextAreaField, FileField, BooleanField
 from wtforms.validators import DataRequired, Length, Email, NumberRange, ValidationError
 import helper as h
+import jobs
+import catalog
 
 app = Flask(__name__)
 #app.config.from_object('config.Config')
@@ -29,6 +33,25 @@ LROC_MISSION_PATH = '/home/ubuntu/Topcoder_FlaskUI/data/lroc_mission'
 OUTPUT_PATH = '/home/ubuntu/Topcoder_FlaskUI/data/output'
 JUPYTER_ROOT = 'http://ec2-3-144-74-167.us-east-2.compute.amazonaws.com:8888/tree'
 
+# co-registration jobs: state and output files, number of jobs run at the same time, max number of queued jobs
+JOBS_PATH = '/home/ubuntu/Topcoder_FlaskUI/data/jobs'
+MAX_CONCURRENT_JOBS = 1
+JOB_QUEUE_SIZE = 10
+
+COREG_PARAMS = ['dir1', 'dir1_mission', 'dir1_camera', 'dir2', 'dir_output', 'num_proc', 'coreg_type', 'filter_cn']
+
+# catalog of inputs and co-registration results: index file, min interval between checks for changed folders (secs)
+CATALOG_INDEX_PATH = '/home/ubuntu/Topcoder_FlaskUI/data/catalog.json'
+CATALOG_REFRESH_SECONDS = 5.
+# JSON API pagination
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+job_manager = None
+job_manager_lock = threading.Lock()
+results_catalog = None
+results_catalog_lock = threading.Lock()
+
 def range_check(form, field):
     if int(field.data) > 4 or int(field.data) < 1:
         raise ValidationError('Field must be in a range 1..4')
@@ -36,7 +59,8 @@ def range_check(form, field):
 
 class CoregForm(FlaskForm):
     #print(list(Path(OLD_MISSIONS_PATH).glob('*')))
-    dir1 = SelectField('Past Mission folder', [DataRequired()], choices=sorted((Path(OLD_MISSIONS_PATH).glob('*'))))
+    # folders choices are set from the catalog on every request
+    dir1 = SelectField('Past Mission folder', [DataRequired()], choices=[])
     dir1_mission = SelectField('Mission', [DataRequired()],
                             choices=[
                                 ('lo', 'Lunar orbiter'),
@@ -51,10 +75,8 @@ class CoregForm(FlaskForm):
                                 ('--panoramic', 'Panoramic'),
                             ])
 
-    dir2 = SelectField('LROC folder', [DataRequired()],
-                       choices=sorted([str(s) for s in Path(LROC_MISSION_PATH).glob('*')]))
-    dir_output = SelectField('Output folder', [DataRequired()],
-                             choices=sorted([str(s) for s in Path(OUTPUT_PATH).glob('*')]))
+    dir2 = SelectField('LROC folder', [DataRequired()], choices=[])
+    dir_output = SelectField('Output folder', [DataRequired()], choices=[])
 
     coreg_type = SelectField('Co-registration algo:', [DataRequired()],
                             choices=[
@@ -69,107 +91,134 @@ class CoregForm(FlaskForm):
     submit = SubmitField('Submit')
 
 
+def coreg_command(dir1, dir1_mission, dir1_camera, dir2, dir_output, num_proc, coreg_type, filter_cn):  #, coreg_config, scale):
+    """ CLI tool command line (arguments list, no shell) """
+    if dir1_mission == 'lo':
+        mission_args = ['--lo', dir1]
+    else:
+        mission_args = ['--apollo', dir1, '--apollo_mission', dir1_mission]
+
+    filter_cn = 1 if str(filter_cn) == 'True' else 0
+
+    return [sys.executable, '-u', 'cli.py'] + mission_args + [dir1_camera,
+            '--lro', dir2,
+            '--output_folder', dir_output,
+            coreg_type, '--num_proc', str(num_proc),
+            '--filter_cn', str(filter_cn)]
+            #'--coreg_config', coreg_config,
+            #'--scale', str(scale)
+
+
+def get_jobs() -> jobs.JobManager:
+    """ Jobs are run by the server process, the manager is created on the first use """
+    global job_manager
+    with job_manager_lock:
+        if job_manager is None:
+            job_manager = jobs.JobManager(JOBS_PATH, max_running=MAX_CONCURRENT_JOBS, max_queued=JOB_QUEUE_SIZE,
+                                          cwd=Path(__file__).resolve().parent)
+    return job_manager
+
+
+def get_catalog() -> catalog.Catalog:
+    """ Catalog is created on the first use, it's read from the index file if it exists """
+    global results_catalog
+    with results_catalog_lock:
+        if results_catalog is None:
+            results_catalog = catalog.Catalog({'old_missions': OLD_MISSIONS_PATH, 'lroc': LROC_MISSION_PATH},
+                                              OUTPUT_PATH, CATALOG_INDEX_PATH, CATALOG_REFRESH_SECONDS)
+    return results_catalog
+
+
+def submit_coreg(params):
+    """ Queue co-registration with the params and show its progress """
+    params = {key: params.get(key) for key in COREG_PARAMS}
+    command = coreg_command(**params)
+    print(f"\nQueuing CLI: {' '.join(command)}\n")
+    try:
+        job = get_jobs().submit(command, params)
+    except queue.Full:
+        flash('Too many co-registrations are queued, please try again later')
+        return redirect(url_for("coreg"))
+    return redirect(url_for("job_page", job_id=job.id))
+
+
+def job_links(job: jobs.Job):
+    """ Links to co-registration results directory and the file with statistics """
+    params = job.state['params']
+    jupyter_url = f'{JUPYTER_ROOT}/{Path(params["dir_output"]).parts[-2]}/{Path(params["dir_output"]).parts[-1]}'
+    stats_url = f'{jupyter_url.replace("/tree", "/edit", 1)}/' \
+                f'{h.get_stats_filename(h.get_artifacts_prefix(params["dir1"]))}'
+    return {'results': jupyter_url, 'stats': stats_url if params['coreg_type'] == '--basic' else None}
+
+
 @app.route('/coreglog')
 def coreg_log():
-    def inner(dir1, dir1_mission, dir1_camera, dir2, dir_output, num_proc, coreg_type, filter_cn):  #, coreg_config, scale):
-        """ Redirect output from the CLI tool to the web page """
-
-        if dir1_mission == 'lo':
-            mission_key = '--lo'
-            mission_type = ''
-        else:
-            mission_key = '--apollo'
-            mission_type = f'--apollo_mission {dir1_mission}'
-
-        if filter_cn == 'True':
-            filter_cn = 1
-        else:
-            filter_cn = 0
-
-        str_exec = f'python -u cli.py ' + \
-            f' {mission_key} {dir1} {mission_type} {dir1_camera}' + \
-            f' --lro {dir2}' + \
-            f' --output_folder {dir_output}' + \
-            f' {coreg_type} --num_proc {num_proc}' + \
-            f' --filter_cn {filter_cn}'
-            #f' --coreg_config {coreg_config}' + \
-            #f' --scale {scale}'
-
-        print(f"\nRunning CLI: {str_exec}\n")
-        yield f'Command line:<br/> {str_exec.rstrip()} <br/><br/>\n'.encode()
-
-        proc = subprocess.Popen(
-            [str_exec],
-            shell=True,
-            stdout=subprocess.PIPE
-        )
-
-        for line in iter(proc.stdout.readline, ''):
-            # add the line from CLI tool stdout
-            yield line.rstrip() + b'<br/>\n'
-
-            # check if process is still running
-            if proc.poll() is not None:
-                # process is not running - flush CLI tool stdout and break the loop
-                while line:
-                   line = proc.stdout.readline()
-                   yield line.rstrip() + b'<br/>\n'
-
-                break
+    # kept for the old links: co-registration is submitted only by the validated form
+    return redirect(url_for("coreg"))
+
+
+@app.route('/jobs')
+def list_jobs():
+    """ States of all jobs, the latest first """
+    return jsonify(get_jobs().states())
+
+
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    job = get_jobs().get(job_id)
+    if job is None:
+        abort(404)
+    return render_template("job.html", job=job.state, command=' '.join(job.state['command']),
+                           coreg_url=url_for("coreg"))
+
+
+@app.route('/jobs/<job_id>/state')
+def job_state(job_id):
+    job = get_jobs().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(dict(job.state, links=job_links(job)))
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    Job output as Server-Sent Events: every line is sent as soon as it's printed, with the line number as event id.
+    Reconnecting clients (Last-Event-ID header or 'last_event_id' arg) get the lines after the last received one,
+    the final job state is sent as 'end' event
+    """
+    job = get_jobs().get(job_id)
+    if job is None:
+        abort(404)
+
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+
+    def inner():
+        for n, line in job.lines(start):
+            if n is None:
+                # keep the connection open (proxies drop idle ones)
+                yield ': keepalive\n\n'
             else:
-                time.sleep(1)
-
-        # add links to co-reg results directory and the file with statistics
-        coreg_url = url_for("coreg")
-        jupyter_url = f'{JUPYTER_ROOT}/{Path(dir_output).parts[-2]}/{Path(dir_output).parts[-1]}'
-        stats_url = f'{jupyter_url.replace("/tree", "/edit", 1)}/{h.get_stats_filename(h.get_artifacts_prefix(dir1))}'
-
-        href = f"window.location.href='{coreg_url}';"
-        html = f'<a href="{jupyter_url}" target="_blank">Co-registration results</a>' + \
-               (f'<br/><br/><a href="{stats_url}" target="_blank">Co-registration stats</a>'
-                    if coreg_type == '--basic' else '') + \
-               f'<br/><br/><button onclick = "{href}">Run again</button>'
-        yield html.encode()  # sys.stdout.encoding
-
-    #print(request.args.get('dir1'), request.args.get('dir1_mission'), request.args.get('dir2'), request.args.get('dir_output'))
-    #print(request.args.get('num_proc'))
-    return app.response_class(stream_with_context(inner(
-                                    request.args.get('dir1'),
-                                    request.args.get('dir1_mission'),
-                                    request.args.get('dir1_camera'),
-                                    request.args.get('dir2'),
-                                    request.args.get('dir_output'),
-                                    request.args.get('num_proc'),
-                                    request.args.get('coreg_type'),
-                                    request.args.get('filter_cn')
-                                    #request.args.get('coreg_config'),
-                                    #request.args.get('scale')
-    )), mimetype='text/html')
+                yield f'id: {n}\ndata: {line}\n\n'
+        yield f'event: end\ndata: {json.dumps(dict(job.state, links=job_links(job)))}\n\n'
+
+    return app.response_class(stream_with_context(inner()), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route("/coreg", methods=["GET", "POST"])
 def coreg():
     form = CoregForm()
-    print(url_for("coreg_log"))
-    form.dir1.choices = sorted(Path(OLD_MISSIONS_PATH).glob('*'))
-    form.dir2.choices = sorted(Path(LROC_MISSION_PATH).glob('*'))
-    form.dir_output.choices = sorted(Path(OUTPUT_PATH).glob('*'))
+    inputs = get_catalog().inputs()
+    form.dir1.choices = inputs['old_missions']
+    form.dir2.choices = inputs['lroc']
+    form.dir_output.choices = inputs['outputs']
     #form.coreg_config.choices = sorted(Path(COREG_CONFIG).glob('*'))
 
     if form.validate_on_submit():
-        # run co-registration with chosen params amd show the CLI tool running progress
-        return redirect(url_for("coreg_log",
-                                dir1=form.dir1.data,
-                                dir1_mission=form.dir1_mission.data,
-                                dir1_camera=form.dir1_camera.data,
-                                dir2=form.dir2.data,
-                                dir_output=form.dir_output.data,
-                                num_proc=form.num_proc.data,
-                                coreg_type=form.coreg_type.data,
-                                filter_cn=form.filter_cn.data,
-                                #coreg_config=form.coreg_config.data,
-                                #scale=form.scale.data
-                                ))
+        # queue co-registration with chosen params amd show the CLI tool running progress
+        return submit_coreg({key: str(getattr(form, key).data) for key in COREG_PARAMS})
     # main form
     return render_template(
         "coreg.html",
@@ -178,14 +227,45 @@ def coreg():
         jupyter_url=JUPYTER_ROOT
     )
 
+def api_page(items):
+    """ Page of the items by 'page' and 'per_page' args """
+    per_page = min(request.args.get('per_page', API_PAGE_SIZE, type=int), API_MAX_PAGE_SIZE)
+    return jsonify(catalog.paginate(items, request.args.get('page', 1, type=int), per_page))
+
+
+@app.route("/api/inputs")
+def api_inputs():
+    """ Input folders (old missions, LROC) and output folders """
+    return jsonify(get_catalog().inputs())
+
+
+@app.route("/api/outputs")
+def api_outputs():
+    """ Output folders with results overview, filtered by 'folder' substring """
+    folder = request.args.get('folder', '').lower()
+    return api_page([output for output in get_catalog().outputs() if folder in output['folder'].lower()])
+
+
+@app.route("/api/results")
+def api_results():
+    """
+    Co-registration results: per-pair records of advanced co-registration, per-image records of basic one.
+    Args: filters (see catalog.Catalog.query), 'sort' field, 'order' (asc/desc), 'page', 'per_page'
+    """
+    filters = {key: value for key, value in request.args.items() if key not in ['sort', 'order', 'page', 'per_page']}
+    try:
+        records = get_catalog().query(filters, request.args.get('sort'), request.args.get('order') == 'desc')
+    except ValueError as ex:
+        return jsonify({'error': str(ex)}), 400
+    return api_page(records)
+
+
 @app.route("/files")
 def list_files():
-    """Endpoint to list files on the server."""
-    files = []
-    for filename in os.listdir('.'):
-        path = os.path.join('.', filename)
-        if os.path.isfile(path):
-            files.append(filename)
+    """ Files of the output folder ('folder' arg) """
+    files = get_catalog().files(request.args.get('folder', ''))
+    if files is None:
+        abort(404)
     return jsonify(files)
 
 
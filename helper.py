@@ -2,11 +2,17 @@
 import shutil
 import pathlib
 import os
+import re
+import json
+import fcntl
+import struct
+import numpy as np
 import pandas as pd
-import kalasiris as isis
+from profiling import isis
 from pathlib import Path
 
 import pvl
+import pancam
 
 ## constants used by the tool
 DELETE_INTERMEDIATE_FILES = True
@@ -19,11 +25,47 @@ pointreg_template = './config/pointreg_00.def'
 QL_THRESHOLD = 0.5
 QL_THRESHOLD_ADV = 0.7
 MODIFIED_ZSCORE_THRESH = 3.
+# coreg control network outliers filtering (see zscore.outliers)
+OUTLIER_MODEL = 'mad'
+IQR_COEFF = 1.5
+RANSAC_THRESH = 1.  # pixels of the reduced cubes
+RANSAC_ITERATIONS = 200
+RANSAC_SAMPLE = 10000  # points scoring RANSAC hypotheses
+STATS_CHUNK_ROWS = 100000  # pointreg flatfile rows aggregated at once by goodness_of_fit_basic_coreg
+
+# preprocessing cache (default size limit in GB, see cache.py)
+PREPROCESS_CACHE_SIZE = 200.
+
+# preprocessing engine (--preprocess_engine): ISIS reduce / histeq programs or in-process streaming ones (see downscale.py)
+PREPROCESS_ENGINES = ['isis', 'numpy']
+PREPROCESS_ENGINE = 'isis'
+REDUCE_VALID_PERCENT = 50.  # reduced pixel is Null if less percent of its input pixels are valid (as ISIS reduce VPER)
+HISTEQ_PERCENTS = (0.5, 99.5, 1.)  # minimum, maximum percent and increment of histeq stretch (ISIS histeq MINPER, MAXPER, INCREMENT defaults)
+HISTEQ_BINS = 65536  # histogram bins of histeq over the valid range of integer cubes
+STREAM_BLOCK_BYTES = 2 ** 26  # input pixels (as float64) reduced at once by the numpy engine
 
 # advanced coreg
 scale = 20
 coreg_config = './config.adv/coreg.maxcor_x20_0.6_40-80_250-500.def'
 transform = 'translate'  # 'wrap'
+# coreg engine (--engine): ISIS 'coreg' program or in-process FFT normalized cross-correlation matcher (see ncc.py)
+COREG_ENGINES = ['isis', 'numpy']
+COREG_ENGINE = 'isis'
+NCC_BATCH_POINTS = 16  # chips correlated at once by the numpy engine (memory is about 12 search chip spectra per point)
+NCC_FFT_WORKERS = 1  # FFT threads of the numpy engine (pairs are co-registered by --num_proc processes already)
+# coarse-to-fine advanced coreg (--pyramid): finer levels (scale, coreg config) following the --scale level
+PYRAMID_LEVELS = [(10, './config.adv/coreg.maxcor_x10_0.6_80-160_500-1000.def'),
+                  (5, './config.adv/coreg.maxcor_x5_0.6_160-320_1000-2000.def')]
+PYRAMID_SEARCH_MARGIN = 4  # pixels of the coarser level searched around the seeded position
+# coreg config auto-tuning (--auto_tune, see autotune.py): a config is accepted when both thresholds are passed
+AUTO_TUNE_MIN_GOF = QL_THRESHOLD_ADV
+AUTO_TUNE_MIN_POINTS = 20
+AUTO_TUNE_HISTORY = 'auto_tune.json'  # configs which co-registered pairs, by pair kind (default is in the output folder)
+ADV_COREG_SUMMARY = 'adv_coreg_summary.csv'
+PROFILE_TRACE = 'profile.jsonl'  # ISIS calls trace written with --profile option
+RUN_MANIFEST = 'manifest.jsonl'  # completed stages of the run, used by --resume (see manifest.py)
+MEMO_FOLDER = '.memo'  # fingerprints of memoized intermediate artifacts (see produce_once)
+FOOTPRINT_MIN_OVERLAP = 0.  # pairs with footprints overlap fraction not above it are not co-registered
 
 # missions
 lunar_missions_acronyms = ['apollo15', 'apollo16', 'apollo17', 'chandrayaan1', 'clementine1', 'kaguya', 'lo', 'lro', 'smart1']
@@ -34,6 +76,16 @@ apollo_pan_file_types = ['.jp2', '.JP2', '.cub', '.CUB']
 lo_file_types = ['.img', '.IMG', '.cub', ', .CUB']  #'.lbl', '.LBL',
 lroc_file_types = ['.img', '.IMG', '.cub', '.CUB']
 
+# bytes per pixel for ISIS cube pixel types
+cub_pixel_bytes = {'UnsignedByte': 1, 'SignedWord': 2, 'UnsignedWord': 2, 'SignedInteger': 4, 'UnsignedInteger': 4, 'Real': 4}
+
+# resources model and budgets (GB) for parallel Apollo panoramic images preprocessing
+# (budgets by default are 80% of physical memory and 90% of free disk space in the output folder)
+PAN_RAM_BASE = 1.
+PAN_RAM_FRACTION = 0.25
+PAN_RAM_BUDGET = None
+PAN_DISK_BUDGET = None
+
 # isis parameters
 isis_linc = 15  # The accuracy of camstats in the line direction (larger is less accurate)
 isis_sinc = 15  # The accuracy of camstats in the sample direction (larger is less accurate)
@@ -80,6 +132,96 @@ def delete_files_with_ckeck(file_lst, output_folder):
                 file.unlink()
 
 
+def artifact_fingerprint(sources, **params):
+    """ Fingerprint of an intermediate artifact: its source files (path, size, mtime) and parameters """
+    sources_info = []
+    for source in sources:
+        stat = Path(source).stat()
+        sources_info.append([str(Path(source).resolve()), stat.st_size, stat.st_mtime_ns])
+    return json.dumps({'sources': sources_info, 'params': params}, sort_keys=True, default=str)
+
+
+def produce_once(artifact, produce, sources, **params):
+    """
+    Memoize intermediate artifact (like reduced or matched cube) within the output folder.
+    'produce(artifact)' is called only if the artifact is missing or was produced from other sources
+    or parameters. Concurrent workers asking for the same artifact wait for the first one to produce it
+    """
+    artifact = Path(artifact)
+    memo_folder = artifact.parent / MEMO_FOLDER
+    memo_folder.mkdir(exist_ok=True)
+    memo_path = memo_folder / f'{artifact.name}.json'
+    fingerprint = artifact_fingerprint(sources, **params)
+
+    with open(memo_folder / f'{artifact.name}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if artifact.exists() and memo_path.exists() and memo_path.read_text() == fingerprint:
+            print(f'--> [INFO] Reusing {artifact.name}')
+            return artifact
+
+        if memo_path.exists():
+            memo_path.unlink()
+        produce(artifact)
+        memo_path.write_text(fingerprint)
+
+    return artifact
+
+
+def pyramid_levels(coreg_config, scale):
+    """ Levels (scale, coreg config) of coarse-to-fine co-registration starting with ('scale', 'coreg_config') """
+    return [(scale, Path(coreg_config))] + [(level_scale, Path(level_config))
+                                            for level_scale, level_config in PYRAMID_LEVELS if level_scale < scale]
+
+
+def coreg_config_group(coreg_config, group):
+    """ Keywords of the group ('Algorithm', 'PatternChip', 'SearchChip', 'SurfaceModel') of coreg definition file """
+    keywords = {}
+    in_group = False
+    for line in Path(coreg_config).read_text().splitlines():
+        line = line.split('#')[0].strip()
+        if re.fullmatch(rf'Group\s*=\s*{group}', line, re.IGNORECASE):
+            in_group = True
+        elif in_group and re.fullmatch(r'End_?Group', line, re.IGNORECASE):
+            break
+        elif in_group and '=' in line:
+            key, value = [s.strip() for s in line.split('=', 1)]
+            keywords[key] = value
+    return keywords
+
+
+def coreg_chip_size(coreg_config, chip):
+    """ (Samples, Lines) of 'PatternChip' or 'SearchChip' group of coreg definition file """
+    keywords = coreg_config_group(coreg_config, chip)
+    return int(keywords['Samples']), int(keywords['Lines'])
+
+
+def write_narrowed_coreg_config(coreg_config, output_path, margin):
+    """
+    Write coreg definition file with the search chip narrowed to the pattern chip extended by 'margin' pixels
+    on every side (but not larger than the original search chip). Returns search chip (Samples, Lines)
+    """
+    pattern_size = coreg_chip_size(coreg_config, 'PatternChip')
+    search_size = coreg_chip_size(coreg_config, 'SearchChip')
+    size = dict(zip(['Samples', 'Lines'], [min(p + 2 * margin, s) for p, s in zip(pattern_size, search_size)]))
+
+    lines = []
+    in_group = False
+    for line in Path(coreg_config).read_text().splitlines():
+        code = line.split('#')[0].strip()
+        if re.fullmatch(r'Group\s*=\s*SearchChip', code, re.IGNORECASE):
+            in_group = True
+        elif in_group and re.fullmatch(r'End_?Group', code, re.IGNORECASE):
+            in_group = False
+        elif in_group and re.match(r'(Samples|Lines)\s*=', code):
+            key = code.split('=')[0].strip()
+            line = re.sub(r'=\s*\d+', f'= {size[key]}', line)
+        lines.append(line)
+
+    Path(output_path).write_text('\n'.join(lines) + '\n')
+    return size['Samples'], size['Lines']
+
+
 def str_to_tuple(tuple_str):
     """ Convert "(a, b)" string to tuple (a, b) """
     return tuple(tuple_str.strip('() ').split(','))
@@ -99,15 +241,10 @@ def get_stats_filename(artifacts_prefix, template=pointreg_template, index=None)
 
 def get_apollo_pan_params(image_name_wo_ext, mission):
     """ Get parameters for specific Apollo panoramic image """
-    pan_params = pd.read_csv(apollo_pan_csv[mission])
-    #utc_time, nadir_point(lat, lon), spacecraft_altitude, camera_axis_intersect(lon, lat)
-    pan_params = pan_params[['image_name', 'utc_time', 'nadir_point', 'spacecraft_altitude', 'camera_axis_intersect']]
-    param_dict = pan_params[pan_params['image_name'] == str(image_name_wo_ext).upper()].iloc[0].to_dict()
+    #utc_time, nadir_point(lat, lon), spacecraft_altitude, camera_axis_intersect(lon, lat), photo footprints
+    param_dict = pancam.get_store(apollo_pan_csv[mission]).get(image_name_wo_ext)
 
     param_dict['gmt'] = param_dict['utc_time'] #'"' + param_dict['utc_time'] + '"'
-    param_dict['lat_nadir'], param_dict['lon_nadir'] = str_to_tuple(param_dict['nadir_point'])
-    # order of (lat, lon) in tuple is different here - it's not a bug
-    param_dict['lon_int'], param_dict['lat_int'] = str_to_tuple(param_dict['camera_axis_intersect'])
     # constant to all Apollo panoramic images
     param_dict['microns'] = 5
 
@@ -120,6 +257,71 @@ def get_apollo_pan_params(image_name_wo_ext, mission):
     return param_dict
 
 
+def get_jp2_dimensions(image_path):
+    """ (samples, lines, bands, bytes per pixel) from the JPEG2000 image header ('ihdr' box) """
+    with open(image_path, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        while f.tell() < end:
+            box_start = f.tell()
+            box_len, box_type = struct.unpack('>I4s', f.read(8))
+            if box_len == 1:
+                box_len = struct.unpack('>Q', f.read(8))[0]
+            elif box_len == 0:
+                box_len = end - box_start
+            elif box_len < 8:
+                break
+
+            if box_type == b'jp2h':
+                # header superbox - continue with its children
+                continue
+            if box_type == b'ihdr':
+                height, width, bands, bpc = struct.unpack('>IIHB', f.read(11))
+                return width, height, bands, ((bpc & 0x7f) + 8) // 8
+            f.seek(box_start + box_len)
+
+    raise MetadataError(image_path, f'JPEG2000 image header is not found in {image_path}')
+
+
+def get_cub_dimensions(image_cube):
+    """ (samples, lines, bands, bytes per pixel) from the ISIS cube label """
+    with open(image_cube, 'rb') as f:
+        label = f.read(65536).decode('ascii', errors='ignore')
+
+    dims = [re.search(rf'\b{key}\s*=\s*(\d+)', label) for key in ['Samples', 'Lines', 'Bands']]
+    pixel_type = re.search(r'\bType\s*=\s*(\w+)', label)
+    if not all(dims) or not pixel_type:
+        raise MetadataError(image_cube, f'Cube dimensions are not found in {image_cube} label')
+
+    return (*[int(d.group(1)) for d in dims], cub_pixel_bytes.get(pixel_type.group(1), 4))
+
+
+def estimate_pan_preprocess_resources(image_path, scale=20, engine=PREPROCESS_ENGINE):
+    """
+    Estimated peak (RAM, disk) in bytes for Apollo panoramic image preprocessing.
+    Disk is the imported full size cube plus reduced and equalized ones; RAM is modelled
+    by PAN_RAM_BASE and PAN_RAM_FRACTION of the full size cube. The numpy engine writes
+    the equalized cube only and its RAM does not depend on the cube size
+    """
+    image_path = Path(image_path)
+    try:
+        if image_path.suffix.lower() == '.cub':
+            samples, lines, bands, pixel_bytes = get_cub_dimensions(image_path)
+        else:
+            samples, lines, bands, pixel_bytes = get_jp2_dimensions(image_path)
+    except (MetadataError, struct.error) as ex:
+        # unknown size - the image will be preprocessed alone
+        print(f'[INFO] Unable to estimate resources for {image_path}: {getattr(ex, "message", ex)}')
+        return float('inf'), float('inf')
+
+    cube_bytes = samples * lines * bands * pixel_bytes
+    if engine == 'numpy':
+        # a block of input lines, its special pixels mask and reduced sums
+        return int(PAN_RAM_BASE * 2 ** 30 + 4 * STREAM_BLOCK_BYTES), int(cube_bytes * (1 + 1 / scale ** 2))
+    disk = int(cube_bytes * (1 + 2 / scale ** 2))
+    ram = int(PAN_RAM_BASE * 2 ** 30 + PAN_RAM_FRACTION * cube_bytes)
+    return ram, disk
+
+
 def check_cub_metadata(image_cube):
     is_metadata_valid = True
     message = ''
@@ -140,6 +342,53 @@ def check_cub_metadata(image_cube):
     return is_metadata_valid, message
 
 
+def get_footprint_bbox(image_cube, output_folder):
+    """
+    Footprint of the cube as (min_lat, max_lat, min_lon, max_lon) bounding box, based on camstats.
+    NaNs are returned if the footprint can't be calculated
+    """
+    camstats_pvl = Path(output_folder) / f'{Path(image_cube).name}.camstats.pvl'
+    try:
+        isis.camstats(from_=image_cube, to_=camstats_pvl, sinc=isis_sinc, linc=isis_linc)
+        bbox = tuple(float(isis.getkey_k(camstats_pvl, group=group, key=key))
+                     for group, key in [('Latitude', 'LatitudeMinimum'),
+                                        ('Latitude', 'LatitudeMaximum'),
+                                        ('PositiveEast Longitude', 'PositiveEast360LongitudeMinimum'),
+                                        ('PositiveEast Longitude', 'PositiveEast360LongitudeMaximum')])
+    except Exception as ex:
+        print(f'--> [INFO] Unable to calculate footprint of {image_cube}: {getattr(ex, "stderr", ex)}')
+        bbox = (np.nan,) * 4
+    finally:
+        if camstats_pvl.exists():
+            camstats_pvl.unlink()
+
+    return bbox
+
+
+def footprint_overlap(bboxes_a, bboxes_b):
+    """
+    Overlap fraction for all pairs of (min_lat, max_lat, min_lon, max_lon) footprints: intersection area
+    divided by the smaller footprint area. Footprints crossing 0/360 longitude are treated as covering
+    all longitudes. NaN is returned for unknown footprints
+    """
+    a = np.array(bboxes_a, dtype=np.float64).reshape(-1, 4)[:, None, :]
+    b = np.array(bboxes_b, dtype=np.float64).reshape(-1, 4)[None, :, :]
+
+    def lon_range(bbox):
+        crosses_meridian = (bbox[..., 3] - bbox[..., 2]) > 180
+        return np.where(crosses_meridian, 0., bbox[..., 2]), np.where(crosses_meridian, 360., bbox[..., 3])
+
+    (a_lon_min, a_lon_max), (b_lon_min, b_lon_max) = lon_range(a), lon_range(b)
+    lat_overlap = np.minimum(a[..., 1], b[..., 1]) - np.maximum(a[..., 0], b[..., 0])
+    lon_overlap = np.minimum(a_lon_max, b_lon_max) - np.maximum(a_lon_min, b_lon_min)
+    intersection = np.clip(lat_overlap, 0, None) * np.clip(lon_overlap, 0, None)
+
+    area_a = (a[..., 1] - a[..., 0]) * (a_lon_max - a_lon_min)
+    area_b = (b[..., 1] - b[..., 0]) * (b_lon_max - b_lon_min)
+    min_area = np.maximum(np.minimum(area_a, area_b), np.finfo(np.float64).tiny)
+    return intersection / min_area
+
+
 def get_artifacts_prefix(path):
     if path:
         return Path(path).name
@@ -147,32 +396,53 @@ def get_artifacts_prefix(path):
         return ''
 
 
-def goodness_of_fit_basic_coreg(stats_file):
+def goodness_of_fit_basic_coreg(stats_file, chunk_rows=STATS_CHUNK_ROWS):
     """
-    Collect statistics for basic co-registration
+    Collect statistics for basic co-registration in a single pass over the pointreg flatfile,
+    reading it in chunks of 'chunk_rows' rows (memory usage does not depend on the file size).
+    The original flatfile is kept as '.initial.csv', '.final.csv' (without units line) and the trimmed stats
+    file are written in the same pass. Per-image statistics are saved to '.images.csv' and returned as well
     """
-    shutil.copy(stats_file, stats_file + '.initial.csv')
+    initial_file = stats_file + '.initial.csv'
+    os.replace(stats_file, initial_file)
+
+    images = None
+    columns = 'PointId,Filename,MeasureType,GoodnessOfFit'.split(',')
+    with open(stats_file + '.final.csv', 'wt') as f_final, open(stats_file, 'wt') as f_stats:
+        for i, df_chunk in enumerate(pd.read_csv(initial_file, skiprows=[1], chunksize=chunk_rows)):
+            df_chunk.to_csv(f_final, index=False, header=(i == 0), na_rep='NA')
+            df_chunk[columns].to_csv(f_stats, index=False, header=(i == 0), na_rep='NA')
+
+            gof = df_chunk['GoodnessOfFit']
+            chunk_images = pd.DataFrame({'measures': gof.isna().groupby(df_chunk['Filename']).size(),
+                                         'gof_count': gof.groupby(df_chunk['Filename']).count(),
+                                         'gof_sum': gof.groupby(df_chunk['Filename']).sum(),
+                                         'below_threshold': (gof < QL_THRESHOLD).groupby(df_chunk['Filename']).sum()})
+            images = chunk_images if images is None else images.add(chunk_images, fill_value=0)
 
-    df_stats = pd.read_csv(stats_file, skiprows=[1])
-    df_stats.to_csv(stats_file + '.final.csv', index=False, na_rep='NA')
-    df_stats['PointId,Filename,MeasureType,GoodnessOfFit'.split(',')].to_csv(stats_file, index=False, na_rep='NA')
+    if images is None:
+        images = pd.DataFrame(columns=['measures', 'gof_count', 'gof_sum', 'below_threshold'])
+    images.index.name = 'Filename'
 
-    gof_mean = df_stats['GoodnessOfFit'].mean(skipna=True)
-    ql_of_uncertainty = (
-            df_stats.loc[df_stats['GoodnessOfFit'] < QL_THRESHOLD, 'GoodnessOfFit'].count() / df_stats['GoodnessOfFit'].count())
-    return gof_mean, ql_of_uncertainty
+    total = images.sum()
+    gof_mean = total['gof_sum'] / total['gof_count'] if total['gof_count'] else np.nan
+    ql_of_uncertainty = total['below_threshold'] / total['gof_count'] if total['gof_count'] else np.nan
 
+    images['gof_mean'] = images['gof_sum'] / images['gof_count']
+    images['ql_of_uncertainty'] = images['below_threshold'] / images['gof_count']
+    images = images.drop(columns='gof_sum').astype({'measures': int, 'gof_count': int, 'below_threshold': int})
+    images.to_csv(stats_file + '.images.csv', na_rep='NA')
 
-def goodness_of_fit_adv_coreg(stats_file, interim_pvl_path, scale):
+    return gof_mean, ql_of_uncertainty, images
+
+
+def goodness_of_fit_adv_coreg(stats: 'pvl.CoregStats', interim_pvl_path, scale):
     """
-    Collect statistics for advanced co-registration
+    Collect statistics for advanced co-registration (filtered points are excluded)
     """
-    df_stats = pd.read_csv(stats_file)
-    if 'Filtered' in df_stats.columns:
-        df_stats = df_stats[df_stats['Filtered'] != 1]
-
-    gof_mean = df_stats['GoodnessOfFit'].mean(skipna=True)
-    ql_of_uncertainty = df_stats[['SampleDifference', 'LineDifference']].std(ddof=0) * scale / 2.
+    gof_mean = np.nanmean(stats.column('GoodnessOfFit', filtered=False))
+    ql_of_uncertainty = [np.nanstd(stats.column(name, filtered=False)) * scale / 2.
+                         for name in ['SampleDifference', 'LineDifference']]
 
     # cnt_ignored = pvl.count_ignored(interim_pvl_path)
     # cnt_total = df_stats['GoodnessOfFit'].count()
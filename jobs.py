@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import json
+import time
+import uuid
+import queue
+import pathlib
+import threading
+import subprocess
+from typing import List, Dict, Any, Iterator, Tuple, Union
+
+# job statuses
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+INTERRUPTED = 'interrupted'  # the server was stopped while the job was running
+FINAL_STATUSES = [DONE, FAILED, INTERRUPTED]
+
+
+class Job:
+    """
+    Background run of a command. Job state is persisted to '<id>.json' and command output to '<id>.log'
+    in the jobs folder, so jobs survive server restarts and their output can be followed from any line
+    """
+
+    def __init__(self, jobs_dir: pathlib.Path, state: Dict[str, Any]):
+        self.jobs_dir = jobs_dir
+        self.state = state
+        # notified on every output line and state change
+        self.changed = threading.Condition()
+
+    @property
+    def id(self) -> str:
+        return self.state['id']
+
+    @property
+    def status(self) -> str:
+        return self.state['status']
+
+    @property
+    def state_path(self) -> pathlib.Path:
+        return self.jobs_dir / f'{self.id}.json'
+
+    @property
+    def log_path(self) -> pathlib.Path:
+        return self.jobs_dir / f'{self.id}.log'
+
+    def save(self):
+        temp_path = self.state_path.with_suffix('.json.tmp')
+        temp_path.write_text(json.dumps(self.state, indent=2))
+        temp_path.replace(self.state_path)
+
+    def update(self, **state):
+        with self.changed:
+            self.state.update(state)
+            self.save()
+            self.changed.notify_all()
+
+    def append(self, log, line: str):
+        """ Append output line to the job log (opened by the worker) """
+        with self.changed:
+            log.write(line if line.endswith('\n') else line + '\n')
+            log.flush()
+            self.changed.notify_all()
+
+    def lines(self, start=0, keepalive=15.) -> Iterator[Tuple[Union[int, None], Union[str, None]]]:
+        """
+        Output lines (line number, line) from line 'start', following the output of a running job until it ends.
+        Readers wait for new lines (no polling); (None, None) is yielded if there is no output for 'keepalive' seconds
+        """
+        n = 0
+        with open(self.log_path, 'rt') as f:
+            while True:
+                # lines are written and read under the lock, so a partially written line is never read
+                with self.changed:
+                    new_lines = f.readlines()
+                    if not new_lines and self.status not in FINAL_STATUSES:
+                        self.changed.wait(keepalive)
+                        new_lines = f.readlines()
+                    finished = self.status in FINAL_STATUSES
+
+                for line in new_lines:
+                    if n >= start:
+                        yield n, line.rstrip('\n')
+                    n += 1
+
+                if not new_lines:
+                    if finished:
+                        return
+                    yield None, None
+
+
+class JobManager:
+    """
+    Bounded queue of jobs run by a pool of 'max_running' worker threads (concurrency limit).
+    Jobs which were queued when the server stopped are queued again, running ones are marked as interrupted
+    """
+
+    def __init__(self, jobs_dir, max_running=1, max_queued=10, cwd=None):
+        self.jobs_dir = pathlib.Path(jobs_dir)
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self.cwd = cwd
+        self.queue = queue.Queue(max_queued)
+        self.jobs: Dict[str, Job] = {}
+
+        self.recover()
+        for _ in range(max_running):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def recover(self):
+        for state_path in sorted(self.jobs_dir.glob('*.json')):
+            try:
+                job = Job(self.jobs_dir, json.loads(state_path.read_text()))
+            except (OSError, json.JSONDecodeError):
+                continue
+            self.jobs[job.id] = job
+
+            if job.status == RUNNING:
+                job.update(status=INTERRUPTED, finished=time.time())
+            elif job.status == QUEUED:
+                try:
+                    self.queue.put_nowait(job)
+                except queue.Full:
+                    job.update(status=INTERRUPTED, finished=time.time())
+
+    def submit(self, command: List[str], params: Dict[str, Any] = None) -> Job:
+        """ Queue the command. Raises queue.Full if the queue is full """
+        job = Job(self.jobs_dir, {
+            'id': f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}',
+            'command': command,
+            'params': params or {},
+            'status': QUEUED,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'returncode': None,
+        })
+        job.log_path.touch()
+        job.save()
+
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            job.state_path.unlink()
+            job.log_path.unlink()
+            raise
+
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id) -> Union[Job, None]:
+        return self.jobs.get(job_id)
+
+    def states(self) -> List[Dict[str, Any]]:
+        """ States of all jobs, the latest first """
+        return sorted((job.state for job in self.jobs.values()), key=lambda state: state['created'], reverse=True)
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self.run(job)
+            finally:
+                self.queue.task_done()
+
+    def run(self, job: Job):
+        job.update(status=RUNNING, started=time.time())
+        with open(job.log_path, 'at') as log:
+            try:
+                proc = subprocess.Popen(job.state['command'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        text=True, bufsize=1, cwd=self.cwd)
+                for line in proc.stdout:
+                    job.append(log, line)
+                returncode = proc.wait()
+            except OSError as ex:
+                job.append(log, f'[ERROR] Unable to run the job: {ex}')
+                returncode = -1
+
+        job.update(status=DONE if returncode == 0 else FAILED, returncode=returncode, finished=time.time())
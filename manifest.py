@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import os
+import json
+import fcntl
+import pathlib
+from typing import Callable, Dict, Hashable, Any, List
+
+import helper as h
+import scheduler
+
+
+def record_key(key: Hashable) -> str:
+    return json.dumps(key, default=str)
+
+
+def artifact_info(path) -> Dict[str, Any]:
+    stat = pathlib.Path(path).stat()
+    return {'path': str(pathlib.Path(path).resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def artifacts_valid(artifacts: List[Dict[str, Any]]) -> bool:
+    """ Artifacts still exist and were not modified since they were recorded """
+    try:
+        return all(artifact_info(a['path']) == a for a in artifacts)
+    except OSError:
+        return False
+
+
+def result_artifacts(result) -> List:
+    """ Files produced by a stage: the preprocessed cube, or 'artifacts' of the pair summary """
+    if isinstance(result, (str, pathlib.Path)):
+        return [result]
+    if isinstance(result, dict):
+        return result.get('artifacts', [])
+    return []
+
+
+def result_failed(result) -> bool:
+    return isinstance(result, dict) and result.get('status') == 'error'
+
+
+def start(output_folder, resume=False) -> pathlib.Path:
+    """ Path of the run manifest in the output folder. A new run (not resumed one) starts an empty manifest """
+    manifest_path = pathlib.Path(output_folder).resolve() / h.RUN_MANIFEST
+    if not resume or not manifest_path.exists():
+        manifest_path.write_text('')
+    return manifest_path
+
+
+def load(manifest_path) -> Dict[str, Dict[str, Any]]:
+    """ Manifest records by stage key, the last record of a stage wins """
+    records = {}
+    with open(manifest_path, 'rt') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the line being written when the run was killed
+                continue
+            records[record['key']] = record
+    return records
+
+
+def append(manifest_path, record: Dict[str, Any]):
+    with open(manifest_path, 'at') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+class Checkpoint:
+    """
+    Task function (see scheduler.Task) recording its completion in the run manifest: stage key,
+    fingerprint of the inputs (source files and parameters), result and produced artifacts.
+    Source files are 'sources' and the first 'source_args' positional arguments (results of dependencies)
+    """
+
+    def __init__(self, manifest_path: pathlib.Path, key: Hashable, func: Callable, sources=(), source_args=0, **params):
+        self.manifest_path = manifest_path
+        self.key = key
+        self.func = func
+        self.sources = list(sources)
+        self.source_args = source_args
+        self.params = params
+
+    def fingerprint(self, args) -> str:
+        return h.artifact_fingerprint(self.sources + list(args[:self.source_args]), **self.params)
+
+    def __call__(self, *args):
+        fingerprint = self.fingerprint(args)
+        result = self.func(*args)
+
+        if not result_failed(result):
+            append(self.manifest_path, {
+                'key': record_key(self.key),
+                'pid': os.getpid(),
+                'fingerprint': fingerprint,
+                'result': result,
+                'artifacts': [artifact_info(path) for path in result_artifacts(result)],
+            })
+        return result
+
+    def completed(self, record: Dict[str, Any], args) -> bool:
+        """ The recorded stage is done with the same inputs and its artifacts are still valid """
+        try:
+            fingerprint = self.fingerprint(args)
+        except OSError:
+            return False
+        return record['fingerprint'] == fingerprint and artifacts_valid(record['artifacts'])
+
+
+def completed_results(tasks: Dict[Hashable, scheduler.Task], manifest_path) -> Dict[Hashable, Any]:
+    """
+    Results of checkpointed tasks completed by the previous run. A task is completed if its record
+    is valid and all its dependencies are completed, so stale work is redone with everything depending on it
+    """
+    records = load(manifest_path)
+    done = {}
+
+    changed = True
+    while changed:
+        changed = False
+        for key, task in tasks.items():
+            if key in done or not isinstance(task.func, Checkpoint) or any(dep not in done for dep in task.deps):
+                continue
+            record = records.get(record_key(key))
+            if record and task.func.completed(record, [done[dep] for dep in task.deps]):
+                done[key] = record['result']
+                changed = True
+
+    return done
@@ -4,12 +4,19 @@ import pathlib
 import shutil
 import time
 from typing import List, Tuple, Dict, TextIO, Any, Union
+import numpy as np
+import pandas as pd
 
-import kalasiris as isis
+from profiling import isis
 import helper as h
 import pvl
+import autotune
+import ncc
+import downscale
+from cache import cached_preprocess
 
-def lo_img_preprocess(image, output_folder, coreg_type):
+@cached_preprocess
+def lo_img_preprocess(image, output_folder, coreg_type, scratch_folder=None):
     """ The passed image label is used for image preprocessing before co-registration"""
     # image name without extension
     image_name = h.filename_frompath_noext(image)  # os.path.basename(image)  #
@@ -62,11 +69,15 @@ def lo_img_preprocess(image, output_folder, coreg_type):
     return image_cube_heq
 
 
-def apollo_img_preprocess(image, output_folder, coreg_type, mission='apollo15'):
+@cached_preprocess
+def apollo_img_preprocess(image, output_folder, coreg_type, mission='apollo15', scratch_folder=None,
+                          preprocess_engine=h.PREPROCESS_ENGINE):
     """ The passed image label is used for image preprocessing before co-registration"""
+    # intermediate cubes are written to the scratch folder, the preprocessed one to the output folder
+    scratch_folder = scratch_folder or output_folder
     # image name without extension
     image_name = h.filename_frompath_noext(image)  # os.path.basename(image)  #
-    image_cube = os.path.join(output_folder, image_name + '.cub')
+    image_cube = os.path.join(scratch_folder, image_name + '.cub')
     #image_cube = os.path.join(output_folder, os.path.basename(image) + '.cub')
 
     print('--> [INFO] Importing image: ', image)
@@ -94,8 +105,9 @@ def apollo_img_preprocess(image, output_folder, coreg_type, mission='apollo15'):
     isis.apollofindrx(from_=image_cube, tolerance=0.01)
 
     print('--> [INFO] Warping')
-    image_cube_warp = os.path.join(output_folder, image_name + '.warped.cub')
+    image_cube_warp = os.path.join(scratch_folder, image_name + '.warped.cub')
     isis.apollowarp(from_=image_cube, to=image_cube_warp)
+    h.delete_files_with_ckeck([image_cube], scratch_folder)
 
     image_cube_cal = os.path.join(output_folder, image_name + '.warped.cal.cub')
     if mission == 'apollo15':
@@ -105,7 +117,11 @@ def apollo_img_preprocess(image, output_folder, coreg_type, mission='apollo15'):
     else:
         # do histogram equalization for other missions
         print('--> [INFO] Histogram initialization')
-        isis.histeq(from_=image_cube_warp, to=image_cube_cal)
+        if preprocess_engine == 'numpy':
+            downscale.reduce_cube(image_cube_warp, image_cube_cal, histeq=True)
+        else:
+            isis.histeq(from_=image_cube_warp, to=image_cube_cal)
+    h.delete_files_with_ckeck([image_cube_warp], scratch_folder)
 
     if coreg_type == 'basic':
         print('--> [INFO] Calculating camstats')
@@ -113,15 +129,16 @@ def apollo_img_preprocess(image, output_folder, coreg_type, mission='apollo15'):
         print('--> [INFO] Initializing footprints')
         isis.footprintinit(from_=image_cube_cal, sinc=h.isis_sinc_foot, linc=h.isis_linc_foot)
 
-    h.delete_files_with_ckeck([image_cube, image_cube_warp], output_folder)
-
     return image_cube_cal
 
 
-def lro_img_preprocess(image, output_folder, coreg_type):
+@cached_preprocess
+def lro_img_preprocess(image, output_folder, coreg_type, scratch_folder=None):
     """ The passed image is used for image preprocessing before co-registration"""
+    # intermediate cubes are written to the scratch folder, the preprocessed one to the output folder
+    scratch_folder = scratch_folder or output_folder
     image_name = h.filename_frompath_noext(image)  # os.path.basename(image)  #
-    image_cube = os.path.join(output_folder, image_name + '.cub')
+    image_cube = os.path.join(scratch_folder, image_name + '.cub')
     #image_cube = os.path.join(output_folder, os.path.basename(image) + '.cub')
     
     print('--> [INFO] Importing image: ', image)
@@ -146,12 +163,14 @@ def lro_img_preprocess(image, output_folder, coreg_type):
     isis.spiceinit(web='yes', from_= image_cube)
     
     print('--> [INFO] Performing radiometric correction')
-    image_cube_cal = os.path.join(output_folder, image_name + '.cal.cub')
+    image_cube_cal = os.path.join(scratch_folder, image_name + '.cal.cub')
     isis.lronaccal(from_=image_cube, to=image_cube_cal)
+    h.delete_files_with_ckeck([image_cube], scratch_folder)
     
     print('--> [INFO] Removing echo effects')
     image_cube_cal_echo = os.path.join(output_folder, image_name + '.cal.echo.cub')
     isis.lronacecho(from_=image_cube_cal, to=image_cube_cal_echo)
+    h.delete_files_with_ckeck([image_cube_cal], scratch_folder)
 
     if coreg_type == 'basic':
         print('--> [INFO] Calculating camstats')
@@ -159,15 +178,17 @@ def lro_img_preprocess(image, output_folder, coreg_type):
         print('--> [INFO] Initializing footprints')
         isis.footprintinit(from_=image_cube_cal_echo, sinc=h.isis_sinc_foot, linc=h.isis_linc_foot)
 
-    h.delete_files_with_ckeck([image_cube, image_cube_cal], output_folder)
-    
     return image_cube_cal_echo
 
 
-def apollo_pan_img_preprocess(image_path, output_folder, coreg_type, mission):
+@cached_preprocess
+def apollo_pan_img_preprocess(image_path, output_folder, coreg_type, mission, scratch_folder=None,
+                              preprocess_engine=h.PREPROCESS_ENGINE):
     """ The passed image label is used for image preprocessing before co-registration"""
+    # intermediate cubes (including the full size one) are written to the scratch folder
+    scratch_folder = pathlib.Path(scratch_folder or output_folder)
     image_path = pathlib.Path(image_path)
-    image_cube = pathlib.Path(output_folder) / image_path.with_suffix('.cub').name
+    image_cube = scratch_folder / image_path.with_suffix('.cub').name
 
     # check if it's image or ISIS cube already
     if image_path.suffix == '.cub':
@@ -192,23 +213,27 @@ def apollo_pan_img_preprocess(image_path, output_folder, coreg_type, mission):
                        vel_horiz=pan_params['vel_horiz'],
                        vel_radial=pan_params['vel_radial'])
 
-    print('--> [INFO] Downscaling cube')
-    image_cube_reduced = pathlib.Path(output_folder) / image_cube.with_suffix('.x20' + '.cub').name
-    isis.reduce(from_=image_cube, to=image_cube_reduced, sscale=20, lscale=20)
-    #image_cube_reduced = image_cube
+    image_cube_reduced = scratch_folder / image_cube.with_suffix('.x20' + '.cub').name
+    image_cube_cal = pathlib.Path(output_folder) / image_cube_reduced.with_suffix('.cal.cub').name
+    if preprocess_engine == 'numpy':
+        # the full size cube is read once, the reduced one is not written
+        print('--> [INFO] Downscaling cube and histogram equalization')
+        downscale.reduce_cube(image_cube, image_cube_cal, scale=20, histeq=True)
+        h.delete_files_with_ckeck([image_cube], scratch_folder)
+    else:
+        print('--> [INFO] Downscaling cube')
+        isis.reduce(from_=image_cube, to=image_cube_reduced, sscale=20, lscale=20)
+        h.delete_files_with_ckeck([image_cube], scratch_folder)
 
-    print('--> [INFO] Histogram equalization')
-    image_cube_cal = image_cube_reduced.with_suffix('.cal.cub')
-    isis.histeq(from_=image_cube_reduced, to=image_cube_cal)
-    #image_cube = image_cube_to
+        print('--> [INFO] Histogram equalization')
+        isis.histeq(from_=image_cube_reduced, to=image_cube_cal)
+        h.delete_files_with_ckeck([image_cube_reduced], scratch_folder)
 
     if coreg_type == 'basic':
         print('--> [INFO] Initializing footprints')
         isis.camstats(from_=image_cube_cal, sinc=h.isis_sinc, linc=h.isis_linc, attach=True)
         isis.footprintinit(from_=image_cube_cal, sinc=h.isis_linc_foot, linc=h.isis_linc_foot)
 
-    #h.delete_files_with_ckeck([image_cube, image_cube_reduced], output_folder)
-
     return image_cube_cal.resolve()
 
 
@@ -254,83 +279,424 @@ def basic_coregistration(list_of_cubs, output_folder, artifacts_prefix):
     isis.pointreg(fromlist=file_list, cnet=file_list_ref_net, deffile=h.pointreg_template,
                   onet=file_list_pointreg, flatfile=stats_file, OUTPUTIGNORED=True, OUTPUTFAILED=True)
 
-    gof_mean, ql_of_uncertainty = h.goodness_of_fit_basic_coreg(stats_file)
+    gof_mean, ql_of_uncertainty, df_images = h.goodness_of_fit_basic_coreg(stats_file)
+    for filename, row in df_images.iterrows():
+        print(f'--> [INFO] {filename}: measures {row["measures"]}, level of uncertainty {row["ql_of_uncertainty"]:.3f}, '
+              f'goodness of fit {row["gof_mean"]:.3f}')
     print(f'[INFO] Total level of uncertainty (0..1, lower is better): {ql_of_uncertainty:.3f}')
     print(f'[INFO] Total goodness of co-registration fit (0..1, higher is better): {gof_mean:.3f}')
 
 
-def advanced_coregistration(old_cubs: List, lroc_cubs: List, output_folder, filter_cn, coreg_config=h.coreg_config, scale=h.scale):
-    """ Performs advanced coregistraion on the passed list of CUB images - NOTE: not tested, to be completed"""
+def skipped_pair_summary(pair: Tuple[pathlib.Path, pathlib.Path], coreg_config: pathlib.Path, scale: int,
+                         message: str) -> Dict[str, Any]:
+    return {'old_cub': pair[0].name, 'lroc_cub': pair[1].name, 'coreg_config': coreg_config.name,
+            'scale': scale, 'status': 'skipped', 'message': message}
 
-    #output_folder = pathlib.Path(output_folder)
-    for old_cub in old_cubs:
-        for lroc_cub in lroc_cubs:
-            adv_coreg_exec(pathlib.Path(old_cub), pathlib.Path(lroc_cub),
-                           pathlib.Path(output_folder), filter_cn, pathlib.Path(coreg_config), scale)
 
+def adv_coreg_pair(pair: Tuple[pathlib.Path, pathlib.Path], output_folder: pathlib.Path, filter_cn: bool,
+                   coreg_config: pathlib.Path, scale: int, scratch_folder: pathlib.Path = None,
+                   outlier_model=h.OUTLIER_MODEL, pyramid=False, auto_tune=None, engine=h.COREG_ENGINE,
+                   preprocess_engine=h.PREPROCESS_ENGINE) -> Dict[str, Any]:
+    """
+    Co-register (old_cub, lroc_cub) pair, coarse-to-fine starting with 'scale' if 'pyramid' is set.
+    'auto_tune' is a dict of auto-tuning settings (see adv_coreg_autotune_exec), config is not tuned if it's None.
+    Errors are not raised but reported in the pair summary
+    """
+    old_cub, lroc_cub = pair
+    start = time.time()
 
-def adv_coreg_exec(old_cub: pathlib.Path, lroc_cub: pathlib.Path, output_folder: pathlib.Path,
-                   filter_cn: bool, coreg_config: pathlib.Path, scale: int, transform=h.transform):
-    #print(f'coreg_config: {coreg_config}  scale: {scale}')
+    try:
+        if pyramid:
+            summary = adv_coreg_pyramid_exec(old_cub, lroc_cub, output_folder, filter_cn,
+                                             h.pyramid_levels(coreg_config, scale), scratch_folder=scratch_folder,
+                                             outlier_model=outlier_model, engine=engine,
+                                             preprocess_engine=preprocess_engine)
+        elif auto_tune is not None:
+            summary = adv_coreg_autotune_exec(old_cub, lroc_cub, output_folder, filter_cn, coreg_config, scale,
+                                              scratch_folder=scratch_folder, outlier_model=outlier_model, engine=engine,
+                                              preprocess_engine=preprocess_engine, **auto_tune)
+        else:
+            summary = adv_coreg_exec(old_cub, lroc_cub, output_folder, filter_cn, coreg_config, scale,
+                                     scratch_folder=scratch_folder, outlier_model=outlier_model, engine=engine,
+                                     preprocess_engine=preprocess_engine)
+    except Exception as ex:
+        message = getattr(ex, 'stderr', None) or str(ex)
+        print(f'[ERROR] Co-registration of {old_cub.stem} & {lroc_cub.stem} failed: {message}')
+        summary = {'status': 'error', 'message': message.strip()}
 
-    # match cubes
-    print(f'[INFO] Starting co-registration: {old_cub.stem} & {lroc_cub.stem}')
-    print(f'--> [INFO] Converting a cube to a different camera geometry')
-    matched_cub = output_folder / f'{old_cub.stem}--match--{lroc_cub.stem}.cub'
-    isis.cam2cam(from_=old_cub, to_=matched_cub, match=lroc_cub)
+    return {'old_cub': old_cub.name, 'lroc_cub': lroc_cub.name, 'coreg_config': coreg_config.name,
+            'scale': scale, **summary, 'seconds': round(time.time() - start, 1)}
+
+
+def adv_coreg_pipeline_pair(old_cub, lroc_cub, old_bbox=None, lroc_bbox=None, output_folder=None, filter_cn=True,
+                            coreg_config=h.coreg_config, scale=h.scale, min_overlap=h.FOOTPRINT_MIN_OVERLAP,
+                            scratch_folder=None, outlier_model=h.OUTLIER_MODEL, pyramid=False, auto_tune=None,
+                            engine=h.COREG_ENGINE, preprocess_engine=h.PREPROCESS_ENGINE):
+    """
+    Co-register (old_cub, lroc_cub) pair as a node of the pipeline (see scheduler.run_dag).
+    The pair is skipped if footprints are passed and they do not overlap
+    """
+    pair = (pathlib.Path(old_cub), pathlib.Path(lroc_cub))
+    coreg_config = pathlib.Path(coreg_config)
+
+    if old_bbox is not None and lroc_bbox is not None:
+        overlap = h.footprint_overlap([old_bbox], [lroc_bbox])[0, 0]
+        if overlap <= min_overlap:
+            return skipped_pair_summary(pair, coreg_config, scale, f'footprints overlap {overlap:.3f} <= {min_overlap}')
+
+    return adv_coreg_pair(pair, pathlib.Path(output_folder), filter_cn, coreg_config, scale,
+                          pathlib.Path(scratch_folder) if scratch_folder else None, outlier_model, pyramid, auto_tune,
+                          engine, preprocess_engine)
+
+
+def scaled_lroc_cube(lroc_cub, scratch_folder: pathlib.Path, scale: int) -> pathlib.Path:
+    """ Reduced LROC cube shared by all pairs with the LROC image """
+    return pathlib.Path(scratch_folder) / f'{pathlib.Path(lroc_cub).stem}.x{scale}.cub'
+
+
+def release_scaled_lroc_cube(lroc_cub, *pair_summaries, scratch_folder=None, scales=(h.scale,)):
+    """ Delete reduced LROC cubes when all pairs with the LROC image are co-registered (pipeline node) """
+    h.delete_files_with_ckeck([scaled_lroc_cube(lroc_cub, scratch_folder, scale) for scale in scales], scratch_folder)
+
+
+def matched_cube(old_cub, lroc_cub, scratch_folder: pathlib.Path) -> pathlib.Path:
+    """ Old cube matched to LROC camera geometry, shared by all coreg configs of the pair """
+    return pathlib.Path(scratch_folder) / f'{pathlib.Path(old_cub).stem}--match--{pathlib.Path(lroc_cub).stem}.cub'
+
+
+def scaled_matched_cube(old_cub, lroc_cub, scratch_folder: pathlib.Path, scale: int) -> pathlib.Path:
+    """ Reduced matched cube shared by all coreg configs of the pair with the same scale """
+    return pathlib.Path(scratch_folder) / f'{matched_cube(old_cub, lroc_cub, scratch_folder).stem}.x{scale}.cub'
+
+
+def release_matched_cubes(old_cub, lroc_cub, *pair_summaries, scratch_folder=None, scales=(h.scale,)):
+    """ Delete matched cubes (full size and reduced) when the pair is co-registered (pipeline node) """
+    h.delete_files_with_ckeck([matched_cube(old_cub, lroc_cub, scratch_folder)] +
+                              [scaled_matched_cube(old_cub, lroc_cub, scratch_folder, scale) for scale in scales],
+                              scratch_folder)
+
+
+def write_adv_coreg_summary(summaries: List[Dict[str, Any]], output_folder: pathlib.Path) -> pd.DataFrame:
+    """ Write per-pair summary table of advanced co-registration """
+    columns = ['old_cub', 'lroc_cub', 'coreg_config', 'scale', 'status', 'points', 'filtered', 'gof_mean',
+               'uncertainty_samples', 'uncertainty_lines', 'seconds', 'message']
+    # number of configs tried by auto-tuning
+    if any('configs_tried' in summary for summary in summaries):
+        columns.insert(columns.index('status'), 'configs_tried')
+    df_summary = pd.DataFrame(summaries, columns=columns).sort_values(['old_cub', 'lroc_cub'])
+    df_summary.to_csv(output_folder / h.ADV_COREG_SUMMARY, index=False, na_rep='NA')
 
-    # scale (reduce)
-    print(f'--> [INFO] Reducing cubes')
-    matched_scaled_cub = output_folder / f'{matched_cub.stem}.x{scale}.cub'
-    lroc_scaled_cub = output_folder / f'{lroc_cub.stem}.x{scale}.cub'
-    isis.reduce(from_=matched_cub, to_=matched_scaled_cub, sscale=scale, lscale=scale)
-    isis.reduce(from_=lroc_cub, to_=lroc_scaled_cub, sscale=scale, lscale=scale)
+    print(f'[INFO] Co-registered pairs: {(df_summary["status"] == "ok").sum()} of {df_summary.shape[0]}, '
+          f'summary: {output_folder / h.ADV_COREG_SUMMARY}')
+    return df_summary
 
-    # deleting temporary files
-    h.delete_files_with_ckeck([matched_cub], output_folder)
 
-    # coreg
+def reduce_pair_cubes(old_cub: pathlib.Path, lroc_cub: pathlib.Path, scratch_folder: pathlib.Path,
+                      scales: List[int], preprocess_engine=h.PREPROCESS_ENGINE) -> List[Tuple[pathlib.Path, pathlib.Path]]:
+    """
+    Matched (to LROC camera geometry) and LROC cubes reduced to every scale, (matched, LROC) per scale.
+    All cubes are produced once: matched ones are shared by all coreg configs of the pair and deleted by
+    'release_matched_cubes', reduced LROC ones are shared by all pairs with the LROC image and deleted by
+    'release_scaled_lroc_cube' (pipeline nodes).
+    Cubes are reduced by ISIS reduce or in-process (see 'preprocess_engine')
+    """
+    matched_cub = matched_cube(old_cub, lroc_cub, scratch_folder)
+
+    def match(to_):
+        # match cubes
+        print(f'--> [INFO] Converting a cube to a different camera geometry')
+        isis.cam2cam(from_=old_cub, to_=to_, match=lroc_cub)
+
+    def reduce_cube(from_, to_, scale):
+        if preprocess_engine == 'numpy':
+            downscale.reduce_cube(from_, to_, scale)
+        else:
+            isis.reduce(from_=from_, to_=to_, sscale=scale, lscale=scale)
+
+    def reduce_matched(scale):
+        def reduce(to_):
+            h.produce_once(matched_cub, match, [old_cub, lroc_cub])
+            print(f'--> [INFO] Reducing matched cube')
+            reduce_cube(matched_cub, to_, scale)
+        return reduce
+
+    def reduce_lroc(scale):
+        def reduce(to_):
+            print(f'--> [INFO] Reducing LROC cube')
+            reduce_cube(lroc_cub, to_, scale)
+        return reduce
+
+    res = []
+    for scale in scales:
+        matched_scaled_cub = scaled_matched_cube(old_cub, lroc_cub, scratch_folder, scale)
+        lroc_scaled_cub = scaled_lroc_cube(lroc_cub, scratch_folder, scale)
+        h.produce_once(matched_scaled_cub, reduce_matched(scale), [old_cub, lroc_cub], scale=scale,
+                       engine=preprocess_engine)
+        h.produce_once(lroc_scaled_cub, reduce_lroc(scale), [lroc_cub], scale=scale, engine=preprocess_engine)
+        res.append((matched_scaled_cub, lroc_scaled_cub))
+    return res
+
+
+def coreg_filtered(from_cub: pathlib.Path, lroc_scaled_cub: pathlib.Path, output_folder: pathlib.Path, res_name: str,
+                   deffile: pathlib.Path, filter_cn: bool, transform=h.transform, outlier_model=h.OUTLIER_MODEL,
+                   engine=h.COREG_ENGINE):
+    """
+    Co-register reduced cubes (by ISIS coreg or in-process numpy matcher, see 'engine')
+    and filter resulting Control Network.
+    Returns coreg stats, path of the (filtered) interim Control Network and number of filtered points.
+    Stats are None if coreg was unable to register any points
+    """
     print(f'--> [INFO] Performing co-registration')
-    res_name = f'{coreg_config.stem}-{old_cub.stem}-{lroc_cub.stem}.x{scale}'
     interim_cn_path = output_folder / f'{res_name}.interim.net'
     stats_path = output_folder / f'{res_name}.stats.txt'
 
-    try:
-        isis.coreg(from_=matched_scaled_cub,
-                   match=lroc_scaled_cub,
-                   deffile=coreg_config,
-                   to_=output_folder / f'{res_name}.{transform}.cub',
-                   onet=interim_cn_path,
-                   flatfile=stats_path,
-                   transform=transform)
-    except Exception as ex:
-        if f'**USER ERROR** Coreg was unable to register any points' in ex.stderr:
-            print('--> [INFO] Advanced co-registration procedure was unable to register any points. Try to use basic co-registration')
-            return
-        else:
-            raise
-
-    # convert interim binary .net to text .pvl
-    interim_pvl_path = interim_cn_path.with_suffix('.pvl')
-    isis.cnetbin2pvl(from_=interim_cn_path, to_=interim_pvl_path)
-
-    # filtering resulting .pvl
+    registered = True
+    if engine == 'numpy':
+        registered = ncc.coreg(from_cub, lroc_scaled_cub, deffile, interim_cn_path, stats_path,
+                               to_=output_folder / f'{res_name}.{transform}.cub', transform=transform) > 0
+    else:
+        try:
+            isis.coreg(from_=from_cub,
+                       match=lroc_scaled_cub,
+                       deffile=deffile,
+                       to_=output_folder / f'{res_name}.{transform}.cub',
+                       onet=interim_cn_path,
+                       flatfile=stats_path,
+                       transform=transform)
+        except Exception as ex:
+            if f'**USER ERROR** Coreg was unable to register any points' in ex.stderr:
+                registered = False
+            else:
+                raise
+
+    if not registered:
+        print('--> [INFO] Advanced co-registration procedure was unable to register any points. Try to use basic co-registration')
+        return None, None, 0
+
+    # coreg stats are read once and shared by filtering and statistics
+    stats = pvl.CoregStats.read(stats_path)
+
+    # filtering resulting control network (binary .net is read directly)
     cnt_filtered = 0
     if filter_cn:
-        # print(interim_pvl_path, stats_path)
-        flt_pvl_path = interim_pvl_path.with_suffix('').with_suffix('.filtered.pvl')
-        cnt_filtered = pvl.filter_coreg_result(interim_pvl_path, stats_path, flt_pvl_path)
+        flt_cn_path = interim_cn_path.with_suffix('').with_suffix('.filtered.pvl')
+        cnt_filtered = pvl.filter_coreg_result(interim_cn_path, stats, flt_cn_path, outlier_model)
+        # stats file is written back with 'Filtered' column
+        stats.write(stats_path)
         print(f'--> [INFO] Filtered points: {cnt_filtered}')
 
     if not cnt_filtered:
-        flt_pvl_path = interim_pvl_path
+        flt_cn_path = interim_cn_path
+
+    return stats, flt_cn_path, cnt_filtered
+
+
+def coreg_artifacts(output_folder: pathlib.Path, res_name: str, transform=h.transform) -> List[pathlib.Path]:
+    """ Files written by coreg_filtered for 'res_name' """
+    return [output_folder / f'{res_name}.{suffix}'
+            for suffix in ['interim.net', 'stats.txt', 'filtered.net', 'filtered.pvl', f'{transform}.cub']]
 
-    # creating Control Network for source images (converting interim CN to final)
+
+def adv_coreg_exec(old_cub: pathlib.Path, lroc_cub: pathlib.Path, output_folder: pathlib.Path,
+                   filter_cn: bool, coreg_config: pathlib.Path, scale: int, transform=h.transform,
+                   scratch_folder: pathlib.Path = None, outlier_model=h.OUTLIER_MODEL,
+                   engine=h.COREG_ENGINE, preprocess_engine=h.PREPROCESS_ENGINE) -> Dict[str, Any]:
+    #print(f'coreg_config: {coreg_config}  scale: {scale}')
+
+    print(f'[INFO] Starting co-registration: {old_cub.stem} & {lroc_cub.stem}')
+    # matched and reduced cubes are intermediate, they are written to the scratch folder
+    scratch_folder = scratch_folder or output_folder
+    [(matched_scaled_cub, lroc_scaled_cub)] = reduce_pair_cubes(old_cub, lroc_cub, scratch_folder, [scale],
+                                                                preprocess_engine)
+
+    stats, flt_cn_path, cnt_filtered = coreg_filtered(
+        matched_scaled_cub, lroc_scaled_cub, output_folder, f'{coreg_config.stem}-{old_cub.stem}-{lroc_cub.stem}.x{scale}',
+        coreg_config, filter_cn, transform, outlier_model, engine)
+    if stats is None:
+        return {'status': 'no_points', 'points': 0}
+
+    # creating Control Network for source images (converting interim CN to final).
+    # Measures are translated through the matched cube (by serial number), it's released by the pipeline
     res_name = f'{coreg_config.stem}-{old_cub.stem}-{lroc_cub.stem}'
-    pvl.translate_coreg_res(flt_pvl_path, old_cub, lroc_cub, output_folder, res_name)
+    pvl.translate_coreg_res(flt_cn_path, old_cub, lroc_cub, output_folder, res_name, cubes_folder=scratch_folder)
 
     # collecting coreg stats
-    gof_mean, uncertainty_samples, uncertainty_lines = h.goodness_of_fit_adv_coreg(stats_path, flt_pvl_path, scale)
+    gof_mean, uncertainty_samples, uncertainty_lines = h.goodness_of_fit_adv_coreg(stats, flt_cn_path, scale)
     print(f'--> [INFO] Quantified level of uncertainty (Samples, Lines) in LROC pixels: '
           f'({uncertainty_samples:.1f}, {uncertainty_lines:.1f})')
     print(f'--> [INFO] Total goodness of co-registration fit (0..1, higher is better): {gof_mean:.3f}')
+
+    return {'status': 'ok', 'points': stats.n_points, 'filtered': cnt_filtered,
+            'gof_mean': gof_mean, 'uncertainty_samples': uncertainty_samples, 'uncertainty_lines': uncertainty_lines,
+            'artifacts': [output_folder / f'{res_name}.net', output_folder / f'{res_name}.pvl']}
+
+
+def adv_coreg_autotune_exec(old_cub: pathlib.Path, lroc_cub: pathlib.Path, output_folder: pathlib.Path,
+                            filter_cn: bool, coreg_config: pathlib.Path, scale: int, transform=h.transform,
+                            scratch_folder: pathlib.Path = None, outlier_model=h.OUTLIER_MODEL, history_path=None,
+                            min_gof=h.AUTO_TUNE_MIN_GOF, min_points=h.AUTO_TUNE_MIN_POINTS,
+                            engine=h.COREG_ENGINE, preprocess_engine=h.PREPROCESS_ENGINE) -> Dict[str, Any]:
+    """
+    Co-register reduced cubes with candidate configs (see autotune.candidates) from the cheapest one,
+    until goodness of fit and number of points pass 'min_gof' and 'min_points'. The config which co-registered
+    the previous pair of the same kind (recorded in 'history_path') is tried first.
+    If no config passes, the one with the best goodness of fit is the result
+    """
+    print(f'[INFO] Starting co-registration (auto-tune): {old_cub.stem} & {lroc_cub.stem}')
+    scratch_folder = scratch_folder or output_folder
+    history_path = history_path or output_folder / h.AUTO_TUNE_HISTORY
+    [(matched_scaled_cub, lroc_scaled_cub)] = reduce_pair_cubes(old_cub, lroc_cub, scratch_folder, [scale],
+                                                                preprocess_engine)
+
+    result = None
+    # coreg results of every tried config, the ones of not selected configs are deleted
+    tried_names = []
+    try:
+        kind = autotune.pair_kind(old_cub, lroc_cub, scale)
+        configs = autotune.candidates(coreg_config, scale, autotune.preferred(history_path, kind))
+        for i, config in enumerate(configs):
+            print(f'--> [INFO] Trying coreg config {i + 1} of {len(configs)}: {config.name}')
+            config_name = f'{config.stem}-{old_cub.stem}-{lroc_cub.stem}.x{scale}'
+            tried_names.append(config_name)
+            stats, flt_cn_path, cnt_filtered = coreg_filtered(
+                matched_scaled_cub, lroc_scaled_cub, output_folder, config_name,
+                config, filter_cn, transform, outlier_model, engine)
+            if stats is None:
+                continue
+
+            gof_mean, uncertainty_samples, uncertainty_lines = h.goodness_of_fit_adv_coreg(stats, flt_cn_path, scale)
+            print(f'--> [INFO] Points: {stats.n_points}, goodness of fit: {gof_mean:.3f}')
+            # NaN goodness of fit (no points to estimate it) is worse than any other one
+            if result is None or np.nan_to_num(gof_mean, nan=-1.) > np.nan_to_num(result['gof_mean'], nan=-1.):
+                result = {'config': config, 'name': config_name, 'stats': stats, 'cn_path': flt_cn_path,
+                          'filtered': cnt_filtered,
+                          'gof_mean': gof_mean, 'uncertainty_samples': uncertainty_samples,
+                          'uncertainty_lines': uncertainty_lines}
+
+            if autotune.passed(gof_mean, stats.n_points, min_gof, min_points):
+                tried = i + 1
+                autotune.record(history_path, kind, config.name)
+                print(f'--> [INFO] Coreg config accepted: {config.name}')
+                break
+        else:
+            if result is None:
+                return {'status': 'no_points', 'points': 0}
+            tried = len(configs)
+            print(f'--> [INFO] No coreg config passed thresholds (goodness of fit {min_gof}, points {min_points}), '
+                  f'the best one is used: {result["config"].name}')
+
+        # creating Control Network for source images (converting interim CN to final)
+        res_name = f'{result["config"].stem}-{old_cub.stem}-{lroc_cub.stem}'
+        pvl.translate_coreg_res(result['cn_path'], old_cub, lroc_cub, output_folder, res_name, cubes_folder=scratch_folder)
+    finally:
+        rejected = [name for name in tried_names if result is None or name != result['name']]
+        h.delete_files_with_ckeck([path for name in rejected for path in coreg_artifacts(output_folder, name, transform)],
+                                  output_folder)
+
+    print(f'--> [INFO] Quantified level of uncertainty (Samples, Lines) in LROC pixels: '
+          f'({result["uncertainty_samples"]:.1f}, {result["uncertainty_lines"]:.1f})')
+    print(f'--> [INFO] Total goodness of co-registration fit (0..1, higher is better): {result["gof_mean"]:.3f}')
+
+    return {'status': 'ok', 'coreg_config': result['config'].name, 'configs_tried': tried,
+            'points': result['stats'].n_points, 'filtered': result['filtered'], 'gof_mean': result['gof_mean'],
+            'uncertainty_samples': result['uncertainty_samples'], 'uncertainty_lines': result['uncertainty_lines'],
+            'artifacts': [output_folder / f'{res_name}.net', output_folder / f'{res_name}.pvl']}
+
+
+def adv_coreg_pyramid_exec(old_cub: pathlib.Path, lroc_cub: pathlib.Path, output_folder: pathlib.Path,
+                           filter_cn: bool, levels: List[Tuple[int, pathlib.Path]], transform=h.transform,
+                           scratch_folder: pathlib.Path = None, outlier_model=h.OUTLIER_MODEL,
+                           search_margin=h.PYRAMID_SEARCH_MARGIN, engine=h.COREG_ENGINE,
+                           preprocess_engine=h.PREPROCESS_ENGINE) -> Dict[str, Any]:
+    """
+    Coarse-to-fine co-registration through 'levels' (scale, coreg config), from the coarsest one.
+    Translation recovered by a level seeds the next finer one: matched cube is translated by it before coreg,
+    so the search chip is narrowed to the pattern chip plus 'search_margin' pixels of the coarser level.
+    Control Network of the finest level with registered points is the result, stats of every level
+    are written to '<result>.levels.csv'
+    """
+    coreg_config, scale = levels[0][1], levels[0][0]
+    print(f'[INFO] Starting coarse-to-fine co-registration: {old_cub.stem} & {lroc_cub.stem} '
+          f'(scales: {", ".join(f"x{level_scale}" for level_scale, _ in levels)})')
+    scratch_folder = scratch_folder or output_folder
+    cubes = reduce_pair_cubes(old_cub, lroc_cub, scratch_folder, [level_scale for level_scale, _ in levels],
+                              preprocess_engine)
+    res_name = f'{coreg_config.stem}-{old_cub.stem}-{lroc_cub.stem}'
+
+    level_summaries = []
+    seeded_cubs, narrowed_configs = [], []
+    result = None
+    # total translation recovered so far, pixels of the last registered level
+    translation = np.zeros(2)
+
+    try:
+        for (level_scale, level_config), (matched_scaled_cub, lroc_scaled_cub) in zip(levels, cubes):
+            start = time.time()
+            level_name = f'{level_config.stem}-{old_cub.stem}-{lroc_cub.stem}.x{level_scale}'
+            print(f'--> [INFO] Co-registration level x{level_scale}')
+
+            if result is None:
+                from_cub, deffile, seed = matched_scaled_cub, level_config, np.zeros(2)
+            else:
+                # translation of the coarser level in pixels of this level
+                seed = translation * result['scale'] / level_scale
+                from_cub = scratch_folder / f'{matched_scaled_cub.stem}.seeded.cub'
+                seeded_cubs.append(from_cub)
+                print(f'--> [INFO] Seeding with translation (Samples, Lines): ({seed[0]:.2f}, {seed[1]:.2f})')
+                # the same translation 'translate' transform of coreg applies to its FROM cube
+                isis.translate(from_=matched_scaled_cub, to_=from_cub, strans=seed[0], ltrans=seed[1],
+                               interp='cubicconvolution')
+                deffile = scratch_folder / f'{level_name}.def'
+                narrowed_configs.append(deffile)
+                margin = int(np.ceil(search_margin * result['scale'] / level_scale))
+                h.write_narrowed_coreg_config(level_config, deffile, margin)
+
+            stats, flt_cn_path, cnt_filtered = coreg_filtered(from_cub, lroc_scaled_cub, output_folder, level_name,
+                                                              deffile, filter_cn, transform, outlier_model, engine)
+            if stats is None:
+                if result is None:
+                    return {'status': 'no_points', 'points': 0}
+                print(f'--> [INFO] Finer levels are skipped, x{result["scale"]} level is the result')
+                break
+
+            residual = [np.nanmedian(stats.column(name, filtered=False)) for name in ['SampleDifference', 'LineDifference']]
+            translation = seed + np.array(residual)
+            gof_mean, uncertainty_samples, uncertainty_lines = h.goodness_of_fit_adv_coreg(stats, flt_cn_path, level_scale)
+            search_chip = h.coreg_chip_size(deffile, 'SearchChip')
+            print(f'--> [INFO] Level x{level_scale}: points {stats.n_points}, filtered {cnt_filtered}, '
+                  f'search chip {search_chip[0]}x{search_chip[1]}, translation in LROC pixels '
+                  f'({translation[0] * level_scale:.1f}, {translation[1] * level_scale:.1f}), uncertainty in LROC pixels '
+                  f'({uncertainty_samples:.1f}, {uncertainty_lines:.1f}), goodness of fit {gof_mean:.3f}')
+
+            result = {'scale': level_scale, 'stats': stats, 'cn_path': flt_cn_path, 'filtered': cnt_filtered,
+                      'gof_mean': gof_mean, 'uncertainty_samples': uncertainty_samples,
+                      'uncertainty_lines': uncertainty_lines, 'seed': seed,
+                      'from_cub': from_cub, 'matched_scaled_cub': matched_scaled_cub}
+            level_summaries.append({
+                'scale': level_scale, 'coreg_config': level_config.name, 'points': stats.n_points,
+                'filtered': cnt_filtered, 'gof_mean': gof_mean, 'uncertainty_samples': uncertainty_samples,
+                'uncertainty_lines': uncertainty_lines, 'search_samples': search_chip[0], 'search_lines': search_chip[1],
+                'translation_samples': translation[0] * level_scale, 'translation_lines': translation[1] * level_scale,
+                'seconds': round(time.time() - start, 1)})
+
+        pd.DataFrame(level_summaries).to_csv(output_folder / f'{res_name}.levels.csv', index=False)
+
+        # creating Control Network for source images (converting interim CN of the finest level to final),
+        # measures of the seeded cube are moved back to the reduced matched cube
+        seeded = {}
+        if result['from_cub'] != result['matched_scaled_cub']:
+            seeded[result['from_cub'].name] = (result['matched_scaled_cub'].name, *result['seed'])
+        pvl.translate_coreg_res(result['cn_path'], old_cub, lroc_cub, output_folder, res_name,
+                                cubes_folder=scratch_folder, seeded_cubes=seeded)
+    finally:
+        # seeded cubes and narrowed configs are used by this pair only (matched cubes are released by the pipeline)
+        h.delete_files_with_ckeck(seeded_cubs + narrowed_configs, scratch_folder)
+
+    print(f'--> [INFO] Quantified level of uncertainty (Samples, Lines) in LROC pixels: '
+          f'({result["uncertainty_samples"]:.1f}, {result["uncertainty_lines"]:.1f})')
+    print(f'--> [INFO] Total goodness of co-registration fit (0..1, higher is better): {result["gof_mean"]:.3f}')
+
+    return {'status': 'ok', 'scale': result['scale'], 'points': result['stats'].n_points, 'filtered': result['filtered'],
+            'gof_mean': result['gof_mean'], 'uncertainty_samples': result['uncertainty_samples'],
+            'uncertainty_lines': result['uncertainty_lines'],
+            'artifacts': [output_folder / f'{res_name}.net', output_folder / f'{res_name}.pvl']}
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+import time
+import getpass
+import pathlib
+from typing import Dict, Any, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import fft
+from numpy.lib.stride_tricks import sliding_window_view
+
+from profiling import isis
+import helper as h
+import cnetbin
+import cube
+
+# columns of ISIS coreg flatfile
+FLATFILE_COLUMNS = ['Sample', 'Line', 'TranslatedSample', 'TranslatedLine', 'SampleDifference', 'LineDifference',
+                    'GoodnessOfFit']
+# peaks of flat correlation surfaces (FFT round-off) are not registered
+FLAT_VARIANCE = 1e-10
+
+
+def match_settings(coreg_config) -> Dict[str, Any]:
+    """ MaximumCorrelation settings of coreg definition file, ISIS defaults are used for missing optional keywords """
+    algorithm = h.coreg_config_group(coreg_config, 'Algorithm')
+    if algorithm.get('Name', 'MaximumCorrelation') != 'MaximumCorrelation':
+        raise ValueError(f'{coreg_config}: numpy engine supports MaximumCorrelation algorithm only')
+    pattern = h.coreg_config_group(coreg_config, 'PatternChip')
+    search = h.coreg_config_group(coreg_config, 'SearchChip')
+    surface = h.coreg_config_group(coreg_config, 'SurfaceModel')
+
+    def valid_range(group):
+        return float(group.get('ValidMinimum', -np.inf)), float(group.get('ValidMaximum', np.inf))
+
+    return {
+        'tolerance': float(algorithm['Tolerance']),
+        'sobel': algorithm.get('Gradient', 'None').lower() == 'sobel',
+        'subpixel': algorithm.get('SubPixelAccuracy', 'True').lower() == 'true',
+        'reduction': int(algorithm.get('ReductionFactor', 1)),
+        'pattern_size': (int(pattern['Samples']), int(pattern['Lines'])),
+        'pattern_range': valid_range(pattern),
+        'pattern_valid_percent': float(pattern.get('ValidPercent', 50.)),
+        'min_zscore': float(pattern.get('MinimumZScore', 1.)),
+        'search_size': (int(search['Samples']), int(search['Lines'])),
+        'search_range': valid_range(search),
+        'search_valid_percent': float(search.get('ValidPercent', 50.)),
+        'subchip_valid_percent': float(search.get('SubchipValidPercent', 50.)),
+        'distance_tolerance': float(surface.get('DistanceTolerance', 1.5)),
+        'window_size': int(surface.get('WindowSize', 5)),
+    }
+
+
+def grid(samples, lines, search_size, rows=None, columns=None) -> Tuple[np.ndarray, ...]:
+    """
+    Points (1-based cube sample, line, row, column) of ISIS coreg grid: 'rows' x 'columns' points,
+    by default one point per search chip
+    """
+    rows = rows or (lines - 1) // search_size[1] + 1
+    columns = columns or (samples - 1) // search_size[0] + 1
+    line_inc, sample_inc = lines // rows, samples // columns
+    row, column = [a.ravel() for a in np.mgrid[0:rows, 0:columns]]
+    line = (line_inc / 2. + row * line_inc + 0.5).astype(int)
+    sample = (sample_inc / 2. + column * sample_inc + 0.5).astype(int)
+    return sample, line, row, column
+
+
+def chips(image, samples, lines, size) -> np.ndarray:
+    """
+    (N x Lines x Samples) chips of 'size' (Samples, Lines) centered on 1-based cube (sample, line) like ISIS chips:
+    the center is pixel (Samples + 1) // 2, (Lines + 1) // 2 of the chip. Pixels out of the cube are NaN
+    """
+    chip_samples, chip_lines = size
+    pad = max(chip_samples, chip_lines)
+    padded = np.pad(image, pad, constant_values=np.nan)
+    windows = sliding_window_view(padded, (chip_lines, chip_samples))
+    return windows[lines - (chip_lines + 1) // 2 + pad, samples - (chip_samples + 1) // 2 + pad]
+
+
+def sobel(image) -> np.ndarray:
+    """ Sobel gradient |Gx| + |Gy| (ISIS 'Gradient = Sobel'), border pixels are NaN """
+    gx = (image[:-2, 2:] + 2 * image[1:-1, 2:] + image[2:, 2:]) - (image[:-2, :-2] + 2 * image[1:-1, :-2] + image[2:, :-2])
+    gy = (image[2:, :-2] + 2 * image[2:, 1:-1] + image[2:, 2:]) - (image[:-2, :-2] + 2 * image[:-2, 1:-1] + image[:-2, 2:])
+    res = np.full_like(image, np.nan)
+    res[1:-1, 1:-1] = np.abs(gx) + np.abs(gy)
+    return res
+
+
+def block_mean(image, factor) -> np.ndarray:
+    """ Image reduced by averaging 'factor' x 'factor' blocks of valid pixels """
+    lines, samples = image.shape[0] // factor * factor, image.shape[1] // factor * factor
+    blocks = image[:lines, :samples].reshape(lines // factor, factor, samples // factor, factor)
+    valid = ~np.isnan(blocks)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(valid, blocks, 0.).sum(axis=(1, 3)) / valid.sum(axis=(1, 3))
+
+
+def box_sums(values, size) -> np.ndarray:
+    """ Sums of all (Lines x Samples) 'size' windows of (N x sl x ss) chips by summed-area tables """
+    table = np.zeros((values.shape[0], values.shape[1] + 1, values.shape[2] + 1))
+    table[:, 1:, 1:] = values.cumsum(axis=1).cumsum(axis=2)
+    lines, samples = size
+    return table[:, lines:, samples:] - table[:, :-lines, samples:] - table[:, lines:, :-samples] + \
+        table[:, :-lines, :-samples]
+
+
+def correlation(search, pattern, min_overlap, workers=h.NCC_FFT_WORKERS) -> np.ndarray:
+    """
+    Normalized cross-correlation of every pattern chip (N x pl x ps) at every position inside its search chip
+    (N x sl x ss), all chips of the batch are correlated at once by FFT. NaN pixels are invalid: correlation
+    is computed over pixels valid in both chips (masked NCC, 6 FFT correlations); chips without invalid pixels
+    need one FFT correlation and window sums. Result is (N x (sl - pl + 1) x (ss - ps + 1)),
+    NaN where fewer than 'min_overlap' pixels are valid in both chips or the subchip is flat
+    """
+    search_lines, search_samples = search.shape[1:]
+    pattern_lines, pattern_samples = pattern.shape[1:]
+    out_lines, out_samples = search_lines - pattern_lines + 1, search_samples - pattern_samples + 1
+    shape = (fft.next_fast_len(search_lines), fft.next_fast_len(search_samples, real=True))
+
+    search_mask, pattern_mask = ~np.isnan(search), ~np.isnan(pattern)
+    # chips are centered for numerical stability (NCC does not depend on the offset)
+    search_values, pattern_values = [
+        np.where(mask, chips_ - (np.where(mask, chips_, 0.).sum(axis=(1, 2)) /
+                                 np.maximum(mask.sum(axis=(1, 2)), 1))[:, None, None], 0.)
+        for chips_, mask in [(search, search_mask), (pattern, pattern_mask)]]
+    search_energy = np.square(search_values).sum(axis=(1, 2))[:, None, None]
+    pattern_energy = np.square(pattern_values).sum(axis=(1, 2))[:, None, None]
+
+    def spectrum(values):
+        return fft.rfft2(values, s=shape, axes=(1, 2), workers=workers)
+
+    def correlate(search_spectrum, pattern_spectrum):
+        return fft.irfft2(search_spectrum * np.conj(pattern_spectrum), s=shape, axes=(1, 2),
+                          workers=workers)[:, :out_lines, :out_samples]
+
+    res = np.empty((search.shape[0], out_lines, out_samples))
+    complete = search_mask.all(axis=(1, 2)) & pattern_mask.all(axis=(1, 2))
+    if complete.any():
+        s, p = search_values[complete], pattern_values[complete]
+        n = pattern_lines * pattern_samples
+        sum_ps = correlate(spectrum(s), spectrum(p))
+        sum_s, sum_s2 = box_sums(s, (pattern_lines, pattern_samples)), box_sums(np.square(s), (pattern_lines, pattern_samples))
+        var_s, var_p = sum_s2 - sum_s ** 2 / n, pattern_energy[complete]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # pattern values are centered (their sum is 0)
+            res[complete] = np.where(var_s > FLAT_VARIANCE * search_energy[complete], sum_ps / np.sqrt(var_s * var_p),
+                                     np.nan)
+
+    partial = ~complete
+    if partial.any():
+        search_mask_spectrum = spectrum(search_mask[partial].astype(np.float64))
+        pattern_mask_spectrum = spectrum(pattern_mask[partial].astype(np.float64))
+        s, p = search_values[partial], pattern_values[partial]
+        s_spectrum, p_spectrum = spectrum(s), spectrum(p)
+
+        n = np.round(correlate(search_mask_spectrum, pattern_mask_spectrum))
+        sum_s = correlate(s_spectrum, pattern_mask_spectrum)
+        sum_s2 = correlate(spectrum(np.square(s)), pattern_mask_spectrum)
+        sum_p = correlate(search_mask_spectrum, p_spectrum)
+        sum_p2 = correlate(search_mask_spectrum, spectrum(np.square(p)))
+        sum_ps = correlate(s_spectrum, p_spectrum)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var_s = sum_s2 - sum_s ** 2 / n
+            var_p = sum_p2 - sum_p ** 2 / n
+            res[partial] = np.where((n >= max(min_overlap, 2)) & (var_s > FLAT_VARIANCE * search_energy[partial]) &
+                                    (var_p > FLAT_VARIANCE * pattern_energy[partial]),
+                                    (sum_ps - sum_s * sum_p / n) / np.sqrt(var_s * var_p), np.nan)
+
+    return np.clip(res, -1., 1.)
+
+
+def subpixel_offsets(fit, best_lines, best_samples, window_size) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sub-pixel (line, sample) offsets of the fit peaks: maximum of the quadratic surface fitted by least squares
+    to 'window_size' x 'window_size' fit values around the peak. NaN if the window is not valid or has no maximum
+    """
+    half = window_size // 2
+    padded = np.pad(fit, ((0, 0), (half, half), (half, half)), constant_values=np.nan)
+    windows = sliding_window_view(padded, (window_size, window_size), axis=(1, 2))[
+        np.arange(fit.shape[0]), best_lines, best_samples].reshape(fit.shape[0], -1)
+
+    y, x = [a.ravel() for a in np.mgrid[-half:half + 1, -half:half + 1]]
+    design = np.column_stack([np.ones(x.size), x, y, x ** 2, x * y, y ** 2])
+    _, b, c, d, e, f = (windows @ np.linalg.pinv(design).T).T
+
+    det = 4 * d * f - e ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dx = (e * c - 2 * f * b) / det
+        dy = (e * b - 2 * d * c) / det
+    peak = np.isfinite(windows).all(axis=1) & (det > 0) & (d < 0)
+    return np.where(peak, dy, np.nan), np.where(peak, dx, np.nan)
+
+
+def valid_percent(chips_) -> np.ndarray:
+    return (~np.isnan(chips_)).mean(axis=(1, 2)) * 100.
+
+
+def pattern_zscore(pattern) -> np.ndarray:
+    """ Max absolute z-score of min and max valid pattern pixels (0 for flat patterns) """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean, std = np.nanmean(pattern, axis=(1, 2)), np.nanstd(pattern, axis=(1, 2))
+        zscore = np.maximum(np.nanmax(pattern, axis=(1, 2)) - mean, mean - np.nanmin(pattern, axis=(1, 2))) / std
+    return np.nan_to_num(zscore, nan=0., posinf=0.)
+
+
+def register_points(pattern_image, search_image, samples, lines, search_samples, search_lines, pattern_size,
+                    search_size, settings, subpixel, batch=h.NCC_BATCH_POINTS, workers=h.NCC_FFT_WORKERS):
+    """
+    Register pattern chips centered on (samples, lines) of 'pattern_image' in search chips centered
+    on (search_samples, search_lines) of 'search_image'. Returns registered 1-based cube (sample, line)
+    in the search image, goodness of fit, success and sub-pixel flags
+    """
+    n_points = len(samples)
+    res_sample, res_line, fit = np.full(n_points, np.nan), np.full(n_points, np.nan), np.full(n_points, np.nan)
+    success, registered_subpixel = np.zeros(n_points, dtype=bool), np.zeros(n_points, dtype=bool)
+    min_overlap = settings['subchip_valid_percent'] / 100. * pattern_size[0] * pattern_size[1]
+    # offset of pattern chip center in the search chip when the pattern is at the search chip origin
+    center_offset = np.array([(search_size[1] + 1) // 2 - (pattern_size[1] + 1) // 2,
+                              (search_size[0] + 1) // 2 - (pattern_size[0] + 1) // 2])
+
+    for start in range(0, n_points, batch):
+        idx = np.arange(start, min(start + batch, n_points))
+        pattern = chips(pattern_image, samples[idx], lines[idx], pattern_size)
+        search = chips(search_image, search_samples[idx], search_lines[idx], search_size)
+
+        chips_valid = ((valid_percent(pattern) >= settings['pattern_valid_percent']) &
+                       (pattern_zscore(pattern) >= settings['min_zscore']) &
+                       (valid_percent(search) >= settings['search_valid_percent']))
+        if not chips_valid.any():
+            continue
+
+        # goodness of fit of MaximumCorrelation is |R|
+        surface = np.abs(correlation(search, pattern, min_overlap, workers))
+        flat = np.where(np.isnan(surface), -1., surface).reshape(len(idx), -1)
+        best = flat.argmax(axis=1)
+        best_fit = flat[np.arange(len(idx)), best]
+        best_lines, best_samples = np.unravel_index(best, surface.shape[1:])
+
+        offset_lines, offset_samples = np.zeros(len(idx)), np.zeros(len(idx))
+        is_subpixel = np.zeros(len(idx), dtype=bool)
+        distance_ok = np.ones(len(idx), dtype=bool)
+        if subpixel:
+            offset_lines, offset_samples = subpixel_offsets(surface, best_lines, best_samples, settings['window_size'])
+            is_subpixel = np.isfinite(offset_lines)
+            distance_ok = ~is_subpixel | (np.hypot(offset_lines, offset_samples) <= settings['distance_tolerance'])
+            offset_lines, offset_samples = np.nan_to_num(offset_lines), np.nan_to_num(offset_samples)
+
+        res_line[idx] = search_lines[idx] + best_lines - center_offset[0] + offset_lines
+        res_sample[idx] = search_samples[idx] + best_samples - center_offset[1] + offset_samples
+        fit[idx] = np.where(best_fit >= 0., best_fit, np.nan)
+        success[idx] = chips_valid & (best_fit >= settings['tolerance']) & distance_ok
+        registered_subpixel[idx] = is_subpixel
+
+    return res_sample, res_line, fit, success, registered_subpixel
+
+
+def register(from_image, match_image, settings, rows=None, columns=None, batch=h.NCC_BATCH_POINTS,
+             workers=h.NCC_FFT_WORKERS) -> pd.DataFrame:
+    """
+    Register the grid of MATCH image pattern chips in FROM image search chips (as ISIS coreg does).
+    With 'ReductionFactor' the chips are registered in images reduced by the factor first, and refined
+    in full resolution images in search chips of pattern chip size extended by the factor
+    """
+    lines, samples = match_image.shape
+    sample, line, row, column = grid(samples, lines, settings['search_size'], rows, columns)
+    pattern_image, search_image = match_image.copy(), from_image.copy()
+    for image, (valid_min, valid_max) in [(pattern_image, settings['pattern_range']),
+                                          (search_image, settings['search_range'])]:
+        with np.errstate(invalid='ignore'):
+            image[(image < valid_min) | (image > valid_max)] = np.nan
+    if settings['sobel']:
+        pattern_image, search_image = sobel(pattern_image), sobel(search_image)
+
+    pattern_size, search_size = settings['pattern_size'], settings['search_size']
+    search_sample, search_line = sample, line
+    factor = settings['reduction']
+    coarse_success = np.ones(len(sample), dtype=bool)
+    if factor > 1:
+        coarse_sample, coarse_line, _, coarse_success, _ = register_points(
+            block_mean(pattern_image, factor), block_mean(search_image, factor),
+            (sample - 1) // factor + 1, (line - 1) // factor + 1, (sample - 1) // factor + 1, (line - 1) // factor + 1,
+            [max(s // factor, 3) for s in pattern_size], [max(s // factor, 3) for s in search_size],
+            settings, False, batch, workers)
+        # centers of the reduced pixels in full resolution, out of the image estimates are clipped
+        search_sample = np.clip(np.round((np.nan_to_num(coarse_sample) - 0.5) * factor + 0.5), 1, samples).astype(int)
+        search_line = np.clip(np.round((np.nan_to_num(coarse_line) - 0.5) * factor + 0.5), 1, lines).astype(int)
+        search_size = [min(p + 2 * factor, s) for p, s in zip(pattern_size, search_size)]
+
+    res_sample, res_line, fit, success, subpixel = register_points(
+        pattern_image, search_image, sample, line, search_sample, search_line, pattern_size, search_size,
+        settings, settings['subpixel'], batch, workers)
+    success &= coarse_success
+
+    return pd.DataFrame({
+        'Sample': sample, 'Line': line, 'TranslatedSample': res_sample, 'TranslatedLine': res_line,
+        # differences are the translation of FROM image to the MATCH one (as of ISIS coreg)
+        'SampleDifference': sample - res_sample, 'LineDifference': line - res_line, 'GoodnessOfFit': fit,
+        'row': row, 'column': column, 'subpixel': subpixel,
+    })[success].reset_index(drop=True)
+
+
+def write_control_network(path, df_points, from_sn, match_sn, target='Moon'):
+    """ Binary Control Network of registered points: reference MATCH measure and registered FROM measure """
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    header = [('NetworkId', 'Coreg'), ('TargetName', target), ('UserName', getpass.getuser()),
+              ('Created', now), ('LastModified', now), ('Description', 'Coreg'), ('Version', '5')]
+    points = (
+        ([('PointType', 'Free'), ('PointId', f'"Row {p.row} Column {p.column}"'), ('ChooserName', 'coreg'),
+          ('DateTime', now)],
+         [[('SerialNumber', match_sn), ('MeasureType', 'Candidate'), ('ChooserName', 'coreg'),
+           ('DateTime', now), ('Sample', str(float(p.Sample))), ('Line', str(float(p.Line))), ('Reference', 'True')],
+          [('SerialNumber', from_sn), ('MeasureType', 'RegisteredSubPixel' if p.subpixel else 'RegisteredPixel'),
+           ('ChooserName', 'coreg'), ('DateTime', now), ('Sample', str(p.TranslatedSample)),
+           ('Line', str(p.TranslatedLine)), ('SampleResidual', f'{p.SampleDifference} <pixels>'),
+           ('LineResidual', f'{p.LineDifference} <pixels>'), ('GoodnessOfFit', str(p.GoodnessOfFit))]])
+        for p in df_points.itertuples(index=False)
+    )
+    cnetbin.write(path, header, points)
+
+
+def coreg(from_cub, match_cub, deffile, onet, flatfile, to_=None, transform=h.transform, rows=None, columns=None,
+          batch=h.NCC_BATCH_POINTS, workers=h.NCC_FFT_WORKERS) -> int:
+    """
+    In-process replacement of ISIS coreg with MaximumCorrelation algorithm: FROM cube is registered to MATCH cube
+    with settings of 'deffile'. Control Network 'onet', 'flatfile' (the same columns as coreg one) and translated
+    or warped FROM cube 'to_' are written. Returns the number of registered points (nothing is written if it's 0)
+    """
+    from_image, match_image = cube.read_band(from_cub), cube.read_band(match_cub)
+    if from_image.shape != match_image.shape:
+        raise ValueError(f'Cubes {from_cub} and {match_cub} must have the same dimensions')
+
+    df_points = register(from_image, match_image, match_settings(deffile), rows, columns, batch, workers)
+    if not len(df_points):
+        return 0
+
+    df_points[FLATFILE_COLUMNS].to_csv(flatfile, index=False)
+    target = cube.read_label(match_cub).get('Instrument', {}).get('TargetName', 'Moon')
+    write_control_network(onet, df_points, pathlib.Path(from_cub).name, pathlib.Path(match_cub).name, target)
+
+    if to_:
+        if transform == 'translate':
+            isis.translate(from_=from_cub, to_=to_, strans=df_points['SampleDifference'].mean(),
+                           ltrans=df_points['LineDifference'].mean(), interp='cubicconvolution')
+        else:
+            isis.warp(from_=from_cub, to_=to_, cnet=onet)
+    return len(df_points)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import os
+import pathlib
+from typing import Dict, Any
+
+import numpy as np
+import pandas as pd
+
+# columns with "(a, b)" tuples in Apollo Pancam state vectors csv, and names of their parsed numeric fields
+TUPLE_COLUMNS = {
+    'nadir_point': ('lat_nadir', 'lon_nadir'),
+    # order of (lat, lon) in tuple is different here - it's not a bug
+    'camera_axis_intersect': ('lon_int', 'lat_int'),
+    **{f'photo_footprint{i}': (f'photo_footprint{i}_lat', f'photo_footprint{i}_lon') for i in range(1, 5)},
+    **{f'inner_photo_footprint{i}': (f'inner_photo_footprint{i}_lat', f'inner_photo_footprint{i}_lon')
+       for i in range(1, 5)},
+}
+
+STATE_VECTOR_DTYPE = np.dtype(
+    [('image_name', 'U16'), ('utc_time', 'U32'), ('spacecraft_altitude', 'f8')] +
+    [(field, 'f8') for fields in TUPLE_COLUMNS.values() for field in fields]
+)
+
+# compiled state vectors loaded by the current process, by csv path
+_stores = {}
+
+
+def compile_state_vectors(csv_path) -> np.ndarray:
+    """ Parse state vectors csv into a structured array with numeric columns """
+    df = pd.read_csv(csv_path, usecols=['image_name', 'utc_time', 'spacecraft_altitude', *TUPLE_COLUMNS])
+    df = df.drop_duplicates('image_name')
+
+    res = np.zeros(df.shape[0], dtype=STATE_VECTOR_DTYPE)
+    res['image_name'] = df['image_name'].str.upper().to_numpy(dtype=str)
+    res['utc_time'] = df['utc_time'].to_numpy(dtype=str)
+    res['spacecraft_altitude'] = df['spacecraft_altitude'].to_numpy(dtype=float)
+
+    for column, fields in TUPLE_COLUMNS.items():
+        values = df[column].str.strip('() ').str.split(',', expand=True).reindex(columns=[0, 1])
+        for i, field in enumerate(fields):
+            res[field] = pd.to_numeric(values[i], errors='coerce').to_numpy(dtype=float)
+
+    return res
+
+
+class StateVectorStore:
+    """
+    Apollo Pancam state vectors indexed by image name.
+    Compiled table is cached next to the csv in NumPy binary format ('.npy') and memory-mapped
+    on load, it's recompiled when the csv is newer than the cache
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = pathlib.Path(csv_path)
+        self.table = self.load()
+        self.index = {name: i for i, name in enumerate(self.table['image_name'])}
+
+    def load(self) -> np.ndarray:
+        cache_path = self.csv_path.with_suffix('.npy')
+        if cache_path.exists() and cache_path.stat().st_mtime >= self.csv_path.stat().st_mtime:
+            return np.load(cache_path, mmap_mode='r')
+
+        table = compile_state_vectors(self.csv_path)
+        try:
+            # write to a temporary file first - other workers might be loading the cache
+            temp_path = cache_path.with_suffix(f'.{os.getpid()}.npy')
+            np.save(temp_path, table)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # read-only location, keep the compiled table in memory only
+            pass
+        return table
+
+    def get(self, image_name) -> Dict[str, Any]:
+        """ State vector of the image as a dictionary """
+        row = self.table[self.index[str(image_name).upper()]]
+        return {field: row[field].item() for field in STATE_VECTOR_DTYPE.names}
+
+
+def get_store(csv_path) -> StateVectorStore:
+    """ State vectors store for the csv, loaded once per process """
+    csv_path = pathlib.Path(csv_path)
+    if csv_path not in _stores:
+        _stores[csv_path] = StateVectorStore(csv_path)
+    return _stores[csv_path]
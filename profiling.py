@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import pathlib
+import resource
+import functools
+import contextlib
+import subprocess
+from typing import Union, List
+
+import pandas as pd
+import kalasiris
+
+# path of the json lines trace file. Set in the environment, so it's inherited by Pool workers
+PROFILE_ENV = 'LMCT_PROFILE'
+
+# ISIS program arguments with input / output files
+INPUT_ARGS = ['from_', 'from', 'fromlist', 'match', 'cnet', 'coordlist']
+OUTPUT_ARGS = ['to_', 'to', 'onet', 'flatfile']
+
+
+def enable(trace_path) -> Union[str, None]:
+    """
+    Start tracing ISIS calls to 'trace_path' (the file is truncated).
+    Returns the trace path set before (None if tracing was disabled), it's restored by 'disable'
+    """
+    trace_path = pathlib.Path(trace_path).resolve()
+    trace_path.write_text('')
+    previous = os.environ.get(PROFILE_ENV)
+    os.environ[PROFILE_ENV] = str(trace_path)
+    return previous
+
+
+def disable(previous=None):
+    """ Stop tracing ISIS calls, the trace path returned by 'enable' is restored """
+    if previous is None:
+        os.environ.pop(PROFILE_ENV, None)
+    else:
+        os.environ[PROFILE_ENV] = previous
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+@contextlib.contextmanager
+def children_peak_rss(peaks: List[int]):
+    """
+    Peak RSS (KB) of every child process started by 'subprocess' (as kalasiris runs ISIS programs) within
+    the context is appended to 'peaks'. Children are reaped by os.wait4, which returns the usage of the child
+    """
+    popen = subprocess.Popen
+
+    class Popen(popen):
+        def _try_wait(self, wait_flags):
+            try:
+                pid, sts, usage = os.wait4(self.pid, wait_flags)
+            except ChildProcessError:
+                # the child can't be waited for (as of subprocess.Popen), its usage is unknown
+                return self.pid, 0
+            if pid:
+                peaks.append(usage.ru_maxrss)
+            return pid, sts
+
+    subprocess.Popen = Popen
+    try:
+        yield peaks
+    finally:
+        subprocess.Popen = popen
+
+
+def traced_call(program, func, *args, **kwargs):
+    """
+    Call kalasiris function and append its trace record to the trace file: program, stage (calling
+    function), input/output paths, wall time, children CPU time, peak RSS of the call and output size.
+    Peak RSS is the maximum RSS of the ISIS processes run by this call (None if it ran none). On Linux it's
+    at least the RSS of the worker when the process is started (the kernel counts it before exec)
+    """
+    stage = sys._getframe(1).f_code.co_name
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    status = 'ok'
+    peaks = []
+
+    try:
+        with children_peak_rss(peaks):
+            return func(*args, **kwargs)
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        wall = time.perf_counter() - start
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        outputs = {k: str(v) for k, v in kwargs.items() if k in OUTPUT_ARGS}
+        record = {
+            'program': program,
+            'stage': stage,
+            'pid': os.getpid(),
+            'status': status,
+            'inputs': [str(a) for a in args] + [str(v) for k, v in kwargs.items() if k in INPUT_ARGS],
+            'outputs': list(outputs.values()),
+            'wall': round(wall, 4),
+            'cpu': round((usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime), 4),
+            'peak_rss_kb': max(peaks, default=None),
+            'output_bytes': sum(file_size(path) or 0 for path in outputs.values()),
+        }
+        with open(os.environ[PROFILE_ENV], 'at') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class TracedIsis:
+    """ Drop-in replacement of 'kalasiris' module tracing all ISIS calls when profiling is enabled """
+
+    def __getattr__(self, name):
+        attr = getattr(kalasiris, name)
+        if callable(attr) and os.environ.get(PROFILE_ENV):
+            return functools.partial(traced_call, name, attr)
+        return attr
+
+
+isis = TracedIsis()
+
+
+def summary(trace_path) -> pd.DataFrame:
+    """ Summary of ISIS calls grouped by stage and program """
+    df = pd.read_json(trace_path, lines=True)
+    if df.empty:
+        return df
+
+    total_wall = df['wall'].sum()
+    df_summary = (df.groupby(['stage', 'program'])
+                  .agg(calls=('wall', 'size'), wall=('wall', 'sum'), cpu=('cpu', 'sum'),
+                       peak_rss_kb=('peak_rss_kb', 'max'), output_bytes=('output_bytes', 'sum'))
+                  .sort_values('wall', ascending=False)
+                  .reset_index())
+    df_summary['wall_pct'] = 100 * df_summary['wall'] / total_wall
+    return df_summary
+
+
+def print_summary(trace_path):
+    """ Print profile of ISIS calls by program, and by stage and program """
+    df_summary = summary(trace_path)
+    if df_summary.empty:
+        print('[INFO] Profile: no ISIS calls were traced')
+        return
+
+    print(f'[INFO] Profile of ISIS calls (trace: {trace_path}):')
+    df_programs = df_summary.groupby('program')[['calls', 'wall', 'wall_pct']].sum().sort_values('wall', ascending=False)
+    for program, row in df_programs.iterrows():
+        print(f'    {program}: {row["calls"]:,.0f} calls, {row["wall"]:,.1f} secs, {row["wall_pct"]:.0f}% of wall time')
+
+    print('[INFO] Profile by stage:')
+    for _, row in df_summary.iterrows():
+        print(f'    {row["stage"]} / {row["program"]}: {row["calls"]:,} calls, {row["wall"]:,.1f} secs '
+              f'({row["wall_pct"]:.0f}%), cpu {row["cpu"]:,.1f} secs, peak RSS {row["peak_rss_kb"] / 1024:,.0f} MB, '
+              f'output {row["output_bytes"] / 2 ** 20:,.1f} MB')
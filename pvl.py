@@ -2,297 +2,570 @@ import pathlib
 from typing import List, Tuple, Dict, TextIO, Any, Union
 import shutil
 import math
+import re
+import numpy as np
 import pandas as pd
+from scipy.spatial import cKDTree
 
-import parse
-import kalasiris as isis
+from profiling import isis
 import helper as h
+import cnetbin
 import zscore
 
 
-def all_substrings_in(substr_lst: List[str], line: str) -> bool:
-    """
-    Check if all substrings are in the line.
-    """
-    ret = True
-    for match_str in substr_lst:
-        if match_str not in line:
-            ret = False
-            break
+# some lines in pvl might be split by '-\n' sequence. They are joined into one line before parsing
+PVL_CONTINUATION_RE = re.compile(r'-\n[ \t]*')
 
-    return ret
+# measure keywords whose values are written back from the ControlNetwork columns
+MEASURE_COLUMNS = {'SerialNumber': 'serial_number', 'Sample': 'sample', 'Line': 'line'}
 
 
-def read_till(match_str_lst: List[str], f: TextIO) -> Tuple[List[str], str]:
-    head = []
-    found_line = ''
-    pred_line = ''
+def pvl_to_float(value: Union[str, None]) -> float:
+    """
+    Convert pvl value to float. Measurement units (like '<pixels>') are dropped, missing value is NaN
+    """
+    if value is None:
+        return math.nan
+    return float(value.split(' ')[0])
 
-    for line in f:
-        # some lines in pvl might be split by '-\n' sequence. Join them into one line to process
-        if '-\n' in line:
-            pred_line = pred_line + line[:-2]
-            continue
 
-        if pred_line:
-            line = pred_line + line.strip(' ')
-            pred_line = ''
+def pvl_to_bool(value: Union[str, None]) -> bool:
+    return value is not None and value.strip().lower() == 'true'
 
-        # save the line
-        head.append(line)
 
-        # check if all match substrings are in the line. if so - stop reading from the file and return results
-        if match_str_lst and all_substrings_in(match_str_lst, line):
-            found_line = line
-            break
+class ControlNetwork:
+    """
+    Columnar representation of ISIS Control Network.
+    Values used by the tool are kept in NumPy arrays (one element per point or per measure),
+    all other keywords are kept as (key, value) pairs to be able to write the network back.
+    Measures of point 'i' are 'point_offsets[i]:point_offsets[i + 1]'
+    """
 
-    return head, found_line
+    def __init__(self,
+                 header: List[Tuple[str, str]],
+                 point_keywords: List[Tuple[Tuple[str, str], ...]],
+                 point_offsets: np.ndarray,
+                 point_id: np.ndarray,
+                 point_ignore: np.ndarray,
+                 measure_keywords: List[Tuple[Tuple[str, str], ...]],
+                 serial_number: np.ndarray,
+                 sample: np.ndarray,
+                 line: np.ndarray,
+                 sample_residual: np.ndarray,
+                 line_residual: np.ndarray,
+                 reference: np.ndarray,
+                 measure_ignore: np.ndarray):
+        self.header = header
+        self.point_keywords = point_keywords
+        self.point_offsets = point_offsets
+        self.point_id = point_id
+        self.point_ignore = point_ignore
+        self.measure_keywords = measure_keywords
+        self.serial_number = serial_number
+        self.sample = sample
+        self.line = line
+        self.sample_residual = sample_residual
+        self.line_residual = line_residual
+        self.reference = reference
+        self.measure_ignore = measure_ignore
+
+    @property
+    def n_points(self) -> int:
+        return len(self.point_id)
+
+    @property
+    def n_measures(self) -> int:
+        return len(self.serial_number)
+
+    @property
+    def measure_point(self) -> np.ndarray:
+        """ Index of the owning point for every measure """
+        return np.repeat(np.arange(self.n_points), np.diff(self.point_offsets))
+
+    @classmethod
+    def from_keywords(cls, header: List[Tuple[str, str]],
+                      points: List[Tuple[List[Tuple[str, str]], List[List[Tuple[str, str]]]]]) -> 'ControlNetwork':
+        """
+        Build Control Network from pvl keywords of points: [(point keywords, [measure keywords, ...]), ...]
+        """
+        point_keywords, point_offsets, point_id, point_ignore = [], [0], [], []
+        measure_keywords, serial_number, sample, line = [], [], [], []
+        sample_residual, line_residual, reference, measure_ignore = [], [], [], []
+
+        for point, measures in points:
+            kw = dict(point)
+            point_id.append(kw.get('PointId', ''))
+            point_ignore.append(pvl_to_bool(kw.get('Ignore')))
+            point_keywords.append(tuple((k, v) for k, v in point if k != 'Ignore'))
+
+            for measure in measures:
+                kw = dict(measure)
+                measure_keywords.append(tuple(measure))
+                serial_number.append(kw.get('SerialNumber', ''))
+                sample.append(pvl_to_float(kw.get('Sample')))
+                line.append(pvl_to_float(kw.get('Line')))
+                sample_residual.append(pvl_to_float(kw.get('SampleResidual')))
+                line_residual.append(pvl_to_float(kw.get('LineResidual')))
+                reference.append(pvl_to_bool(kw.get('Reference')))
+                measure_ignore.append(pvl_to_bool(kw.get('Ignore')))
+            point_offsets.append(len(measure_keywords))
+
+        return cls(header=list(header),
+                   point_keywords=point_keywords,
+                   point_offsets=np.array(point_offsets, dtype=np.int64),
+                   point_id=np.array(point_id, dtype=object),
+                   point_ignore=np.array(point_ignore, dtype=bool),
+                   measure_keywords=measure_keywords,
+                   serial_number=np.array(serial_number, dtype=object),
+                   sample=np.array(sample, dtype=np.float64),
+                   line=np.array(line, dtype=np.float64),
+                   sample_residual=np.array(sample_residual, dtype=np.float64),
+                   line_residual=np.array(line_residual, dtype=np.float64),
+                   reference=np.array(reference, dtype=bool),
+                   measure_ignore=np.array(measure_ignore, dtype=bool))
+
+    def points(self):
+        """
+        Generate (point keywords, [measure keywords, ...]) of every point, values of the columns included
+        """
+        for p in range(self.n_points):
+            point = list(self.point_keywords[p])
+            if self.point_ignore[p]:
+                point.insert(0, ('Ignore', 'True'))
+
+            measures = []
+            for m in range(self.point_offsets[p], self.point_offsets[p + 1]):
+                measures.append([(k, getattr(self, MEASURE_COLUMNS[k])[m] if k in MEASURE_COLUMNS else v)
+                                 for k, v in self.measure_keywords[m]])
+            yield point, measures
+
+    def to_pvl(self) -> str:
+        """
+        Serialize Control Network to pvl (text) format
+        """
+        out = ['Object = ControlNetwork\n']
+        out.extend(f'  {k} = {v}\n' for k, v in self.header)
+
+        for point, measures in self.points():
+            out.append('\n  Object = ControlPoint\n')
+            out.extend(f'    {k} = {v}\n' for k, v in point)
+
+            for measure in measures:
+                out.append('\n    Group = ControlMeasure\n')
+                out.extend(f'      {k} = {v}\n' for k, v in measure)
+                out.append('    End_Group\n')
+
+            out.append('  End_Object\n')
+
+        out.append('End_Object\nEnd\n')
+        return ''.join(out)
+
+    def to_bin(self, output_net_path: pathlib.Path):
+        """
+        Write Control Network in ISIS binary format
+        """
+        cnetbin.write(output_net_path, self.header, ((point, [[(k, str(v)) for k, v in measure] for measure in measures])
+                                                     for point, measures in self.points()))
+
+
+def parse_control_network(text: str) -> ControlNetwork:
+    """
+    Parse Control Network in pvl (text) format in a single pass
+    """
+    header = []
+    point_keywords, point_offsets, point_id, point_ignore = [], [0], [], []
+    measure_keywords, serial_number, sample, line = [], [], [], []
+    sample_residual, line_residual, reference, measure_ignore = [], [], [], []
+
+    keywords = header
+    point = None
+    measure = None
+    # value of the last keyword continues on the next lines (multi-line parenthesized arrays)
+    unbalanced = False
+
+    for raw_line in PVL_CONTINUATION_RE.sub('', text).splitlines():
+        if unbalanced:
+            key, value = keywords[-1]
+            value = f'{value} {raw_line.strip()}'
+            keywords[-1] = (key, value)
+            unbalanced = value.count('(') > value.count(')')
+            continue
 
+        key, sep, value = raw_line.partition('=')
+        key = key.strip()
+
+        if not sep:
+            if key in ('End_Group', 'EndGroup') and measure is not None:
+                kw = dict(measure)
+                measure_keywords.append(tuple(measure))
+                serial_number.append(kw.get('SerialNumber', ''))
+                sample.append(pvl_to_float(kw.get('Sample')))
+                line.append(pvl_to_float(kw.get('Line')))
+                sample_residual.append(pvl_to_float(kw.get('SampleResidual')))
+                line_residual.append(pvl_to_float(kw.get('LineResidual')))
+                reference.append(pvl_to_bool(kw.get('Reference')))
+                measure_ignore.append(pvl_to_bool(kw.get('Ignore')))
+                measure = None
+                keywords = point
+            elif key in ('End_Object', 'EndObject') and point is not None:
+                point_keywords.append(tuple(point))
+                point_offsets.append(len(measure_keywords))
+                point = None
+                keywords = header
+            continue
 
-def pvlgroup_to_dict(grp: List[str]) -> Dict[str, str]:
+        if key.startswith('#'):
+            continue
+        value = value.strip()
+
+        if key == 'Object' and value == 'ControlPoint':
+            point = []
+            point_id.append('')
+            point_ignore.append(False)
+            keywords = point
+        elif key == 'Group' and value == 'ControlMeasure':
+            measure = []
+            keywords = measure
+        elif key == 'Object' and value == 'ControlNetwork':
+            continue
+        elif point is not None and measure is None and key == 'PointId':
+            point_id[-1] = value
+            point.append((key, value))
+        elif point is not None and measure is None and key == 'Ignore':
+            point_ignore[-1] = pvl_to_bool(value)
+        else:
+            keywords.append((key, value))
+            unbalanced = value.count('(') > value.count(')')
+
+    return ControlNetwork(header=header,
+                          point_keywords=point_keywords,
+                          point_offsets=np.array(point_offsets, dtype=np.int64),
+                          point_id=np.array(point_id, dtype=object),
+                          point_ignore=np.array(point_ignore, dtype=bool),
+                          measure_keywords=measure_keywords,
+                          serial_number=np.array(serial_number, dtype=object),
+                          sample=np.array(sample, dtype=np.float64),
+                          line=np.array(line, dtype=np.float64),
+                          sample_residual=np.array(sample_residual, dtype=np.float64),
+                          line_residual=np.array(line_residual, dtype=np.float64),
+                          reference=np.array(reference, dtype=bool),
+                          measure_ignore=np.array(measure_ignore, dtype=bool))
+
+
+def read_control_network(input_path: pathlib.Path) -> ControlNetwork:
     """
-    Parse pvl group formatted as a list of 'key = value' strings into dictionary
+    Read Control Network from pvl (text) or ISIS binary file.
+    Binary networks of versions other than 5 are converted to pvl by ISIS
     """
-    grp_dict = {}
+    input_path = pathlib.Path(input_path)
+    if cnetbin.is_binary(input_path):
+        try:
+            return ControlNetwork.from_keywords(*cnetbin.read(input_path))
+        except ValueError as ex:
+            print(f'--> [INFO] {ex}, converting it with cnetbin2pvl')
+            temp_pvl_path = input_path.parent / f'{input_path.name}.cnetbin2pvl.pvl'
+            isis.cnetbin2pvl(from_=input_path, to_=temp_pvl_path)
+            try:
+                return read_control_network(temp_pvl_path)
+            finally:
+                temp_pvl_path.unlink()
+
+    with open(input_path, 'rt') as f:
+        return parse_control_network(f.read())
+
+
+def write_final_cn(cn: ControlNetwork, output_folder: pathlib.Path, output_cn_name: str):
+    """
+    Write Control Network to files in both binary and pvl (text) format
+    """
+    cn.to_bin(output_folder / f'{output_cn_name}.net')
+    with open(output_folder / f'{output_cn_name}.pvl', 'wt') as f:
+        f.write(cn.to_pvl())
 
-    for line in grp:
-        res = parse.parse('{}={}', line)
-        if res:
-            k = res.fixed[0].strip()
-            v = res.fixed[1].strip()
-            grp_dict.update({k: v})
 
-    return grp_dict
+def translate_measures(cn: ControlNetwork,
+                       old_cube_path: pathlib.Path,
+                       lroc_cube_path: pathlib.Path,
+                       output_folder: pathlib.Path,
+                       output_cn_name: str,
+                       cubes_folder: pathlib.Path = None):
+    """
+    Translate measures of 'cn' to source images point by point (several ISIS calls per measure).
+    Co-registered cubes (named by measures serial numbers) are in 'cubes_folder' (default is 'output_folder')
+    """
+    cubes_folder = cubes_folder or output_folder
+    temp_pvl_path = output_folder / f'{output_cn_name}.camtp.pvl'
 
+    for i in range(cn.n_measures):
+        # if matched (moved) point
+        if not cn.serial_number[i]:
+            continue
 
-def clean_pvldict(pvl_dict: Dict[str, str]) -> Dict[str, Any]:
-    cleaned_dict = pvl_dict.copy()
+        # for transformed image. get lat & lon of control point
+        isis.campt(from_=cubes_folder / cn.serial_number[i], to_=temp_pvl_path,
+                   append=False, sample=cn.sample[i], line=cn.line[i])
+        lat = isis.getkey_k(temp_pvl_path, group='GroundPoint', key='PlanetocentricLatitude')
+        lon = isis.getkey_k(temp_pvl_path, group='GroundPoint', key='PositiveEast360Longitude')
 
-    def update_dict(key, type_):
-        val = cleaned_dict.get(key, None)
-        if val is not None:
-            # in case these are some measurement units in a string
-            val = val.split(' ')[0]
-            cleaned_dict[key] = type_(val)
+        ## for source image. get sample & line of control point corresponding to found lat & lon
+        if cn.reference[i]:
+            src_image = lroc_cube_path
+        else:
+            src_image = old_cube_path
 
-    for key in ['Sample', 'Line', 'SampleResidual', 'LineResidual']:
-        update_dict(key, float)
+        isis.campt(from_=src_image, to_=temp_pvl_path, type='ground', append=False,
+                   latitude=lat, longitude=lon)
+        cn.sample[i] = float(isis.getkey_k(temp_pvl_path, group='GroundPoint', key='Sample'))
+        cn.line[i] = float(isis.getkey_k(temp_pvl_path, group='GroundPoint', key='Line'))
+        cn.serial_number[i] = isis.getsn(from_=src_image, format_='flat').stdout.strip()
 
-    update_dict('Reference', bool)
-    return cleaned_dict
+    if temp_pvl_path.exists():
+        temp_pvl_path.unlink()
 
 
-def update_pvlgroup(source_pvl: List[str], keys: List[str], pvl_dict: Dict[str, Any]) -> List[str]:
+def campt_coordlist(cube_path: pathlib.Path, coords: np.ndarray, coordtype: str,
+                    temp_prefix: pathlib.Path) -> pd.DataFrame:
     """
-    Update 'source_pvl' (containing pvl group as list of strings) from 'pvl_dict'
-    using only dictionary keys from 'keys'
+    Resolve all coordinates ('sample, line' or 'latitude, longitude' rows of 'coords')
+    with a single campt call. Returns campt flat output, one row per coordinate
     """
-    res_pvl = source_pvl.copy()
+    coordlist_path = temp_prefix.parent / f'{temp_prefix.name}.coords.txt'
+    flat_path = temp_prefix.parent / f'{temp_prefix.name}.campt.csv'
+
+    np.savetxt(coordlist_path, coords, fmt='%.10f', delimiter=',')
+    isis.campt(from_=cube_path, to_=flat_path, usecoordlist=True, coordlist=coordlist_path,
+               coordtype=coordtype, format_='flat', append=False, allowoutside=True)
+    res = pd.read_csv(flat_path)
+
+    for temp_path in [coordlist_path, flat_path]:
+        if temp_path.exists():
+            temp_path.unlink()
 
-    for i, line in enumerate(res_pvl):
-        for key in keys:
-            if all_substrings_in([f' {key} ', ' = '], line):
-                res_pvl[i] = f'{key} = {pvl_dict[key]}\n'
-    return res_pvl
+    if res.shape[0] != coords.shape[0]:
+        raise ValueError(f'campt returned {res.shape[0]} points for {coords.shape[0]} coordinates ({cube_path})')
+
+    return res
 
 
-def write_final_cn(cn: str, output_folder: pathlib.Path, output_cn_name: str):
+def translate_measures_batched(cn: ControlNetwork,
+                               old_cube_path: pathlib.Path,
+                               lroc_cube_path: pathlib.Path,
+                               output_folder: pathlib.Path,
+                               output_cn_name: str,
+                               cubes_folder: pathlib.Path = None):
     """
-    Write Control Network from 'cn' string to files in both binary and pvl (text) format
+    Translate measures of 'cn' to source images with one campt call per cube per direction
+    and one getsn call per source image (see translate_measures)
     """
-    temp_pvl_path = output_folder / 'camtp.pvl'
+    cubes_folder = cubes_folder or output_folder
+    temp_prefix = output_folder / f'{output_cn_name}.translate'
+    matched = np.flatnonzero(cn.serial_number != '')
+
+    # for transformed images. get lat & lon of control points
+    lat = np.full(cn.n_measures, np.nan)
+    lon = np.full(cn.n_measures, np.nan)
+    for serial_number in np.unique(cn.serial_number[matched]):
+        idx = matched[cn.serial_number[matched] == serial_number]
+        ground = campt_coordlist(cubes_folder / serial_number,
+                                 np.column_stack([cn.sample[idx], cn.line[idx]]), 'image', temp_prefix)
+        lat[idx] = ground['PlanetocentricLatitude'].to_numpy(dtype=float)
+        lon[idx] = ground['PositiveEast360Longitude'].to_numpy(dtype=float)
+
+    # for source images. get sample & line of control points corresponding to found lat & lon
+    for is_reference, src_image in [(True, lroc_cube_path), (False, old_cube_path)]:
+        idx = matched[cn.reference[matched] == is_reference]
+        if not len(idx):
+            continue
 
-    with open(temp_pvl_path, 'wt') as f:
-        f.write(cn)
+        # measures not projected to ground are left NaN (campt can't parse NaN coordinates)
+        found = idx[np.isfinite(lat[idx]) & np.isfinite(lon[idx])]
+        cn.sample[idx] = np.nan
+        cn.line[idx] = np.nan
+        if len(found):
+            image = campt_coordlist(src_image, np.column_stack([lat[found], lon[found]]), 'ground', temp_prefix)
+            cn.sample[found] = image['Sample'].to_numpy(dtype=float)
+            cn.line[found] = image['Line'].to_numpy(dtype=float)
+        cn.serial_number[idx] = isis.getsn(from_=src_image, format_='flat').stdout.strip()
 
-    # easiest way to format final pvl is converting it back and forth
-    output_net_path = output_folder / f'{output_cn_name}.net'
-    output_pvl_path = output_folder / f'{output_cn_name}.pvl'
-    isis.cnetpvl2bin(from_=temp_pvl_path, to_=output_net_path)
-    isis.cnetbin2pvl(from_=output_net_path, to_=output_pvl_path)
+    # points which can't be projected to ground or back to the source image are ignored
+    failed = matched[np.isnan(cn.sample[matched]) | np.isnan(cn.line[matched])]
+    if len(failed):
+        print(f'--> [INFO] Unable to translate {len(failed)} measures, corresponding points are ignored')
+        cn.point_ignore[cn.measure_point[failed]] = True
 
-    if temp_pvl_path.exists():
-        temp_pvl_path.unlink()
+
+def unseed_measures(cn: ControlNetwork, seeded_cubes: Dict[str, Tuple[str, float, float]]):
+    """
+    Move measures of seeded (translated before coreg) cubes back to the cubes they were produced from.
+    'seeded_cubes' maps serial number of seeded cube to (serial number of the source cube, sample and line shift)
+    """
+    for seeded_sn, (source_sn, sample_shift, line_shift) in seeded_cubes.items():
+        idx = cn.serial_number == seeded_sn
+        cn.sample[idx] -= sample_shift
+        cn.line[idx] -= line_shift
+        cn.serial_number[idx] = source_sn
 
 
 def translate_coreg_res(input_pvl_path: pathlib.Path,
                         old_cube_path: pathlib.Path,
                         lroc_cube_path: pathlib.Path,
                         output_folder: pathlib.Path,
-                        output_cn_name: str):
+                        output_cn_name: str,
+                        batched: bool = True,
+                        cubes_folder: pathlib.Path = None,
+                        seeded_cubes: Dict[str, Tuple[str, float, float]] = None):
     """
     Translate Control Network. Get interim (or filtered) control network after co-registration process
-    and convert it to the control network for source images
+    and convert it to the control network for source images.
+    Co-registered (reduced) cubes are in 'cubes_folder' (default is 'output_folder'), see unseed_measures
+    for 'seeded_cubes'
     """
-    temp_pvl_path = output_folder / 'camtp.pvl'
-
-    with open(input_pvl_path, 'rt') as f:
-        line = ' '
-        control_network = []
-
-        # parse control network
-        while line:
-            head, line = read_till(['Group', '=', 'ControlMeasure'], f)
-            control_network.extend(head)
-
-            pvl_group, line = read_till(['End_Group'], f)
-            pvl_dict = clean_pvldict(pvlgroup_to_dict(pvl_group[:-1]))
-
-            # if matched (moved) point
-            if 'SerialNumber' in pvl_dict.keys():
-                #try:
-                # for transformed image. get lat & lon of control point
-                isis.campt(from_=output_folder / pvl_dict['SerialNumber'], to_=temp_pvl_path,
-                           append=False, sample=pvl_dict['Sample'], line=pvl_dict['Line'])
-                lat = isis.getkey_k(temp_pvl_path, group='GroundPoint', key='PlanetocentricLatitude')
-                lon = isis.getkey_k(temp_pvl_path, group='GroundPoint', key='PositiveEast360Longitude')
-
-                ## for source image. get sample & line of control point corresponding to found lat & lon
-                if pvl_dict.get('Reference'):
-                    src_image = lroc_cube_path
-                else:
-                    src_image = old_cube_path
-
-                isis.campt(from_=src_image, to_=temp_pvl_path, type='ground', append=False,
-                           latitude=lat, longitude=lon)
-                sample = isis.getkey_k(temp_pvl_path, group='GroundPoint', key='Sample')
-                line = isis.getkey_k(temp_pvl_path, group='GroundPoint', key='Line')
-                sn = isis.getsn(from_=src_image, format_='flat').stdout.strip()
-
-                pvl_dict['Sample'] = sample
-                pvl_dict['Line'] = line
-                pvl_dict['SerialNumber'] = sn  # src_image.name  #
-                pvl_group = update_pvlgroup(pvl_group, ['Sample', 'Line', 'SerialNumber'], pvl_dict)
-                control_network.extend(pvl_group)
-                #except Exception as ex:
-                #    print(ex.stderr)
-            else:
-                control_network.extend(pvl_group)
-
-    write_final_cn(''.join(control_network), output_folder, output_cn_name)
+    cn = read_control_network(input_pvl_path)
+    if seeded_cubes:
+        unseed_measures(cn, seeded_cubes)
 
-    if temp_pvl_path.exists():
-        temp_pvl_path.unlink()
+    if batched:
+        translate_measures_batched(cn, old_cube_path, lroc_cube_path, output_folder, output_cn_name, cubes_folder)
+    else:
+        translate_measures(cn, old_cube_path, lroc_cube_path, output_folder, output_cn_name, cubes_folder)
+
+    write_final_cn(cn, output_folder, output_cn_name)
 
 
 def count_ignored(input_pvl_path: pathlib.Path) -> int:
-    cnt = 0
-    with open(input_pvl_path, 'rt') as f:
-        line = ' '
-        while line:
-            _, line = read_till(['Ignore', '=', 'True'], f)
-            if line:
-                cnt += 1
+    cn = read_control_network(input_pvl_path)
+    return int(cn.point_ignore.sum() + cn.measure_ignore.sum())
 
-    return cnt
 
+class CoregStats:
+    """
+    Columnar representation of coreg flatfile (advanced co-registration stats).
+    The file is parsed once and shared by filtering, matching with Control Network and statistics.
+    Every column is kept in a NumPy array (one element per registered point), 'filtered' marks outliers
+    """
 
-def filter_points(stats_path):
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns = dict(columns)
+        n_rows = len(next(iter(self.columns.values()))) if self.columns else 0
+        filtered = self.columns.pop('Filtered', None)
+        # 'Filtered' column is written only when the points were filtered
+        self.has_filtered = filtered is not None
+        self.filtered = np.zeros(n_rows, dtype=bool) if filtered is None else np.asarray(filtered) == 1
+
+    @classmethod
+    def read(cls, stats_path: pathlib.Path) -> 'CoregStats':
+        df_stats = pd.read_csv(stats_path)
+        return cls({name: df_stats[name].to_numpy() for name in df_stats.columns})
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.filtered)
+
+    @property
+    def n_points(self) -> int:
+        """ Number of points which are not filtered """
+        return int(self.n_rows - self.filtered.sum())
+
+    def column(self, name: str, filtered=None) -> np.ndarray:
+        """
+        Column values as floats, missing column is NaN.
+        'filtered' selects filtered (True) or not filtered (False) points only
+        """
+        values = self.columns.get(name)
+        values = np.full(self.n_rows, np.nan) if values is None else values.astype(np.float64, copy=False)
+        if filtered is None:
+            return values
+        return values[self.filtered == filtered]
+
+    def write(self, stats_path: pathlib.Path):
+        columns = dict(self.columns)
+        if self.has_filtered:
+            columns['Filtered'] = self.filtered.astype(np.int64)
+        pd.DataFrame(columns).to_csv(stats_path, index=False)
+
+
+def filter_points(stats: CoregStats, outlier_model=None) -> int:
     """
-    Add to stats file column 'Filtered' and fill it.
-    All points with Modified z-score bigger than threshold (MODIFIED_ZSCORE_THRESH) are marked as filtered
+    Mark points of coreg stats as filtered.
+    Outliers of (SampleDifference, LineDifference) residuals are detected by 'outlier_model' (OUTLIER_MODEL
+    by default, see zscore.outliers), e.g. 'mad' marks points with Modified z-score bigger than threshold
+    (MODIFIED_ZSCORE_THRESH)
     """
-    df_stats = pd.read_csv(stats_path)
-    df_stats['Filtered'] = 0
-    df_stats.to_csv(stats_path, index=False)
+    stats.has_filtered = True
+    stats.filtered[:] = zscore.outliers(
+        np.column_stack([stats.column('Sample'), stats.column('Line')]),
+        np.column_stack([stats.column('SampleDifference'), stats.column('LineDifference')]),
+        outlier_model or h.OUTLIER_MODEL, zscore_thresh=h.MODIFIED_ZSCORE_THRESH, iqr_coeff=h.IQR_COEFF, ransac_thresh=h.RANSAC_THRESH,
+        ransac_iter=h.RANSAC_ITERATIONS, ransac_sample=h.RANSAC_SAMPLE)
 
-    res = []
+    return int(stats.filtered.sum())
 
-    # if more than 2 rows - try to filter
-    if df_stats.shape[0] > 2:
-        df_stats['sample_mod_zscore'] = zscore.modified_zscore(df_stats['SampleDifference'])
-        df_stats['line_mod_zscore'] = zscore.modified_zscore(df_stats['LineDifference'])
 
-        df_stats.loc[df_stats['sample_mod_zscore'] >= h.MODIFIED_ZSCORE_THRESH, 'Filtered'] = 1
-        df_stats.loc[df_stats['line_mod_zscore'] >= h.MODIFIED_ZSCORE_THRESH, 'Filtered'] = 1
+def point_measure_values(cn: ControlNetwork) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Collapse measures of every point to a single (Sample, Line, SampleResidual, LineResidual) tuple.
+    Every value is taken from the last measure of the point having it, missing values are -1
+    """
+    def last_defined(values):
+        defined = np.flatnonzero(~np.isnan(values))
+        last = np.full(cn.n_points, -1, dtype=np.int64)
+        np.maximum.at(last, cn.measure_point[defined], defined)
 
-        # if some rows were filtered
-        if df_stats['Filtered'].sum() > 0:
-            #shutil.copy(stats_path, stats_path.with_suffix('.init.txt'))
-            (df_stats.drop(['sample_mod_zscore', 'line_mod_zscore'], axis='columns')
-             .to_csv(stats_path, index=False))
+        res = np.full(cn.n_points, -1.)
+        res[last >= 0] = values[last[last >= 0]]
+        return res
 
-        res = list(df_stats.loc[df_stats['Filtered'] == 1].itertuples(index=False))
+    return (last_defined(cn.sample), last_defined(cn.line),
+            last_defined(cn.sample_residual), last_defined(cn.line_residual))
 
-    return res
 
+def points_in_measures(stats: CoregStats, sample, line, sample_residual, line_residual, abs_tol=0.01) -> np.ndarray:
+    """
+    Check (vectorized) which measures match any of the filtered points of coreg 'stats'.
+    A measure matches the point when its (Sample, Line) is within 'abs_tol' of point's (Sample, Line)
+    or (TranslatedSample, TranslatedLine) and its residuals are within 'abs_tol' of point's differences
+    """
+    query = np.column_stack([sample, line, sample_residual, line_residual])
+    res = np.zeros(query.shape[0], dtype=bool)
 
-def point_in_measures(point_tuples_lst, pvl_dict_measures, abs_tol=0.01):
-    res = False
+    if not stats.filtered.any() or not query.shape[0]:
+        return res
 
-    for point in point_tuples_lst:
-        is_the_same_point = (
-                (math.isclose(point.Sample, pvl_dict_measures.get('Sample', -1), abs_tol=abs_tol) and
-                 math.isclose(point.Line, pvl_dict_measures.get('Line', -1), abs_tol=abs_tol))
-                or
-                (math.isclose(point.TranslatedSample, pvl_dict_measures.get('Sample', -1), abs_tol=abs_tol) and
-                 math.isclose(point.TranslatedLine, pvl_dict_measures.get('Line', -1), abs_tol=abs_tol))
-        )
+    points = np.column_stack([stats.column(name, filtered=True) for name in
+                              ['Sample', 'Line', 'TranslatedSample', 'TranslatedLine', 'SampleDifference', 'LineDifference']])
 
-        is_the_same_residual = (
-                math.isclose(point.SampleDifference,
-                             pvl_dict_measures.get('SampleResidual', -1), abs_tol=abs_tol) and
-                math.isclose(point.LineDifference,
-                             pvl_dict_measures.get('LineResidual', -1), abs_tol=abs_tol)
-        )
+    # Chebyshev distance <= abs_tol is the same as all coordinates being close (math.isclose with abs_tol)
+    upper_bound = np.nextafter(abs_tol, np.inf)
 
-        res = is_the_same_point and is_the_same_residual
+    for coords in [points[:, [0, 1, 4, 5]], points[:, [2, 3, 4, 5]]]:
+        coords = coords[~np.isnan(coords).any(axis=1)]
+        if not coords.shape[0]:
+            continue
 
-        if res:
-            break
+        dist, _ = cKDTree(coords).query(query, k=1, p=np.inf, distance_upper_bound=upper_bound)
+        res |= np.isfinite(dist)
 
     return res
 
 
-def filter_coreg_result(input_pvl_path, stats_path, output_pvl_path):
+def filter_coreg_result(input_pvl_path, stats: CoregStats, output_pvl_path, outlier_model=None):
     """
-    Filter all points in Control Network marked in stats file as 'Filtered'
+    Filter all points in Control Network marked in coreg stats as filtered
     """
-    filtered_points = filter_points(stats_path)
-    #print(filtered_points)
+    cnt_filtered = filter_points(stats, outlier_model)
 
-    if not filtered_points:
+    if not cnt_filtered:
         return 0
 
-    with open(input_pvl_path, 'rt') as f:
-        line = ' '
-        control_network = []
-
-        while line:
-            head, line = read_till(['Object', '=', 'ControlPoint'], f)
-            control_network.extend(head)
-            # print(f'head:\n {head}\nline:\n{line}\n')
-
-            pvl_group_point, line = read_till(['Group', '=', 'ControlMeasure'], f)
-            pvl_dict_point = clean_pvldict(pvlgroup_to_dict(pvl_group_point[:-1]))
-            # print(f'pvl_group_point:\n {pvl_group_point}\nline:\n{line}\n')
+    cn = read_control_network(input_pvl_path)
+    point_sample, point_line, point_sample_residual, point_line_residual = point_measure_values(cn)
 
-            # if not ignored point
-            if ('PointId' in pvl_dict_point.keys()
-                    and 'Ignore' not in pvl_dict_point.keys()):
-
-                pvl_group_measures, line = read_till(['End_Object'], f)
-                pvl_dict_measures = clean_pvldict(pvlgroup_to_dict(pvl_group_measures[:-1]))
-                # print(f'pvl_group_measures:\n {pvl_group_measures}\nline:{line}\n')
-                # print(f'pvl_dict_measures:\n {pvl_dict_measures}\n')
-
-                # if it's filtered point - and "Ignore = True" in pvl for this point
-                if point_in_measures(filtered_points, pvl_dict_measures):
-                    #print('----!!! Filtered ----')
-                    pvl_group_point.insert(0, ' Ignore = True\n')
-
-                    #print(f'pvl_dict_point after:\n {pvl_dict_point}\n')
-                    #print(f'pvl_group_point after:\n {pvl_group_point}\n')
-
-                control_network.extend(pvl_group_point)
-                control_network.extend(pvl_group_measures)
-            else:
-                control_network.extend(pvl_group_point)
-
-            # print('====================\n')
+    # if it's filtered point - and "Ignore = True" in pvl for this point
+    is_filtered = points_in_measures(stats, point_sample, point_line,
+                                     point_sample_residual, point_line_residual)
+    cn.point_ignore |= is_filtered
 
     # save Control Network in a binary and text formats
-    write_final_cn(''.join(control_network), output_pvl_path.parent, output_pvl_path.stem)
-
-    return len(filtered_points)
+    write_final_cn(cn, output_pvl_path.parent, output_pvl_path.stem)
 
+    return cnt_filtered
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import os
+import queue
+import shutil
+import threading
+from multiprocessing import Pool
+from typing import Callable, Dict, Any, Tuple, Hashable
+
+GB = 2 ** 30
+
+
+def total_memory():
+    """ Physical memory of the machine in bytes """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def free_disk(path):
+    """ Free disk space in bytes for the file system containing 'path' """
+    return shutil.disk_usage(path).free
+
+
+def folder_size(path):
+    """ Total size in bytes of files in the folder (recursively) """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # deleted while walking
+                pass
+    return size
+
+
+class FolderUsageMonitor:
+    """ Track peak size of the folder, sampling it every 'interval' seconds in a background thread """
+
+    def __init__(self, path, interval=1.):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, folder_size(self.path))
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+class Task:
+    """
+    Node of the tasks graph. 'func' is called with results of 'deps' tasks as positional arguments.
+    'resources' are estimated peak (RAM, disk) in bytes, tasks of the same 'group' might be limited
+    in number of concurrently running ones, ready tasks with higher 'priority' are started first
+    """
+
+    def __init__(self, func: Callable, deps: Tuple[Hashable, ...] = (), resources: Tuple[float, float] = (0, 0),
+                 group: str = None, priority: int = 0):
+        self.func = func
+        self.deps = tuple(deps)
+        self.resources = resources
+        self.group = group
+        self.priority = priority
+
+
+def run_dag(tasks: Dict[Hashable, Task], num_proc: int, ram_budget: float = float('inf'),
+            disk_budget: float = float('inf'), group_limits: Dict[str, int] = None,
+            done: Dict[Hashable, Any] = None) -> Dict[Hashable, Any]:
+    """
+    Run the tasks graph in a single process pool of 'num_proc' workers. A task is started as soon as
+    all its dependencies are done, while the sum of (RAM, disk) estimates of running tasks fits into
+    the budgets and its group limit is not reached. A task exceeding a budget on its own is started
+    only when no other task is running. 'done' are results of already completed tasks (e.g. by a
+    previous run), they are not in 'tasks' but might be their dependencies. Returns results by task key
+    """
+    group_limits = group_limits or {}
+    results = dict(done or {})
+    for key, task in tasks.items():
+        missing = [dep for dep in task.deps if dep not in tasks and dep not in results]
+        if missing:
+            raise ValueError(f'Task {key} depends on unknown tasks {missing}')
+
+    # the biggest tasks first, so the small ones fill the rest of the budget
+    pending = sorted(tasks, key=lambda k: (tasks[k].priority, tasks[k].resources), reverse=True)
+    running = set()
+    finished = queue.Queue()
+
+    def can_start(key):
+        task = tasks[key]
+        if any(dep not in results for dep in task.deps):
+            return False
+        if task.group in group_limits and sum(tasks[k].group == task.group for k in running) >= group_limits[task.group]:
+            return False
+        ram = sum(tasks[k].resources[0] for k in running) + task.resources[0]
+        disk = sum(tasks[k].resources[1] for k in running) + task.resources[1]
+        return not running or (ram <= ram_budget and disk <= disk_budget)
+
+    with Pool(num_proc) as p:
+        while pending or running:
+            for key in list(pending):
+                if len(running) >= num_proc:
+                    break
+                if not can_start(key):
+                    continue
+
+                task = tasks[key]
+                ram, disk = task.resources
+                if ram > ram_budget or disk > disk_budget:
+                    print(f'[INFO] Task {key} is expected to exceed resources budget '
+                          f'(RAM {ram / GB:.1f} GB, disk {disk / GB:.1f} GB), running it alone')
+                pending.remove(key)
+                running.add(key)
+                p.apply_async(task.func, [results[dep] for dep in task.deps],
+                              callback=lambda res, key=key: finished.put((key, res, None)),
+                              error_callback=lambda ex, key=key: finished.put((key, None, ex)))
+
+            if not running:
+                raise ValueError(f'Tasks {pending} have cyclic dependencies')
+
+            key, res, ex = finished.get()
+            running.remove(key)
+            if ex is not None:
+                raise ex
+            results[key] = res
+
+    return results
@@ -1,6 +1,9 @@
 from scipy import stats
 import numpy as np
 
+# outliers detection models (see 'outliers')
+OUTLIER_MODELS = ['mad', 'iqr', 'ransac_translate', 'ransac_affine']
+
 
 def get_boundaries_iqr(df_in, col_name, iqr_coeff=1.5):
     """ Getting a df_in[col_name] 'normal' values range based on the interquartile range.
@@ -13,23 +16,135 @@ def get_boundaries_iqr(df_in, col_name, iqr_coeff=1.5):
     return min_, max_
 
 
-def mad(x):
+def median(x, axis=0):
+    """
+    Median along the axis by selection (np.partition, O(n)) instead of sorting.
+    'x' must not contain NaNs
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = x.shape[axis]
+    k = (n - 1) // 2
+    if n % 2:
+        return np.partition(x, k, axis=axis).take(k, axis=axis)
+
+    part = np.partition(x, [k, k + 1], axis=axis)
+    return (part.take(k, axis=axis) + part.take(k + 1, axis=axis)) / 2.
+
+
+def mad(x, axis=0):
     """ Median absolute deviation """
-    med = np.median(x, axis=None)
-    mad = np.median(np.abs(x - med))
-    return mad
+    med = np.expand_dims(median(x, axis=axis), axis)
+    return median(np.abs(x - med), axis=axis)
 
 
-def modified_zscore(x):
+def modified_zscore(x, axis=0):
     """
     Modified z-score calculation.
     Adaptation of regular z-score to the small sample size (number of data points) case.
-    Points with with modified_zscore > specific threshold (~3.0-3.5) might be considered as outliers
+    Points with with modified_zscore > specific threshold (~3.0-3.5) might be considered as outliers.
+    Every column of 2D 'x' is scored separately (axis=0)
 
     Based on:
     "NIST/SEMATECH e-Handbook of Statistical Methods",
     https://www.itl.nist.gov/div898/handbook/eda/section3/eda35h.htm
     """
-    res = 0.6745 * (x - np.median(x)) / mad(x)
+    deviation = np.asarray(x, dtype=np.float64) - np.expand_dims(median(x, axis=axis), axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res = 0.6745 * deviation / np.expand_dims(median(np.abs(deviation), axis=axis), axis)
     return res
 
+
+def iqr_boundaries(x, iqr_coeff=1.5, axis=0):
+    """ Array version of 'get_boundaries_iqr': 'normal' values range of every column of 'x' """
+    q1, q3 = np.quantile(x, [0.25, 0.75], axis=axis)
+    iqr = q3 - q1
+    return q1 - iqr_coeff * iqr, q3 + iqr_coeff * iqr
+
+
+def affine_design(xy):
+    """ Design matrix [x, y, 1] of affine model, coordinates are normalized for numerical stability """
+    xy = (xy - xy.mean(axis=0)) / np.maximum(xy.std(axis=0), 1e-12)
+    return np.column_stack([xy, np.ones(xy.shape[0])])
+
+
+def ransac_inliers(xy, dxy, model='translate', thresh=1., n_iter=200, n_sample=10000, seed=0):
+    """
+    Inliers of residual vectors 'dxy' (N x 2) of points 'xy' (N x 2) for the model fitted by RANSAC.
+    Model is 'translate' (the same residual vector for all points) or 'affine' (residual vector
+    is an affine function of the point). Hypotheses are drawn and scored in one batch on a random subset
+    of 'n_sample' points, the best one is refined by least squares on all its inliers.
+    A point is an inlier if its residual vector is within 'thresh' of the model
+    """
+    n_points = dxy.shape[0]
+    design = None if model == 'translate' else affine_design(xy)
+    n_min = 1 if model == 'translate' else 3
+
+    rng = np.random.default_rng(seed)
+    subset = rng.choice(n_points, n_sample, replace=False) if n_points > n_sample else np.arange(n_points)
+    sample_idx = subset[rng.integers(0, subset.size, (n_iter, n_min))]
+
+    # hypotheses: residual vector for 'translate', (3 x 2) parameters matrix for 'affine'
+    if model == 'translate':
+        predicted = dxy[sample_idx[:, 0]][:, None, :]
+    else:
+        a, b = design[sample_idx], dxy[sample_idx]
+        # degenerate samples (repeated or collinear points) are dropped
+        regular = np.abs(np.linalg.det(a)) > 1e-9
+        a, b = a[regular], b[regular]
+        if not a.shape[0]:
+            return np.ones(n_points, dtype=bool)
+        predicted = design[subset] @ np.linalg.solve(a, b)
+
+    # squared distances are compared to avoid square roots
+    thresh2 = thresh ** 2
+    scores = (np.square(predicted - dxy[subset]).sum(axis=-1) <= thresh2).sum(axis=1)
+    best = np.argmax(scores)
+
+    def inliers_of(prediction):
+        diff = prediction - dxy
+        return np.einsum('ij,ij->i', diff, diff) <= thresh2
+
+    if model == 'translate':
+        inliers = inliers_of(predicted[best, 0])
+        return inliers_of(dxy[inliers].mean(axis=0)) if inliers.any() else inliers
+
+    inliers = inliers_of(design @ np.linalg.solve(a[best], b[best]))
+    if inliers.sum() < n_min:
+        return inliers
+    # least squares by normal equations (3 x 3 system)
+    inlier_design = design[inliers]
+    params = np.linalg.solve(inlier_design.T @ inlier_design, inlier_design.T @ dxy[inliers])
+    return inliers_of(design @ params)
+
+
+def outliers(xy, dxy, model='mad', zscore_thresh=3., iqr_coeff=1.5, ransac_thresh=1., ransac_iter=200,
+             ransac_sample=10000) -> np.ndarray:
+    """
+    Mark outliers among residual vectors 'dxy' (N x 2, e.g. coreg Sample/Line differences) of points 'xy'.
+    All points are processed in one batch by one of OUTLIER_MODELS:
+    - 'mad' - modified z-score of any residual component (in absolute value) is not below 'zscore_thresh'
+    - 'iqr' - any residual component is out of the interquartile range extended by 'iqr_coeff'
+    - 'ransac_translate', 'ransac_affine' - residual vector is farther than 'ransac_thresh' from the model
+    Points with undefined values are never marked, nothing is marked if there are 2 points or less
+    """
+    xy, dxy = np.asarray(xy, dtype=np.float64), np.asarray(dxy, dtype=np.float64)
+    res = np.zeros(dxy.shape[0], dtype=bool)
+    valid = np.isfinite(dxy).all(axis=1)
+    if model == 'ransac_affine':
+        valid &= np.isfinite(xy).all(axis=1)
+
+    if valid.sum() <= 2:
+        return res
+    xy, dxy = xy[valid], dxy[valid]
+
+    if model == 'mad':
+        res[valid] = (np.abs(modified_zscore(dxy)) >= zscore_thresh).any(axis=1)
+    elif model == 'iqr':
+        min_, max_ = iqr_boundaries(dxy, iqr_coeff)
+        res[valid] = ((dxy < min_) | (dxy > max_)).any(axis=1)
+    elif model in ['ransac_translate', 'ransac_affine']:
+        res[valid] = ~ransac_inliers(xy, dxy, model.split('_')[1], ransac_thresh, ransac_iter, ransac_sample)
+    else:
+        raise ValueError(f'Unknown outliers detection model: {model}')
+
+    return res